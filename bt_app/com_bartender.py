@@ -8,6 +8,19 @@ try:
 except Exception:  # pragma: no cover - pywin32 only on Windows
     Dispatch = None
 
+# BtPrintResult: 0 — btSuccess, 1 — btTimeout, 2 — btFailure (в т.ч. отменённый диалог печати)
+BT_PRINT_SUCCESS = 0
+
+
+def print_succeeded(result: Any) -> bool:
+    """Whether ``Format.PrintOut`` reported success; a wrapper that returns nothing counts as success."""
+    if result is None:
+        return True
+    try:
+        return int(result) == BT_PRINT_SUCCESS
+    except (TypeError, ValueError):
+        return True
+
 
 class BT:
     def __init__(self, logger):
@@ -0,0 +1,116 @@
+"""One pass over an opened kontur file: the DM/GTIN lookup and the pre-flight checks.
+
+Opening a file needs the ``KonturLookup`` for «Отбор», the check against the
+printed-DM ledger and the GS1 check of the DM column. Done separately, they
+are three full reads of the file, and in index mode every read parses each
+line again. ``scan_kontur`` reads the DM and GTIN columns once, chunk by
+chunk, and feeds all three. It touches no GUI state, so the app runs it in
+a worker thread. ``selection_ledger_report`` later answers the ledger check
+of a print job from that report instead of reading the rows again.
+"""
+from __future__ import annotations
+
+import time
+from array import array
+from bisect import bisect_left
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Tuple, Union
+
+from .gs1 import Gs1Report, check_columns
+from .ledger import LedgerReport, PrintedLedger
+from .row_index import KonturRowIndex
+from .row_select import KonturLookup, RowSelection
+from .row_store import KonturRowStore
+
+# строк на один кусок колонок
+SCAN_CHUNK_ROWS = 100000
+
+
+@dataclass
+class KonturScan:
+    lookup: KonturLookup
+    # None — проверка не запрашивалась (или журнала нет)
+    ledger: Optional[LedgerReport]
+    gs1: Optional[Gs1Report]
+    seconds: float
+    # с какой строки (0-based) собраны отчёты
+    report_from: Optional[int] = 0
+
+
+def iter_dm_gtin(source: Union[KonturRowStore, KonturRowIndex],
+                 chunk_rows: int = SCAN_CHUNK_ROWS) -> Iterator[Tuple[List[str], List[str]]]:
+    """(DM, GTIN) column chunks of every row, in file order."""
+    total = len(source)
+    for start in range(0, total, chunk_rows):
+        stop = min(total, start + chunk_rows)
+        if isinstance(source, KonturRowStore):
+            gtins = source.gtins
+            yield source.dm_slice(start, stop), [gtins[i] for i in source.gtin_ids()[start:stop]]
+        else:
+            dms, gtin_col, _names, _dates = source.columns(start, stop - start)
+            yield dms, gtin_col
+
+
+def scan_kontur(source: Union[KonturRowStore, KonturRowIndex], ledger: Optional[PrintedLedger] = None,
+                report_from: Optional[int] = 0, chunk_rows: int = SCAN_CHUNK_ROWS) -> KonturScan:
+    """Lookup of the whole file plus the ledger and GS1 reports for rows from ``report_from`` on.
+
+    Report positions are 0-based rows of the file. ``report_from=None``
+    builds the lookup only.
+    """
+    t0 = time.time()
+    gs1 = Gs1Report() if report_from is not None else None
+    led = LedgerReport(mark=ledger.mark()) if report_from is not None and ledger is not None else None
+
+    def chunks():
+        pos = 0
+        for dms, gtins in iter_dm_gtin(source, chunk_rows):
+            end = pos + len(dms)
+            if gs1 is not None and end > report_from:
+                cut = max(0, report_from - pos)
+                check_columns(dms[cut:], gtins[cut:], gs1, pos + cut)
+                if led is not None:
+                    led.printed.extend(ledger.printed(dms[cut:], pos + cut))
+            yield dms, gtins
+            pos = end
+
+    lookup = KonturLookup.from_columns(chunks())
+    if isinstance(source, KonturRowStore):
+        lookup.dm_at = source.dm
+    else:
+        lookup.dm_at = lambda i: (source[i] or {}).get("DM", "")
+    if led is not None:
+        led.total = gs1.total
+        # повторы DM видны по соседним равным хэшам в отсортированном индексе — без отдельного множества
+        led.duplicates = lookup.duplicate_rows(report_from)
+    return KonturScan(lookup, led, gs1, time.time() - t0, report_from)
+
+
+def _rows_in(rows: array, sel: RowSelection) -> array:
+    """Rows of a sorted ``rows`` array that fall into the selection."""
+    out = array("I")
+    for s, e in sel.ranges:
+        out.extend(rows[bisect_left(rows, s):bisect_left(rows, e)])
+    return out
+
+
+def selection_ledger_report(report: LedgerReport, sel: RowSelection, lookup: KonturLookup,
+                            ledger: PrintedLedger) -> LedgerReport:
+    """Ledger check of a selection from the file-wide report of ``scan_kontur``.
+
+    Codes printed since the scan are read from the ledger log and located
+    with the lookup. Positions are 0-based file rows; ``duplicates`` are the
+    rows whose DM already occurred above them in the file.
+    """
+    out = LedgerReport(total=len(sel), printed=_rows_in(report.printed, sel),
+                       duplicates=_rows_in(report.duplicates, sel), mark=ledger.mark())
+    done = report.printed
+    extra = array("I")
+    for dm in ledger.codes_since(report.mark):
+        for row in lookup.dm_rows(dm):
+            i = bisect_left(done, row)
+            if (i == len(done) or done[i] != row) and any(s <= row < e for s, e in sel.ranges):
+                extra.append(row)
+    if extra:
+        out.printed = array("I", sorted(out.printed + extra))
+    return out
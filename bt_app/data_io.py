@@ -3,10 +3,19 @@ from __future__ import annotations
 
 import csv
 import datetime as dt
+import gzip
+import hashlib
+import io
 import os
 import re
+import zipfile
 from calendar import monthrange
-from typing import Dict, Iterable, List, Optional
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO, Tuple, TypeVar
+
+from .gtin import lookup_product
 
 try:
     from openpyxl import load_workbook
@@ -19,6 +28,23 @@ except Exception:  # pragma: no cover - optional dependency on Windows
     win32print = None
 
 
+T = TypeVar("T")
+
+# DM, GTIN, NAME, PROD_DATE ("" — дата не указана в строке)
+KonturColumns = Tuple[List[str], List[str], List[str], List[str]]
+
+PARALLEL_MIN_BYTES = 16 * 1024 * 1024
+
+COMPRESSED_SUFFIXES = (".gz", ".zip")
+# книга Excel — не текст: строки только через openpyxl (iter_kontur_xlsx)
+WORKBOOK_SUFFIXES = (".xlsx",)
+KONTUR_SUFFIXES = (".csv", ".tsv", ".txt")
+# строк на один блок колонок при потоковом разборе сжатого файла
+STREAM_CHUNK_ROWS = 50_000
+
+# заголовки 4-й колонки, с которыми она читается как своя дата производства строки
+PROD_DATE_HEADERS = ("PROD_DATE", "ДАТА ПРОИЗВОДСТВА")
+
 REQUIRED_COLUMNS = ["ShortName", "ShortGTIN", "EXP_DATE", "PROD_DATE", "PART_NUM", "DM", "NUM"]
 
 
@@ -80,25 +106,309 @@ def add_years(date_: dt.date, years: int) -> dt.date:
     return dt.date(y, date_.month, d)
 
 
+def _header_dated(parts: List[str]) -> Optional[bool]:
+    """For a header record, whether it names its 4th column PROD_DATE; None for any other record."""
+    parts = [(p or "").strip().upper() for p in parts]
+    if not parts or parts[0] != "DM" or (len(parts) > 2 and parts[2] not in ("NAME", "")):
+        return None
+    return len(parts) > 3 and parts[3] in PROD_DATE_HEADERS
+
+
+def _kontur_row(parts: List[str], dated: bool = False) -> Optional[Dict[str, str]]:
+    """Turn one TSV record into a raw row, or None for blank/header/empty-DM records.
+
+    The 4th column is the row's PROD_DATE only in a ``dated`` file (its
+    header names the column); otherwise extra columns are ignored.
+    """
+    if not parts or all((p or "").strip() == "" for p in parts):
+        return None
+    parts = [(p or "").strip() for p in parts]
+    while len(parts) < 3:
+        parts.append("")
+    dm, gtin, name = parts[0], parts[1], parts[2]
+    if dm.strip().upper() == "DM" and (name.strip().upper() in ("NAME", "")):
+        return None
+    if not dm.strip():
+        return None
+    row = {"DM": dm, "GTIN": gtin, "NAME": name}
+    # необязательная 4-я колонка: своя дата производства у строки
+    if dated and len(parts) > 3 and parts[3]:
+        row["PROD_DATE"] = parts[3]
+    return row
+
+
+def iter_kontur_file(f: Iterable[str], dated: Optional[bool] = None) -> Iterator[Dict[str, str]]:
+    """Parse kontur rows from an already opened text stream.
+
+    ``dated=None`` — the stream starts at the top of the file, and its first
+    non-blank record tells whether the 4th column is PROD_DATE; a stream
+    opened in the middle of a file gets the flag from the caller.
+    """
+    rdr = csv.reader(f, delimiter="\t", quotechar='"')
+    for parts in rdr:
+        if dated is None and any((p or "").strip() for p in parts):
+            dated = bool(_header_dated(parts))
+        row = _kontur_row(parts, bool(dated))
+        if row is not None:
+            yield row
+
+
+def is_compressed(csv_path: str) -> bool:
+    return csv_path.lower().endswith(COMPRESSED_SUFFIXES)
+
+
+def is_workbook(csv_path: str) -> bool:
+    return csv_path.lower().endswith(WORKBOOK_SUFFIXES)
+
+
+def is_streamed(csv_path: str) -> bool:
+    """Archives and workbooks are read only as one stream: no byte offsets, no tail reads."""
+    return is_compressed(csv_path) or is_workbook(csv_path)
+
+
+def _zip_member(zf: zipfile.ZipFile) -> zipfile.ZipInfo:
+    files = [i for i in zf.infolist() if not i.is_dir()]
+    for info in files:
+        if info.filename.lower().endswith(KONTUR_SUFFIXES):
+            return info
+    if not files:
+        raise ValueError(f"В архиве нет файлов: {zf.filename}")
+    return files[0]
+
+
+def open_kontur_text(csv_path: str) -> TextIO:
+    """Open a kontur file as text; .gz and .zip are decoded on the fly, nothing is extracted to disk.
+
+    A workbook is not text and raises ValueError: read it with ``iter_kontur_raw``.
+    """
+    if is_workbook(csv_path):
+        raise ValueError(f"Книга Excel читается только построчно (iter_kontur_raw), не как текст: {csv_path}")
+    low = csv_path.lower()
+    if low.endswith(".gz"):
+        return gzip.open(csv_path, "rt", encoding="utf-8-sig", newline="")
+    if low.endswith(".zip"):
+        # ZipFile можно закрыть сразу: открытый член архива держит файл до своего закрытия
+        with zipfile.ZipFile(csv_path) as zf:
+            raw = zf.open(_zip_member(zf))
+        return io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+    return open(csv_path, "r", encoding="utf-8-sig", newline="")
+
+
+def _xlsx_cell(v: object) -> str:
+    if v is None:
+        return ""
+    if isinstance(v, float) and v.is_integer():
+        # GTIN, сохранённый в Excel числом
+        return str(int(v))
+    if isinstance(v, dt.date):
+        # PROD_DATE, сохранённая в Excel датой (datetime — тоже date)
+        return v.strftime("%d.%m.%Y")
+    return str(v)
+
+
+def iter_kontur_xlsx(xlsx_path: str) -> Iterator[Dict[str, str]]:
+    """Stream kontur rows (DM, GTIN, NAME and optional PROD_DATE columns) from the active sheet.
+
+    The workbook is opened read-only, so rows are produced from the sheet XML
+    as it is read and memory stays bounded for very long sheets.
+    """
+    if not load_workbook:
+        raise RuntimeError("Для чтения .xlsx нужен пакет openpyxl")
+    wb = load_workbook(xlsx_path, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        # размеры листа из самого файла бывают неверными — читаем до фактического конца
+        ws.reset_dimensions()
+        dated = None
+        for values in ws.iter_rows(max_col=4, values_only=True):
+            parts = [_xlsx_cell(v) for v in values]
+            if dated is None and any(p.strip() for p in parts):
+                dated = bool(_header_dated(parts))
+            row = _kontur_row(parts, bool(dated))
+            if row is not None:
+                yield row
+    finally:
+        wb.close()
+
+
+def iter_kontur_raw(csv_path: str) -> Iterator[Dict[str, str]]:
+    """Stream kontur rows one by one without keeping the file in memory."""
+    if is_workbook(csv_path):
+        yield from iter_kontur_xlsx(csv_path)
+        return
+    with open_kontur_text(csv_path) as f:
+        yield from iter_kontur_file(f)
+
+
+def kontur_dated(csv_path: str) -> bool:
+    """Whether the header of a text kontur file names its 4th column PROD_DATE."""
+    with open_kontur_text(csv_path) as f:
+        for parts in csv.reader(f, delimiter="\t", quotechar='"'):
+            if any((p or "").strip() for p in parts):
+                return bool(_header_dated(parts))
+    return False
+
+
 def load_kontur_raw(csv_path: str) -> List[Dict[str, str]]:
+    return list(iter_kontur_raw(csv_path))
+
+
+def count_kontur_rows(csv_path: str) -> int:
+    """Count data rows with the same skipping rules as load_kontur_raw."""
+    return sum(1 for _ in iter_kontur_raw(csv_path))
+
+
+def kontur_byte_ranges(csv_path: str, parts: int, size: Optional[int] = None) -> List[Tuple[int, int]]:
+    """Split a file (its first ``size`` bytes) into about ``parts`` byte ranges that start and end on line boundaries."""
+    size = os.path.getsize(csv_path) if size is None else size
+    if size == 0:
+        return []
+    step = max(1, size // max(1, parts))
+    bounds = [0]
+    with open(csv_path, "rb") as f:
+        pos = step
+        while pos < size:
+            f.seek(pos)
+            f.readline()
+            nxt = f.tell()
+            if nxt >= size:
+                break
+            if nxt > bounds[-1]:
+                bounds.append(nxt)
+            pos = max(nxt, bounds[-1]) + step
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _columns(rows: Iterable[Dict[str, str]]) -> KonturColumns:
+    dms: List[str] = []
+    gtins: List[str] = []
+    names: List[str] = []
+    dates: List[str] = []
+    for row in rows:
+        dms.append(row["DM"])
+        gtins.append(row["GTIN"])
+        names.append(row["NAME"])
+        dates.append(row.get("PROD_DATE", ""))
+    return dms, gtins, names, dates
+
+
+def _text_columns(text: str, dated: bool = False) -> KonturColumns:
+    """Columns of the kontur rows in a block of text.
+
+    Without quotes a record is just its line split on tabs, so the csv
+    module and the per-row dicts are skipped; the rules are those of
+    ``_kontur_row``. Lines are split on "\n" only: DM codes carry GS (\x1d),
+    which ``str.splitlines`` would treat as a line break.
+    """
+    if '"' in text:
+        return _columns(iter_kontur_file(io.StringIO(text, newline=""), dated))
+    dms: List[str] = []
+    gtins: List[str] = []
+    names: List[str] = []
+    dates: List[str] = []
+    for line in text.split("\n"):
+        parts = line.split("\t")
+        dm = parts[0].strip()
+        if not dm:
+            continue
+        n = len(parts)
+        name = parts[2].strip() if n > 2 else ""
+        if dm.upper() == "DM" and name.upper() in ("NAME", ""):
+            continue
+        dms.append(dm)
+        gtins.append(parts[1].strip() if n > 1 else "")
+        names.append(name)
+        dates.append(parts[3].strip() if dated and n > 3 else "")
+    return dms, gtins, names, dates
+
+
+def _parse_kontur_range(args: Tuple[str, int, int, bool]) -> KonturColumns:
+    """Process-pool worker: parse one byte range into (DM, GTIN, NAME, PROD_DATE) columns.
+
+    The last item says whether the file is ``dated`` (see ``kontur_dated``).
+    """
+    csv_path, start, end, dated = args
+    with open(csv_path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    text = data.decode("utf-8-sig" if start == 0 else "utf-8")
+    return _text_columns(text, dated)
+
+
+def iter_kontur_columns(csv_path: str, workers: Optional[int] = None,
+                        size: Optional[int] = None) -> Iterator[KonturColumns]:
+    """Parse a kontur file in a process pool, yielding column chunks in file order.
+
+    Ranges are split on line boundaries, so records must not span lines
+    (kontur exports never quote multi-line fields). Small files are parsed
+    in-process. ``size`` stops the parse at that many bytes of a growing
+    file. Archives and workbooks cannot be split by bytes and are read as one
+    stream, to the end.
+    """
+    if is_streamed(csv_path):
+        for chunk in iter_chunks(iter_kontur_raw(csv_path), STREAM_CHUNK_ROWS):
+            yield _columns(chunk)
+        return
+    workers = workers or os.cpu_count() or 1
+    # заголовок есть только в первом диапазоне — смысл 4-й колонки определяется заранее
+    dated = kontur_dated(csv_path)
+    size = os.path.getsize(csv_path) if size is None else size
+    if workers <= 1 or size < PARALLEL_MIN_BYTES:
+        for s, e in kontur_byte_ranges(csv_path, 1, size):
+            yield _parse_kontur_range((csv_path, s, e, dated))
+        return
+    ranges = kontur_byte_ranges(csv_path, workers * 4, size)
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        yield from ex.map(_parse_kontur_range, [(csv_path, s, e, dated) for s, e in ranges])
+
+
+def load_kontur_parallel(csv_path: str, workers: Optional[int] = None) -> List[Dict[str, str]]:
+    """Same result as load_kontur_raw, parsed by several processes."""
     rows: List[Dict[str, str]] = []
-    with open(csv_path, "r", encoding="utf-8-sig", newline="") as f:
-        rdr = csv.reader(f, delimiter="\t", quotechar='"')
-        for parts in rdr:
-            if not parts or all((p or "").strip() == "" for p in parts):
-                continue
-            parts = [(p or "").strip() for p in parts]
-            while len(parts) < 3:
-                parts.append("")
-            dm, gtin, name = parts[0], parts[1], parts[2]
-            if dm.strip().upper() == "DM" and (name.strip().upper() in ("NAME", "")):
-                continue
-            if not dm.strip():
-                continue
-            rows.append({"DM": dm, "GTIN": gtin, "NAME": name})
+    for dms, gtins, names, dates in iter_kontur_columns(csv_path, workers):
+        for d, g, n, p in zip(dms, gtins, names, dates):
+            row = {"DM": d, "GTIN": g, "NAME": n}
+            if p:
+                row["PROD_DATE"] = p
+            rows.append(row)
     return rows
 
 
+def kontur_head_hash(csv_path: str, nbytes: int = 4096) -> str:
+    """Hash of the first bytes of a file, used to notice that it was rewritten."""
+    with open(csv_path, "rb") as f:
+        return hashlib.blake2b(f.read(nbytes), digest_size=16).hexdigest()
+
+
+def read_kontur_tail(csv_path: str, offset: int, dated: bool = False) -> Tuple[List[Dict[str, str]], int]:
+    """Parse complete lines appended after ``offset``; returns (rows, new offset).
+
+    A trailing line without a newline is left for the next call, since the
+    writer may still be in the middle of it. ``dated`` is the file's
+    ``kontur_dated`` flag, taken when it was opened.
+    """
+    with open(csv_path, "rb") as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b"\n") + 1
+    if end <= 0:
+        return [], offset
+    text = data[:end].decode("utf-8-sig" if offset == 0 else "utf-8")
+    return list(iter_kontur_file(io.StringIO(text, newline=""), dated if offset else None)), offset + end
+
+
+def iter_chunks(rows: Iterable[T], size: int) -> Iterator[List[T]]:
+    """Split an iterable into lists of at most ``size`` items, lazily."""
+    it = iter(rows)
+    size = max(1, int(size))
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 def _norm(s: str) -> str:
     return re.sub(r"\s+", "", (s or "").strip().lower())
 
@@ -130,14 +440,22 @@ def _parse_shelf_life(text: str) -> Dict[str, Optional[int]]:
 
 
 def read_product_map(xlsx_path: str) -> Dict[str, Dict[str, object]]:
-    """Load product map with GTIN metadata."""
+    """Load product map with GTIN metadata.
+
+    The workbook is streamed in read-only, values-only mode and only the
+    columns the map needs are pulled from each row.
+    """
     mapping: Dict[str, Dict[str, object]] = {}
     if not xlsx_path or not os.path.isfile(xlsx_path) or not load_workbook:
         return mapping
+    wb = None
     try:
-        wb = load_workbook(xlsx_path, data_only=True)
+        wb = load_workbook(xlsx_path, read_only=True, data_only=True)
         ws = wb.active
-        hdrs = [str(c.value or "").strip() for c in ws[1]]
+        # размеры листа из самого файла бывают неверными — читаем до фактического конца
+        ws.reset_dimensions()
+        header = next(ws.iter_rows(min_row=1, max_row=1, values_only=True), ())
+        hdrs = [str(v or "").strip() for v in header]
         col = {h: i + 1 for i, h in enumerate(hdrs)}
 
         idx_gtin = col.get("GTIN") or col.get("ГТИН") or col.get("gtin")
@@ -148,13 +466,14 @@ def read_product_map(xlsx_path: str) -> Dict[str, Dict[str, object]]:
                      or col.get("Short Name") or col.get("SHORT NAME") or col.get("Короткое имя") or col.get("КОРОТКОЕ ИМЯ"))
 
         def cell(row, j: int | None) -> str:
-            if not j:
+            if not j or j > len(row):
                 return ""
-            v = row[j - 1].value
+            v = row[j - 1]
             return "" if v is None else str(v).strip()
 
         has_short = bool(idx_short)
-        for row in ws.iter_rows(min_row=2):
+        max_col = max((j for j in (idx_gtin, idx_pack, idx_shelf, idx_part, idx_short) if j), default=1)
+        for row in ws.iter_rows(min_row=2, max_col=max_col, values_only=True):
             g = only_digits(cell(row, idx_gtin))
             if not g:
                 continue
@@ -173,12 +492,19 @@ def read_product_map(xlsx_path: str) -> Dict[str, Dict[str, object]]:
         return mapping
     except Exception:
         return {}
+    finally:
+        if wb is not None:
+            # read-only книга держит файл открытым до close()
+            try:
+                wb.close()
+            except Exception:
+                pass
 
 
 def choose_format_for(gtin: str, product_map: Dict[str, Dict[str, object]], manual_choice: str) -> str:
     if manual_choice in ("16x16", "30x20"):
         return manual_choice
-    info = product_map.get(only_digits(gtin), {})
+    info = lookup_product(product_map, gtin)
     fmt = (info.get("FORMAT") or "") if info else ""
     return fmt if fmt in ("16x16", "30x20") else "16x16"
 
@@ -190,45 +516,130 @@ def make_part_num(prod_date: dt.date | None, part_template: str | None) -> str:
     return yymmdd
 
 
-def enrich_row(base_row: Dict[str, str], idx1: int, prod_date: dt.date, exp_days_override: Optional[int],
-               product_map: Dict[str, Dict[str, object]], mode_choice: str) -> Dict[str, str]:
-    dm, gtin, name = base_row.get("DM", ""), base_row.get("GTIN", ""), base_row.get("NAME", "")
-    fmt = choose_format_for(gtin, product_map, mode_choice)
-    info = product_map.get(only_digits(gtin), {})
-    pd = prod_date or dt.date.today()
+@lru_cache(maxsize=4096)
+def parse_row_date(s: str) -> dt.date:
+    """Per-row PROD_DATE (ДД.ММ.ГГГГ or ГГГГ-ММ-ДД); a file usually has only a few distinct values."""
+    s = s.strip()
+    for fmt in ("%d.%m.%Y", "%Y-%m-%d", "%Y-%m-%d %H:%M:%S"):
+        try:
+            return dt.datetime.strptime(s, fmt).date()
+        except ValueError:
+            pass
+    raise ValueError(f"Неверная дата производства в строке: '{s}', нужен ДД.ММ.ГГГГ")
 
+
+@lru_cache(maxsize=65536)
+def _dated_fields(pd: dt.date, years, months, weeks, days, exp_days_override: Optional[int],
+                  part_template: str) -> Tuple[str, str, str, str]:
+    """(PROD_DATE, EXP_DATE, PART_NUM, shelf log) for one production date and product.
+
+    Memoized: rows of the same product and date share the date arithmetic and strftime work.
+    """
     exp_date = None
-    shelf_info = info.get("SHELF") or {}
     log_shelf = ""
-    if shelf_info:
-        if shelf_info.get('years'):
-            exp_date = add_years(pd, int(shelf_info['years']))
-            log_shelf = f"years={shelf_info['years']}"
-        elif shelf_info.get('months'):
-            exp_date = add_months(pd, int(shelf_info['months']))
-            log_shelf = f"months={shelf_info['months']}"
-        elif shelf_info.get('weeks'):
-            exp_date = add_days(pd, int(shelf_info['weeks']) * 7)
-            log_shelf = f"weeks={shelf_info['weeks']}"
-        elif shelf_info.get('days'):
-            exp_date = add_days(pd, int(shelf_info['days']))
-            log_shelf = f"days={shelf_info['days']}"
+    if years:
+        exp_date = add_years(pd, int(years))
+        log_shelf = f"years={years}"
+    elif months:
+        exp_date = add_months(pd, int(months))
+        log_shelf = f"months={months}"
+    elif weeks:
+        exp_date = add_days(pd, int(weeks) * 7)
+        log_shelf = f"weeks={weeks}"
+    elif days:
+        exp_date = add_days(pd, int(days))
+        log_shelf = f"days={days}"
     if (exp_date is None) and (exp_days_override is not None):
         exp_date = add_days(pd, int(exp_days_override))
         log_shelf = f"override_days={exp_days_override}"
+    return (pd.strftime("%d.%m.%Y"), exp_date.strftime("%d.%m.%Y") if exp_date else "",
+            make_part_num(pd, part_template), log_shelf)
 
-    part_num = make_part_num(pd, info.get("PART_TEMPLATE") or "")
+
+def enrich_row(base_row: Dict[str, str], idx1: int, prod_date: Optional[dt.date], exp_days_override: Optional[int],
+               product_map: Dict[str, Dict[str, object]], mode_choice: str) -> Dict[str, str]:
+    """Build the label fields of one row; a PROD_DATE in the row overrides ``prod_date``."""
+    dm, gtin, name = base_row.get("DM", ""), base_row.get("GTIN", ""), base_row.get("NAME", "")
+    fmt = choose_format_for(gtin, product_map, mode_choice)
+    info = lookup_product(product_map, gtin)
+    row_date = base_row.get("PROD_DATE")
+    pd = parse_row_date(row_date) if row_date else (prod_date or dt.date.today())
+
+    shelf_info = info.get("SHELF") or {}
+    prod_s, exp_s, part_num, log_shelf = _dated_fields(
+        pd, shelf_info.get('years'), shelf_info.get('months'), shelf_info.get('weeks'), shelf_info.get('days'),
+        exp_days_override, info.get("PART_TEMPLATE") or "")
     short_excel = (info.get("SHORTNAME") or "").strip()
 
     return {
         "DM": dm, "GTIN": gtin, "NAME": name,
         "ShortGTIN": short_gtin(gtin),
         "ShortName": short_excel if short_excel else name,
-        "PROD_DATE": pd.strftime("%d.%m.%Y") if pd else "",
+        "PROD_DATE": prod_s,
         "NUM": str(idx1),
-        "EXP_DATE": exp_date.strftime("%d.%m.%Y") if exp_date else "",
+        "EXP_DATE": exp_s,
         "PART_NUM": part_num,
         "_FORMAT": fmt,
         "_SHELF_LOG": log_shelf,
         "_SHORT_SRC": "Excel" if short_excel else "NAME"
     }
+
+
+def row_invariants(gtin: str, row_date: Optional[str], default_pd: dt.date, exp_days_override: Optional[int],
+                   product_map: Dict[str, Dict[str, object]], mode_choice: str) -> Optional[tuple]:
+    """Fields shared by all rows of one GTIN and production date, None if ``row_date`` is invalid.
+
+    (_FORMAT, ShortGTIN, ShortName from Excel, PROD_DATE, EXP_DATE, PART_NUM, shelf log)
+    """
+    try:
+        pd = parse_row_date(row_date) if row_date else default_pd
+    except ValueError:
+        return None
+    info = lookup_product(product_map, gtin)
+    shelf_info = info.get("SHELF") or {}
+    return (choose_format_for(gtin, product_map, mode_choice), short_gtin(gtin),
+            (info.get("SHORTNAME") or "").strip()) + _dated_fields(
+        pd, shelf_info.get('years'), shelf_info.get('months'), shelf_info.get('weeks'),
+        shelf_info.get('days'), exp_days_override, info.get("PART_TEMPLATE") or "")
+
+
+def enrich_rows(rows: Iterable[Dict[str, str]], nums: Iterable[int], prod_date: Optional[dt.date],
+                exp_days_override: Optional[int], product_map: Dict[str, Dict[str, object]],
+                mode_choice: str) -> List[Optional[Dict[str, str]]]:
+    """Batch form of ``enrich_row``: one result per row, numbered by ``nums``.
+
+    Everything that depends only on GTIN and production date (format, product
+    map lookup, shelf life, PART_NUM, ShortGTIN, date strings) is computed once
+    per distinct pair; only DM, NAME and NUM are taken per row. A row whose own
+    PROD_DATE cannot be parsed gives None instead of raising.
+    """
+    default_pd = prod_date or dt.date.today()
+    per_gtin: Dict[Tuple[str, Optional[str]], Optional[tuple]] = {}
+    out: List[Optional[Dict[str, str]]] = []
+    for row, idx1 in zip(rows, nums):
+        gtin = row.get("GTIN", "")
+        row_date = row.get("PROD_DATE")
+        key = (gtin, row_date)
+        if key in per_gtin:
+            inv = per_gtin[key]
+        else:
+            inv = per_gtin[key] = row_invariants(gtin, row_date, default_pd, exp_days_override,
+                                                 product_map, mode_choice)
+        if inv is None:
+            out.append(None)
+            continue
+        fmt, sg, short_excel, prod_s, exp_s, part_num, log_shelf = inv
+        name = row.get("NAME", "")
+        out.append({
+            "DM": row.get("DM", ""), "GTIN": gtin, "NAME": name,
+            "ShortGTIN": sg,
+            "ShortName": short_excel if short_excel else name,
+            "PROD_DATE": prod_s,
+            "NUM": str(idx1),
+            "EXP_DATE": exp_s,
+            "PART_NUM": part_num,
+            "_FORMAT": fmt,
+            "_SHELF_LOG": log_shelf,
+            "_SHORT_SRC": "Excel" if short_excel else "NAME"
+        })
+    return out
@@ -0,0 +1,84 @@
+"""Enrichment of large row ranges in a pool of worker processes.
+
+The job's ``EnrichContext`` (product map included) is sent to every worker
+once, at pool start; after that only the raw rows and their numbers cross
+the process boundary. Results are handed back in submission order.
+"""
+from __future__ import annotations
+
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .data_io import enrich_rows
+from .models import EnrichContext
+
+# строки куска и их номера в файле
+Chunk = Tuple[List[Dict[str, str]], List[int]]
+
+# контекст задания внутри процесса-исполнителя (задаётся инициализатором пула)
+_CTX: Optional[EnrichContext] = None
+
+
+def enrich_chunk(ctx: EnrichContext, rows: List[Dict[str, str]], nums: List[int]) -> List[Optional[dict]]:
+    """``enrich_rows`` with the job context applied; None marks a row that cannot be labelled."""
+    out = enrich_rows(rows, nums, ctx.prod_date, ctx.exp_days, ctx.product_map, ctx.mode_choice)
+    for i, (base, enr) in enumerate(zip(rows, out)):
+        if enr is None:
+            continue
+        if not ctx.prod_date and not base.get("PROD_DATE"):
+            # общей даты нет, а своей у строки тоже нет
+            out[i] = None
+            continue
+        # ручная партия имеет приоритет (если авто-галка снята)
+        if ctx.manual_part is not None:
+            enr["PART_NUM"] = ctx.manual_part
+    return out
+
+
+def _init_worker(ctx: EnrichContext) -> None:
+    global _CTX
+    _CTX = ctx
+
+
+def _worker_chunk(chunk: Chunk) -> List[Optional[dict]]:
+    rows, nums = chunk
+    return enrich_chunk(_CTX, rows, nums)
+
+
+def default_workers() -> int:
+    # одно ядро остаётся окну и BarTender
+    return max(1, (os.cpu_count() or 2) - 1)
+
+
+class EnrichPool:
+    """Process pool bound to one job context."""
+
+    def __init__(self, ctx: EnrichContext, workers: Optional[int] = None) -> None:
+        self.workers = workers or default_workers()
+        self._ex = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=(ctx,))
+
+    def submit_all(self, chunks: Iterable[Chunk], ahead: Optional[int] = None) -> Iterator[Tuple[Chunk, Future]]:
+        """``(chunk, future)`` pairs, in order; at most ``ahead`` chunks are in flight at a time.
+
+        ``chunks`` is consumed lazily, so a long selection is never held in
+        memory as a whole.
+        """
+        ahead = max(1, ahead or self.workers * 2)
+        pending: Deque[Tuple[Chunk, Future]] = deque()
+        for chunk in chunks:
+            pending.append((chunk, self._ex.submit(_worker_chunk, chunk)))
+            if len(pending) >= ahead:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+
+    def close(self, cancel: bool = False) -> None:
+        self._ex.shutdown(wait=not cancel, cancel_futures=cancel)
+
+    def __enter__(self) -> "EnrichPool":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close(cancel=exc_type is not None)
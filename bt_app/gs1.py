@@ -0,0 +1,191 @@
+"""GS1 element-string parsing and pre-flight validation of DM codes."""
+from __future__ import annotations
+
+import re
+from array import array
+from collections import Counter
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple
+
+GS = "\x1d"
+
+# AI -> (фиксированная длина | None, максимальная длина значения)
+AI_TABLE: Dict[str, Tuple[Optional[int], int]] = {
+    "01": (14, 14),    # GTIN
+    "17": (6, 6),      # срок годности YYMMDD
+    "3103": (6, 6),    # масса нетто, кг
+    "8005": (6, 6),    # цена
+    "21": (None, 20),  # серийный номер
+    "91": (None, 90),  # ключ проверки
+    "92": (None, 90),  # код проверки
+    "93": (None, 90),  # код проверки (короткий)
+}
+
+# причины отказа (для сводки)
+ERR_EMPTY = "пустой DM"
+ERR_STRUCTURE = "неверная структура GS1"
+ERR_NO_GTIN = "нет (01) в начале"
+ERR_CHECK_DIGIT = "неверная контрольная цифра GTIN"
+ERR_GTIN_MISMATCH = "GTIN в DM не совпадает с колонкой GTIN"
+
+_BRACKETED_AI = re.compile(r"\((\d{2,4})\)")
+_NON_DIGITS = re.compile(r"\D+")
+
+
+class Gs1Code(NamedTuple):
+    gtin: str
+    serial: str
+    elements: Dict[str, str]
+
+
+@dataclass
+class Gs1Report:
+    """Result of validating the DM column of a file.
+
+    Positions are 0-based indexes into the checked sequence.
+    """
+    total: int = 0
+    malformed: array = field(default_factory=lambda: array("I"))
+    mismatched: array = field(default_factory=lambda: array("I"))
+    reasons: Counter = field(default_factory=Counter)
+
+    @property
+    def ok(self) -> bool:
+        return not self.malformed and not self.mismatched
+
+
+@lru_cache(maxsize=1)
+def _parser() -> "re.Pattern[str]":
+    """One compiled pattern for the whole element string: (01) first, then (21), then the rest.
+
+    Variable-length values run up to GS or the end of the code; a GS after a
+    fixed-length value is not needed but tolerated.
+    """
+    def element(ai: str) -> str:
+        fixed, max_len = AI_TABLE[ai]
+        if fixed:
+            return f"{ai}\\d{{{fixed}}}{GS}?"
+        return f"{ai}[^{GS}]{{1,{max_len}}}(?:{GS}|$)"
+
+    fixed_ais = [ai for ai, (fixed, _) in AI_TABLE.items() if fixed and ai != "01"]
+    any_ai = "|".join(element(ai) for ai in AI_TABLE if ai not in ("01", "21"))
+    return re.compile(
+        f"{GS}?01(?P<gtin>\\d{{14}}){GS}?"
+        f"(?:{'|'.join(element(ai) for ai in fixed_ais)})*"
+        f"21(?P<serial>[^{GS}]{{1,{AI_TABLE['21'][1]}}})(?:{GS}|$)"
+        f"(?P<rest>(?:{any_ai})*)"
+    )
+
+
+def normalize_dm(dm: str) -> str:
+    """Bring a human-readable "(01)...(21)..." code to the raw GS-separated form."""
+    if dm.startswith("("):
+        dm = _BRACKETED_AI.sub(lambda m: GS + m.group(1), dm).lstrip(GS)
+    return dm
+
+
+def gtin_check_digit_ok(gtin: str) -> bool:
+    digits = [ord(c) - 48 for c in gtin]
+    total = sum(d * (3 if i % 2 == 0 else 1) for i, d in enumerate(reversed(digits[:-1])))
+    return (10 - total % 10) % 10 == digits[-1]
+
+
+def _split_elements(rest: str) -> Dict[str, str]:
+    out: Dict[str, str] = {}
+    pos = 0
+    while pos < len(rest):
+        if rest.startswith(GS, pos):
+            pos += 1
+            continue
+        for ai, (fixed, _) in AI_TABLE.items():
+            if rest.startswith(ai, pos):
+                start = pos + len(ai)
+                if fixed:
+                    pos = start + fixed
+                else:
+                    end = rest.find(GS, start)
+                    pos = len(rest) if end < 0 else end
+                out[ai] = rest[start:pos]
+                break
+        else:
+            break
+    return out
+
+
+def validate_dm(dm: str, gtin_column: str = "") -> Optional[str]:
+    """Return the rejection reason for a DM code, or None if it is fine."""
+    dm = normalize_dm(dm or "")
+    if not dm:
+        return ERR_EMPTY
+    m = _parser().match(dm)
+    if m is None or m.end() != len(dm):
+        return ERR_STRUCTURE if dm.lstrip(GS).startswith("01") else ERR_NO_GTIN
+    gtin = m.group("gtin")
+    if not gtin_check_digit_ok(gtin):
+        return ERR_CHECK_DIGIT
+    col = _NON_DIGITS.sub("", gtin_column or "")
+    if col and col.zfill(14) != gtin:
+        return ERR_GTIN_MISMATCH
+    return None
+
+
+def parse_dm(dm: str) -> Optional[Gs1Code]:
+    """Parse a DM code into GTIN, serial and the other elements; None if malformed."""
+    dm = normalize_dm(dm or "")
+    m = _parser().match(dm)
+    if m is None or m.end() != len(dm):
+        return None
+    elements = {"01": m.group("gtin"), "21": m.group("serial")}
+    elements.update(_split_elements(dm[m.end("gtin"):m.start("serial") - 2]))
+    elements.update(_split_elements(m.group("rest")))
+    return Gs1Code(m.group("gtin"), m.group("serial"), elements)
+
+
+def check_rows(rows: Iterable[Dict[str, str]]) -> Gs1Report:
+    """Validate the DM column of raw rows in one pass."""
+    return _check(((row.get("DM", ""), row.get("GTIN", "")) for row in rows), Gs1Report(), 0)
+
+
+def check_columns(dms: Iterable[str], gtins: Iterable[str], rep: Optional[Gs1Report] = None,
+                  start: int = 0) -> Gs1Report:
+    """``check_rows`` over parallel DM and GTIN columns.
+
+    Adds to ``rep`` when given, with positions offset by ``start``, so a file
+    can be checked chunk by chunk.
+    """
+    return _check(zip(dms, gtins), rep if rep is not None else Gs1Report(), start)
+
+
+def _check(pairs: Iterable[Tuple[str, str]], rep: Gs1Report, start: int) -> Gs1Report:
+    match = _parser().match
+    check_ok: Dict[str, bool] = {}
+    col_norm: Dict[str, str] = {}
+    n = 0
+    for pos, (dm, raw_col) in enumerate(pairs, start):
+        n += 1
+        if dm.startswith("("):
+            dm = normalize_dm(dm)
+        m = match(dm) if dm else None
+        if m is None or m.end() != len(dm):
+            rep.malformed.append(pos)
+            rep.reasons[ERR_EMPTY if not dm else
+                        ERR_STRUCTURE if dm.lstrip(GS).startswith("01") else ERR_NO_GTIN] += 1
+            continue
+        gtin = m.group("gtin")
+        ok = check_ok.get(gtin)
+        if ok is None:
+            ok = check_ok[gtin] = gtin_check_digit_ok(gtin)
+        if not ok:
+            rep.malformed.append(pos)
+            rep.reasons[ERR_CHECK_DIGIT] += 1
+            continue
+        col = col_norm.get(raw_col)
+        if col is None:
+            col = _NON_DIGITS.sub("", raw_col)
+            col = col_norm[raw_col] = col.zfill(14) if col else ""
+        if col and col != gtin:
+            rep.mismatched.append(pos)
+            rep.reasons[ERR_GTIN_MISMATCH] += 1
+    rep.total += n
+    return rep
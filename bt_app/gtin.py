@@ -0,0 +1,98 @@
+"""Catalog lookups by GTIN, tolerant to GTIN-8/12/13/14 spellings of one code.
+
+Kontur files carry 14-digit GTINs while the catalog is often keyed by the
+13-digit EAN, or lost its leading zeros in Excel. ``GtinIndex`` maps every
+catalog key to its GTIN-14 form once, when the catalog is loaded; a row's
+GTIN is normalized the same way at lookup, so both spellings meet. An exact
+key still wins, so a catalog that already matches the files behaves as
+before, and a code with a wrong check digit is only ever matched exactly.
+"""
+from __future__ import annotations
+
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, List
+
+from .gs1 import gtin_check_digit_ok
+
+# короче — это уже не GTIN (GTIN-8 — самый короткий)
+_MIN_LEN = 8
+# сколько разных GTIN помнит кэш поиска одного справочника
+LOOKUP_CACHE = 4096
+# справочников с построенным индексом (текущий и, при перечитывании, предыдущий)
+_MAX_INDEXES = 4
+
+_NON_DIGITS = re.compile(r"\D+")
+_EMPTY: Dict[str, object] = {}
+
+
+def gtin14(digits: str) -> str:
+    """GTIN-14 form of a GTIN-8/12/13/14 digit string; "" when it cannot be a GTIN."""
+    return digits.zfill(14) if _MIN_LEN <= len(digits) <= 14 else ""
+
+
+def valid_gtin14(digits: str) -> str:
+    """``gtin14`` of the digits when its check digit is right, else ""."""
+    g = gtin14(digits)
+    return g if g and gtin_check_digit_ok(g) else ""
+
+
+class GtinIndex:
+    """Normalized keys of one product map and a cached lookup over them."""
+
+    def __init__(self, product_map: Dict[str, Dict[str, object]]) -> None:
+        self.product_map = product_map
+        self._by_gtin14: Dict[str, str] = {}
+        # ключи справочника с неверной контрольной цифрой — находятся только точным совпадением
+        self.invalid: List[str] = []
+        for key in product_map:
+            if key.startswith("_"):
+                continue
+            g = gtin14(key)
+            if not g:
+                continue
+            if not gtin_check_digit_ok(g):
+                self.invalid.append(key)
+                continue
+            # при нескольких написаниях одного кода побеждает первое
+            self._by_gtin14.setdefault(g, key)
+        self.get = lru_cache(maxsize=LOOKUP_CACHE)(self._get)
+
+    def _get(self, gtin: str) -> Dict[str, object]:
+        digits = _NON_DIGITS.sub("", gtin or "")
+        info = self.product_map.get(digits)
+        if info is not None:
+            return info
+        key = self._by_gtin14.get(valid_gtin14(digits))
+        return self.product_map[key] if key is not None else _EMPTY
+
+
+_INDEXES: "OrderedDict[int, GtinIndex]" = OrderedDict()
+# поиск идёт и из GUI, и из потока подготовки пакетов
+_LOCK = threading.Lock()
+
+
+def gtin_index(product_map: Dict[str, Dict[str, object]]) -> GtinIndex:
+    """The index of a product map, built on first use.
+
+    Product maps are replaced, never edited in place, so the index is kept
+    per map object; the index holds the map, so its id cannot be reused
+    while it is cached.
+    """
+    with _LOCK:
+        idx = _INDEXES.get(id(product_map))
+        if idx is None or idx.product_map is not product_map:
+            idx = GtinIndex(product_map)
+            _INDEXES[id(product_map)] = idx
+            while len(_INDEXES) > _MAX_INDEXES:
+                _INDEXES.popitem(last=False)
+        else:
+            _INDEXES.move_to_end(id(product_map))
+        return idx
+
+
+def lookup_product(product_map: Dict[str, Dict[str, object]], gtin: str) -> Dict[str, object]:
+    """Catalog entry for a row's GTIN in any spelling; an empty dict when there is none."""
+    return gtin_index(product_map).get(gtin)
@@ -7,7 +7,8 @@ BarTender GUI V0.3.3 FIX3k2
 - ShortName берётся только из Excel (столбец ShortName / SHORTNAME / Короткое имя)
 """
 
-import os, csv, re, time, json, atexit, traceback, datetime as dt
+import os, csv, re, time, json, queue, atexit, traceback, datetime as dt
+from itertools import islice
 import time
 import threading
 import customtkinter as ctk
@@ -128,23 +129,26 @@ def add_years(date_, years:int):
 
 # ------------------------ CSV (Контур сырой) ------------------------
 
-def load_kontur_raw(csv_path: str):
-    rows = []
-    with open(csv_path, "r", encoding="utf-8-sig", newline="") as f:
-        rdr = csv.reader(f, delimiter="\t", quotechar='"')
-        for parts in rdr:
-            if not parts or all((p or "").strip()=="" for p in parts): 
-                continue
-            parts = [(p or "").strip() for p in parts]
-            while len(parts)<3: 
-                parts.append("")
-            dm, gtin, name = parts[0], parts[1], parts[2]
-            if dm.strip().upper()=="DM" and (name.strip().upper() in ("NAME","")):
-                continue
-            if not dm.strip(): 
-                continue
-            rows.append({"DM": dm, "GTIN": gtin, "NAME": name})
-    return rows
+from bt_app.data_io import (enrich_row, enrich_rows, is_streamed, iter_chunks, iter_kontur_columns,
+                            iter_kontur_raw, kontur_dated, kontur_head_hash, load_kontur_raw, read_kontur_tail,
+                            choose_format_for, read_product_map)
+from bt_app.gtin import gtin_index, lookup_product
+from bt_app.row_index import KonturRowIndex
+from bt_app.row_store import KonturRowStore
+from bt_app.models import EnrichContext
+from bt_app.kontur_cache import KonturCache, kontur_cache_key
+from bt_app.product_cache import load_product_map_cached
+from bt_app.session import clear_session, load_session, save_session, session_path
+from bt_app.kontur_merge import write_kontur_merged
+from bt_app.row_select import RowSelection, parse_selection
+from bt_app.enrich_np import HAVE_NUMPY, enrich_columns
+from bt_app.enrich_pool import EnrichPool, default_workers, enrich_chunk
+from bt_app.pipeline import (Prefetcher, calibration_rows, discard_staged, prepare_column_batch,
+                             prepare_row_batch)
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
+from bt_app.ledger import PrintedLedger
+from bt_app.csv_scan import scan_kontur, selection_ledger_report
+from bt_app.com_bartender import print_succeeded
 
 # ------------------------ Excel-справочник ------------------------
 
@@ -172,101 +176,12 @@ def _parse_shelf_life(text: str):
     res['months'] = n; 
     return res
 
-def read_product_map(xlsx_path: str):
-    """Читает: GTIN, Упаковка, Срок годности, Шаблон партии, ShortName."""
-    mapping={}
-    if not xlsx_path or not os.path.isfile(xlsx_path) or not load_workbook: 
-        return mapping
-    try:
-        wb=load_workbook(xlsx_path, data_only=True); ws=wb.active
-        hdrs=[str(c.value or "").strip() for c in ws[1]]
-        col={h:i+1 for i,h in enumerate(hdrs)}
-
-        idx_gtin = col.get("GTIN") or col.get("ГТИН") or col.get("gtin")
-        idx_pack = col.get("Упаковка") or col.get("УПАКОВКА")
-        idx_shelf= col.get("Срок годности") or col.get("СРОК ГОДНОСТИ")
-        idx_part = col.get("Шаблон партии") or col.get("ШАБЛОН ПАРТИИ") or col.get("Партия") or col.get("ПАРТИЯ")
-        idx_short = (col.get("ShortName") or col.get("SHORTNAME") or col.get("Shortname") or col.get("shortname")
-                     or col.get("Short Name") or col.get("SHORT NAME") or col.get("Короткое имя") or col.get("КОРОТКОЕ ИМЯ"))
-
-        def cell(row, j):
-            if not j: return ""
-            v=row[j-1].value
-            return "" if v is None else str(v).strip()
-
-        has_short = bool(idx_short)
-        for row in ws.iter_rows(min_row=2):
-            g=only_digits(cell(row, idx_gtin))
-            if not g: 
-                continue
-            pack=_norm(cell(row, idx_pack))
-            shelf=cell(row, idx_shelf)
-            fmt=""
-            if "ведро" in pack: 
-                fmt="30x20"
-            elif any(w in pack for w in ("банка","туба")): 
-                fmt="16x16"
-            shelf_parsed=_parse_shelf_life(shelf)
-            part_tpl=cell(row, idx_part)
-            short_from_xlsx = cell(row, idx_short)
-            mapping[g]={"FORMAT":fmt, "SHELF":shelf_parsed, "PART_TEMPLATE":part_tpl, "SHORTNAME": short_from_xlsx}
-        mapping["_HAS_SHORT_COL"] = has_short
-        return mapping
-    except Exception:
-        return {}
-
-def choose_format_for(gtin, product_map, manual_choice):
-    if manual_choice in ("16x16","30x20"): 
-        return manual_choice
-    info = product_map.get(only_digits(gtin), {})
-    fmt = (info.get("FORMAT") or "") if info else ""
-    return fmt if fmt in ("16x16","30x20") else "16x16"
-
 def make_part_num(prod_date, part_template: str|None):
     yymmdd = prod_date.strftime("%y%m%d") if prod_date else ""
     if part_template: 
         return part_template.replace("{DATE}", yymmdd)
     return yymmdd
 
-def enrich_row(base_row, idx1, prod_date, exp_days_override, product_map, mode_choice):
-    dm,gtin,name = base_row.get("DM",""), base_row.get("GTIN",""), base_row.get("NAME","")
-    fmt = choose_format_for(gtin, product_map, mode_choice)
-    info = product_map.get(only_digits(gtin), {})
-    pd = prod_date or dt.date.today()
-
-    # срок годности
-    exp_date = None
-    shelf_info = info.get("SHELF") or {}
-    log_shelf = ""
-    if shelf_info:
-        if shelf_info.get('years'):
-            exp_date = add_years(pd, int(shelf_info['years'])); log_shelf = f"years={shelf_info['years']}"
-        elif shelf_info.get('months'):
-            exp_date = add_months(pd, int(shelf_info['months'])); log_shelf = f"months={shelf_info['months']}"
-        elif shelf_info.get('weeks'):
-            exp_date = add_days(pd, int(shelf_info['weeks'])*7); log_shelf = f"weeks={shelf_info['weeks']}"
-        elif shelf_info.get('days'):
-            exp_date = add_days(pd, int(shelf_info['days'])); log_shelf = f"days={shelf_info['days']}"
-    if (exp_date is None) and (exp_days_override is not None):
-        exp_date = add_days(pd, int(exp_days_override)); log_shelf = f"override_days={exp_days_override}"
-
-    part_num = make_part_num(pd, info.get("PART_TEMPLATE") or "")
-    short_excel = (info.get("SHORTNAME") or "").strip()
-
-    enr = {
-        "DM": dm, "GTIN": gtin, "NAME": name,
-        "ShortGTIN": short_gtin(gtin),
-        "ShortName": short_excel if short_excel else name,
-        "PROD_DATE": pd.strftime("%d.%m.%Y") if pd else "",
-        "NUM": str(idx1),
-        "EXP_DATE": exp_date.strftime("%d.%m.%Y") if exp_date else "",
-        "PART_NUM": part_num,
-        "_FORMAT": fmt,
-        "_SHELF_LOG": log_shelf,
-        "_SHORT_SRC": "Excel" if short_excel else "NAME"
-    }
-    return enr
-
 # ------------------------ COM-обёртка ------------------------
 
 
@@ -532,8 +447,33 @@ class App(ctk.CTk):
         self.is_paused = False
         self.csv_path = ""
         self.csv_rows = []
+        self.csv_total = 0
+        self.csv_index = None
+        self.csv_tail = None
+        # индексы DM → строка и GTIN → строки текущего файла (для «Отбора»); строятся в фоне
+        # одним проходом вместе с проверками по журналу и GS1
+        self.csv_lookup = None
+        # отчёт того же прохода по журналу для всего файла: по нему сверяется отбор задания
+        self.csv_ledger_report = None
+        self._scan_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="csv-scan")
+        self._scan_future = None
+        # индекс смещений большого файла строится на том же исполнителе, до прохода по нему
+        self._index_future = None
+        # журнал уже напечатанных DM (защита от повторной печати)
+        self.ledger = None
+        self.ledger_skip_printed = True
         self.preview_ctkimg = None
         self.product_map = {}
+        # справочник разбирается в фоне; пока future не готов, в product_map прежнее значение
+        self._pm_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="product-map")
+        self._pm_future = None
+        self._pm_path = ""
+        # (mtime, размер) файла, из которого взят текущий справочник, и загружаемого сейчас
+        self._pm_sig = None
+        self._pm_loading_sig = None
+        # последнее увиденное опросом изменение (перечитываем, когда оно держится два опроса)
+        self._pm_seen = None
+        self._pm_reload = False
 
         # состояние текущего пакета
         self.batch_info = None
@@ -547,10 +487,21 @@ class App(ctk.CTk):
 
         self._build_ui()
         self._start_bt()
+        self._open_ledger()
+        self._open_csv_cache()
         self._refresh_printers()
         self._load_presets()
-        self._auto_load_product_map()
-        self.after(200, self._prompt_csv_on_launch)
+        self.after(200, self._on_launch)
+
+    def _on_launch(self):
+        # после сбоя — предложить восстановить сессию целиком (без чтения xlsx и разбора CSV)
+        restored = self._offer_session_restore()
+        if not restored:
+            # справочник грузится в фоне — выбор CSV открывается сразу
+            self._auto_load_product_map()
+            self._prompt_csv_on_launch()
+        self._session_start()
+        self._watch_product_map()
 
     # индикатор прогресса
 
@@ -644,29 +595,290 @@ class App(ctk.CTk):
             return "next"
         return self.batch_action_var.get() or "next"
 
-    def _store_batch_state(self, bidx: int, total_batches: int, rows, enriched_rows, global_offset: int, copies: int, printer: str):
+    def _store_batch_state(self, bidx: int, total_batches: int, rows, enriched_rows, global_offset: int, copies: int, printer: str, nums=None):
         self.batch_info = {
+            "nums": list(nums) if nums else None,
             "index": bidx,
             "total": total_batches,
             "rows": list(rows),
             "enriched_rows": list(enriched_rows),
             "offset": global_offset,
-            "start_line": global_offset + 1,
-            "end_line": global_offset + len(rows),
+            "start_line": nums[0] if nums else global_offset + 1,
+            "end_line": nums[-1] if nums else global_offset + len(rows),
             "copies": copies,
             "printer": printer,
         }
 
-    def _prepare_enriched_rows(self, rows, global_offset: int):
-        enriched_rows = []
-        for i_pre, base_pre in enumerate(rows):
-            self._pause_wait()
+    # ---------- снимок сессии (восстановление после сбоя) ----------
+
+    def _session_signature(self):
+        b = self.batch_info or {}
+        return (self.csv_path, self._csv_total(), id(self.product_map), id(self.batch_info),
+                b.get("partial_start"), self.index_entry.get(), self.batch_entry.get())
+
+    def _session_state(self) -> dict:
+        return {
+            "saved_at": time.time(),
+            "csv_path": self.csv_path,
+            "csv_tail": dict(self.csv_tail) if self.csv_tail else None,
+            # индекс строк восстанавливается по своему .rowidx, хранилище — из буфера
+            "csv_store": self.csv_rows.to_bytes() if isinstance(self.csv_rows, KonturRowStore) else None,
+            "product_map_path": self.cfg.get("product_map_path", ""),
+            "product_map": self.product_map,
+            # (mtime, размер) файла, из которого взят справочник: по нему после восстановления
+            # видно, что xlsx правили, пока программа не работала
+            "product_map_sig": self._pm_sig,
+            "batch_info": dict(self.batch_info) if self.batch_info else None,
+            "index": self.index_entry.get(),
+            "batch_size": self.batch_entry.get(),
+        }
+
+    def _session_start(self):
+        self._session_sig = None
+        self._session_writer = None
+        self._session_error = None
+        if not self.cfg.get("session_snapshot", True):
+            return
+        atexit.register(self._session_close)
+        self._session_tick()
+
+    def _session_tick(self):
+        """Периодически (session_snapshot_sec) записывать снимок, если состояние изменилось."""
+        if self._session_error:
+            self.logger.log_warning(f"Снимок сессии не записан: {self._session_error}")
+            self._session_error = None
+        busy = self._session_writer is not None and self._session_writer.is_alive()
+        try:
+            sig = self._session_signature()
+            if not busy and sig != self._session_sig and self.csv_path:
+                state = self._session_state()
+                self._session_sig = sig
+                # запись — в отдельном потоке, чтобы не подвешивать окно на больших файлах
+                self._session_writer = threading.Thread(target=self._session_write, args=(state,))
+                self._session_writer.start()
+        except Exception as e:
+            self.logger.err(f"Снимок сессии: {e}")
+        self.after(int(self.cfg.get("session_snapshot_sec", 60)) * 1000, self._session_tick)
+
+    def _session_write(self, state: dict):
+        try:
+            save_session(state)
+        except Exception as e:
+            self._session_error = e
+
+    def _session_close(self):
+        # штатное завершение: снимок больше не нужен
+        if self._session_writer is not None:
+            self._session_writer.join()
+        clear_session()
+
+    def _offer_session_restore(self) -> bool:
+        if not self.cfg.get("session_snapshot", True) or not os.path.isfile(session_path()):
+            return False
+        saved = time.strftime("%d.%m.%Y %H:%M", time.localtime(os.path.getmtime(session_path())))
+        if not mb.askyesno("Восстановление сессии",
+                           f"Предыдущая работа завершилась не штатно ({saved}).\n\n"
+                           "Восстановить загруженный CSV, справочник и состояние пакета?"):
+            clear_session()
+            return False
+        t0 = time.time()
+        state = load_session()
+        if state is None:
+            self.logger.err("Снимок сессии повреждён или от другой версии — восстановление невозможно")
+            clear_session()
+            return False
+        try:
+            self._restore_session(state)
+        except Exception as e:
+            self.logger.err(f"Не удалось восстановить сессию: {e}")
+            return False
+        self.logger.log(f"Сессия восстановлена за {time.time() - t0:.2f} с: CSV строк={self.csv_total}, "
+                        f"справочник={len([k for k in self.product_map if k != '_HAS_SHORT_COL'])}")
+        return True
+
+    def _restore_session(self, state: dict):
+        self.product_map = state.get("product_map") or {}
+        pm_path = state.get("product_map_path") or ""
+        if pm_path:
+            self._pm_path = pm_path
+            saved_sig = state.get("product_map_sig")
+            sig = self._file_sig(pm_path)
+            if sig is not None and (saved_sig is None or tuple(saved_sig) != sig):
+                # файл менялся после снимка (или снимок без подписи) — в снимке устаревший справочник
+                self.logger.log(f"Справочник изменён после снимка сессии — перечитываю в фоне: {pm_path}")
+                self._load_product_map_async(pm_path, reload=True)
+            else:
+                self._pm_sig = tuple(saved_sig) if saved_sig else None
             try:
-                self.update_idletasks(); self.update()
+                self.prodmap_entry.configure(state="normal")
+                self.prodmap_entry.delete(0, "end")
+                self.prodmap_entry.insert(0, pm_path)
+                self.prodmap_entry.configure(state="disabled")
             except Exception:
                 pass
-            idx1_pre = global_offset + i_pre + 1
-            enr_pre = self._enrich(base_pre, idx1_pre)
+
+        p = state.get("csv_path") or ""
+        if p:
+            self.csv_path = p
+            self.csv_tail = state.get("csv_tail")
+            self.csv_label.configure(text=f"CSV: {self.csv_path}")
+            if state.get("csv_store") is not None:
+                self.csv_rows = KonturRowStore.from_bytes(state["csv_store"])
+                self.csv_total = len(self.csv_rows)
+                self._scan_csv(report_from=None)
+            else:
+                # индекс — обычно из .rowidx, но без него строится заново: в фоне, как при открытии
+                self._index_csv(p, self._csv_restored)
+
+        for entry, key in ((self.index_entry, "index"), (self.batch_entry, "batch_size")):
+            if state.get(key):
+                entry.delete(0, "end")
+                entry.insert(0, state[key])
+
+        info = state.get("batch_info")
+        if info:
+            self.batch_info = info
+            self._show_batch_controls(
+                f"Восстановлен пакет {info.get('index')}/{info.get('total')}",
+                f"Строки: {info.get('start_line')}-{info.get('end_line')} (в пакете {len(info.get('rows', []))} позиций)"
+            )
+        if self.csv_total:
+            self._preview()
+
+    def _csv_restored(self):
+        self._scan_csv(report_from=None)
+        self._preview()
+
+    # ---------- журнал напечатанных DM ----------
+
+    def _open_ledger(self):
+        try:
+            self.ledger = PrintedLedger.open()
+            atexit.register(self.ledger.close)
+            self.logger.log(f"Журнал напечатанных DM: {len(self.ledger)} кодов ({self.ledger.log_path})")
+        except Exception as e:
+            self.ledger = None
+            self.logger.err(f"Журнал напечатанных DM недоступен: {e}")
+
+    def _open_csv_cache(self):
+        self.csv_cache = None
+        if not self.cfg.get("csv_cache", True):
+            return
+        try:
+            self.csv_cache = KonturCache(max_bytes=int(self.cfg.get("csv_cache_max_mb", 512)) * 1024 * 1024)
+        except Exception as e:
+            self.logger.err(f"Кэш разобранных CSV недоступен: {e}")
+
+    def _load_csv_store(self, p, size=None) -> bool:
+        """Заполнить self.csv_rows из кэша или разбором файла; True — взято из кэша.
+
+        size — разобрать только столько байт (снимок для «Дочитать CSV»): строки, дописанные
+        во время разбора, достанутся дочитыванию, а не попадут в хранилище дважды.
+        """
+        key = None
+        if self.csv_cache is not None:
+            try:
+                key = kontur_cache_key(p)
+                # файл дописан после снимка — ключ уже не про разбираемые байты: мимо кэша
+                if size is not None and os.path.getsize(p) != size:
+                    key = None
+                cached = self.csv_cache.get(key) if key is not None else None
+            except OSError:
+                key = cached = None
+            if cached is not None:
+                self.csv_rows = cached
+                return True
+        # большие файлы разбираются в пуле процессов (порядок строк сохраняется)
+        self.csv_rows = KonturRowStore()
+        for cols in iter_kontur_columns(p, int(self.cfg.get("csv_workers", 0)) or None, size):
+            self.csv_rows.extend_columns(*cols)
+        if key is not None:
+            self.csv_cache.put(key, self.csv_rows)
+        return False
+
+    def _show_ledger_report(self, rep):
+        """Сколько DM файла уже печаталось и какие повторяются внутри файла (строки — номера в файле)."""
+        if rep.duplicates:
+            sample = ", ".join(str(p + 1) for p in rep.duplicates[:10])
+            self.logger.log_warning(f"CSV: повторяющихся DM внутри файла: {len(rep.duplicates)} (строки: {sample}…)")
+        if rep.printed:
+            sample = ", ".join(str(p + 1) for p in rep.printed[:10])
+            self.logger.log_warning(f"CSV: уже напечатано ранее: {len(rep.printed)} из {rep.total} (строки: {sample}…)")
+
+    def _show_gs1_report(self, rep):
+        """Структура DM (GS1) и совпадение GTIN в DM с колонкой GTIN — до печати."""
+        if rep.ok:
+            return
+        lines = []
+        for title, positions in (("Некорректные DM", rep.malformed), ("GTIN в DM ≠ колонке GTIN", rep.mismatched)):
+            if positions:
+                sample = ", ".join(str(p + 1) for p in positions[:10])
+                lines.append(f"{title}: {len(positions)} (строки: {sample}…)")
+                self.logger.log_warning(f"CSV: {lines[-1]}")
+        reasons = "\n".join(f"  {reason}: {n}" for reason, n in rep.reasons.most_common())
+        mb.showwarning("Проверка DM", "\n".join(lines) + "\n\nПричины:\n" + reasons)
+
+    def _ledger_confirm(self, dms, title: str, sel=None) -> bool:
+        """Проверить DM задания по журналу и спросить, что делать с уже напечатанными.
+
+        sel — отбор строк файла: тогда сверка берётся из фонового прохода по файлу, а dms
+        читаются, только если его отчёта нет. False — задание отменено. Решение запоминается
+        в self.ledger_skip_printed.
+        """
+        self.ledger_skip_printed = True
+        if self.ledger is None:
+            return True
+        rep = self._selection_ledger_report(sel) if sel is not None else None
+        if rep is None:
+            rep = self.ledger.check(d for d in dms if d and d != "X")
+        if rep.duplicates:
+            self.logger.log_warning(f"{title}: повторяющихся DM в задании: {len(rep.duplicates)}")
+        if not rep.printed:
+            return True
+        ans = mb.askyesnocancel(
+            title,
+            f"{len(rep.printed)} из {rep.total} DM уже печатались ранее.\n\n"
+            "Да — напечатать их повторно\nНет — пропустить уже напечатанные\nОтмена — не печатать",
+        )
+        if ans is None:
+            self.logger.log(f"{title}: отменено — DM уже печатались.")
+            return False
+        self.ledger_skip_printed = not ans
+        self.logger.log_warning(f"{title}: уже напечатанных DM {len(rep.printed)} — "
+                                f"{'печатаем повторно' if ans else 'будут пропущены'}")
+        return True
+
+    def _selection_ledger_report(self, sel):
+        """Отчёт журнала по отбору без чтения строк; None — отчёта прохода по всему файлу нет."""
+        self._wait_csv_scan()
+        full = self.csv_ledger_report
+        if full is None or self.csv_lookup is None or full.total != self._csv_total():
+            return None
+        return selection_ledger_report(full, sel, self.csv_lookup, self.ledger)
+
+    def _ledger_blocked(self, dm) -> bool:
+        return bool(self.ledger is not None and self.ledger_skip_printed and dm and dm != "X" and dm in self.ledger)
+
+    def _ledger_record(self, dms):
+        if self.ledger is None:
+            return
+        try:
+            self.ledger.add_many(d for d in dms if d and d != "X")
+        except Exception as e:
+            self.logger.err(f"Журнал DM: не удалось записать: {e}")
+
+    def _prepare_enriched_rows(self, rows, global_offset: int, nums=None, ctx=None):
+        """nums — номера строк в файле (для отбора вразбивку), иначе подряд от global_offset + 1.
+
+        ctx — снимок параметров задания (EnrichContext); без него снимается здесь же.
+        """
+        enriched_rows = []
+        rows = list(rows)
+        nums = list(nums) if nums else list(range(global_offset + 1, global_offset + 1 + len(rows)))
+        if ctx is None:
+            ctx = self._enrich_context(need_date=any(not r.get("PROD_DATE") for r in rows))
+        pairs = zip(nums, rows)
+        for idx1_pre, enr_pre in self._iter_enriched(pairs, ctx, use_pool=self._enrich_pool_ok(len(rows))):
             if not enr_pre:
                 self.logger.err(f"Строка {idx1_pre}: данные не сформированы — пропуск в буфере")
                 continue
@@ -675,9 +887,7 @@ class App(ctk.CTk):
             if bool(self.calib_var.get()) and enriched_rows:
                 cols = getattr(self, 'REQ_COLS', ["ShortName","ShortGTIN","EXP_DATE","PROD_DATE","PART_NUM","DM","NUM"])
                 fmt0 = (enriched_rows[0].get("_FORMAT") or "16x16")
-                dummy = {k: ("1" if k.upper()=="NUM" else ("000" if k=="ShortGTIN" else "X")) for k in cols}
-                dummy.update({"_FORMAT": fmt0})
-                enriched_rows = [dummy.copy() for _ in range(6)] + enriched_rows
+                enriched_rows = calibration_rows(cols, fmt0) + enriched_rows
                 self.logger.log("КАЛИБРОВКА: 6 строк 'X' добавлены в начало батча.")
         except Exception:
             pass
@@ -701,6 +911,11 @@ class App(ctk.CTk):
                 except Exception:
                     pass
 
+                if self._ledger_blocked(enr.get("DM")):
+                    self.logger.log_warning(f"Пакет {bidx}: DM {enr.get('DM')} (NUM {enr.get('NUM')}) уже напечатан — пропуск")
+                    self._set_progress(i_enr+1, len(enriched_rows), f"Печать пакета {bidx}")
+                    continue
+
                 fmt_name = enr.get("_FORMAT","16x16")
                 btw = self._get_btw_for_format(fmt_name)
                 if not btw:
@@ -736,6 +951,7 @@ class App(ctk.CTk):
                 prompt_left = False
                 if main_ok:
                     sent += 1
+                    self._ledger_record([enr.get("DM")])
                     try:
                         self.logger.log(f"Основная этикетка отправлена → '{prn}'.")
                     except Exception:
@@ -779,6 +995,8 @@ class App(ctk.CTk):
         if not enriched_rows:
             mb.showerror("Печать пакета", "Текущий пакет пуст и не может быть перепечатан.")
             return
+        if not self._ledger_confirm((e.get("DM") for e in enriched_rows), "Печать пакета"):
+            return
         self.set_status("Подготовка данных…")
         self._write_tmp_batch_csv(enriched_rows)
         start_line = self.batch_info.get("start_line", 1)
@@ -796,14 +1014,18 @@ class App(ctk.CTk):
             return
         offset = self.batch_info.get("offset", 0) + start_idx - 1
         part_rows = rows[start_idx - 1:]
+        nums = self.batch_info.get("nums")
+        part_nums = nums[start_idx - 1:] if nums else None
+        if not self._ledger_confirm((r.get("DM") for r in part_rows), "Допечатка"):
+            return
         self.set_status("Подготовка данных…")
-        enriched_rows = self._prepare_enriched_rows(part_rows, offset)
+        enriched_rows = self._prepare_enriched_rows(part_rows, offset, part_nums)
         if not enriched_rows:
             mb.showerror("Допечатка", "Нет валидных строк для допечатки.")
             return
         self._write_tmp_batch_csv(enriched_rows)
-        start_line = offset + 1
-        end_line = offset + len(part_rows)
+        start_line = part_nums[0] if part_nums else offset + 1
+        end_line = part_nums[-1] if part_nums else offset + len(part_rows)
         self._print_enriched_rows(enriched_rows, self.batch_info.get("printer", ""), self.batch_info.get("copies", 1), self.batch_info.get("index", 1), self.batch_info.get("total", 1), start_line=start_line, end_line=end_line)
 
     def _build_ui(self):
@@ -826,6 +1048,7 @@ class App(ctk.CTk):
 #         ctk.CTkButton(top, text="30x20…", command=lambda: self._choose_btw("30x20")).pack(side="left", padx=(0, 8), pady=10)
 
         ctk.CTkButton(top, text="Открыть CSV…", command=self._choose_csv).pack(side="left", padx=(8, 8), pady=10)
+        ctk.CTkButton(top, text="Дочитать CSV", width=110, command=self._reload_csv_tail).pack(side="left", padx=(0, 8), pady=10)
         self.csv_label = ctk.CTkLabel(top, text="CSV: (не выбран)")
         self.csv_label.pack(side="left", padx=(8, 4), pady=10)
 
@@ -860,6 +1083,12 @@ class App(ctk.CTk):
         self.limit_entry = ctk.CTkEntry(mid, width=100)
         self.limit_entry.pack(side="left", padx=(0, 12), pady=10)
 
+        # отбор строк вместо «Строка №» + «Лимит»: «17, 340-360, 9021» — строки вразбивку (одним заданием),
+        # GTIN=… — только этот товар, DM=… — продолжить с этого кода
+        ctk.CTkLabel(mid, text="Отбор:").pack(side="left", padx=(6, 6), pady=10)
+        self.select_entry = ctk.CTkEntry(mid, width=200, placeholder_text="17, 340-360 / GTIN=… / DM=…")
+        self.select_entry.pack(side="left", padx=(0, 12), pady=10)
+
         ctk.CTkLabel(mid, text="Пакет по (шт.):").pack(side="left", padx=(6, 6), pady=10)
         self.batch_entry = ctk.CTkEntry(mid, width=100)
         self.batch_entry.insert(0, str(self.default_batch_size))
@@ -1042,61 +1271,152 @@ class App(ctk.CTk):
         except Exception:
             pass
 
-        if os.path.isfile(path) and load_workbook is not None:
-            try:
-                self.product_map = read_product_map(path) or {}
-            except Exception as e:
-                self.product_map = {}
-                self.logger.err(f"Ошибка чтения справочника: {e}")
-            self.cfg["product_map_path"] = path
-            save_config(self.cfg)
-            cnt = len([k for k in self.product_map.keys() if k != "_HAS_SHORT_COL"])
-            has_short = bool(self.product_map.get("_HAS_SHORT_COL"))
-            self.logger.log(f"Справочник загружен автоматически: {path} (записей={cnt}); ShortName-столбец: {has_short}")
+        use_cache = bool(self.cfg.get("product_map_cache", True))
+        if os.path.isfile(path) and (load_workbook is not None or use_cache):
+            self._load_product_map_async(path)
         else:
             if load_workbook is None:
                 self.logger.err("openpyxl не установлен; справочник не загружен.")
             else:
                 self.logger.err(f"Справочник не найден: {path}")
 
-    def _prompt_csv_on_launch(self):
-        if self.csv_path:
+    def _load_product_map_async(self, path, reload=False):
+        """Разбор справочника в фоновом потоке; готовый словарь подставляется в self.product_map целиком.
+
+        reload — перечитывание изменившегося файла: неудачный разбор оставляет прежний справочник.
+        """
+        # разобранный справочник берётся из кэша, пока сам xlsx не менялся — тогда openpyxl не нужен
+        use_cache = bool(self.cfg.get("product_map_cache", True))
+
+        def job():
+            t0 = time.time()
+            if use_cache:
+                mapping, from_cache = load_product_map_cached(path)
+            else:
+                mapping, from_cache = read_product_map(path) or {}, False
+            # индекс GTIN-14 строится здесь же, в фоне, а не на первой строке печати
+            gtin_index(mapping)
+            return mapping, from_cache, time.time() - t0
+
+        self._pm_loading_sig = self._file_sig(path)
+        self._pm_reload = reload
+        fut = self._pm_executor.submit(job)
+        self._pm_future = fut
+        self._pm_path = path
+        self.set_status("Справочник обновляется…" if reload else "Справочник загружается…")
+        self.after(100, self._poll_product_map, fut)
+
+    def _poll_product_map(self, fut):
+        if not fut.done():
+            self.after(100, self._poll_product_map, fut)
             return
-        p = fd.askopenfilename(title="Выбери kontur.csv/tsv",
-                               filetypes=[("CSV/TSV", "*.csv;*.tsv;*.txt"), ("Все файлы", "*.*")])
-        if not p:
-            self.logger.err("CSV не выбран.")
+        self._apply_product_map(fut)
+
+    def _apply_product_map(self, fut):
+        # future применяется один раз: либо из опроса, либо из ожидания в _wait_product_map
+        if self._pm_future is not fut:
             return
-        self.csv_path = p
-        self.csv_label.configure(text=f"CSV: {self.csv_path}")
+        self._pm_future = None
+        path = self._pm_path
+        # этот вариант файла разобран (удачно или нет) — повторно его не перечитываем
+        self._pm_sig = self._pm_loading_sig
         try:
-            self.csv_rows = load_kontur_raw(p)
-            head = self.csv_rows[0] if self.csv_rows else {"DM": "", "NAME": ""}
-            self.logger.log(f"CSV: строк={len(self.csv_rows)}; пример DM='{head.get('DM','')}', NAME='{head.get('NAME','')}'")
-            # авто-подстановка размера пакета: минимум из дефолта и общего числа строк
-            try:
-                if self.csv_rows:
-                    suggested = min(len(self.csv_rows), self.default_batch_size)
-                    self.batch_entry.delete(0, "end")
-                    self.batch_entry.insert(0, str(suggested))
-            except Exception:
-                pass
+            mapping, from_cache, took = fut.result()
+        except Exception as e:
+            self.logger.err(f"Ошибка чтения справочника: {e}")
+            self.set_status("Справочник не загружен")
+            return
+        if self._pm_reload:
+            if not mapping:
+                self.logger.err(f"Справочник изменён, но не прочитан — остаётся прежний: {path}")
+                self.set_status("Справочник не обновлён")
+                return
+            # задания в работе держат свой снимок (EnrichContext) — подмена их не затрагивает
+            self.product_map = mapping
+            cnt = len([k for k in mapping.keys() if k != "_HAS_SHORT_COL"])
+            self.logger.log(f"Справочник обновлён: {path} (записей={cnt}) за {took:.2f} с")
+            self.set_status(f"Справочник обновлён ({cnt})")
+            self._log_gtin_check(mapping)
+            return
+        if not mapping and load_workbook is None:
+            self.logger.err("openpyxl не установлен; справочник не загружен.")
+            self.set_status("Справочник не загружен")
+            return
+        self.product_map = mapping
+        self.cfg["product_map_path"] = path
+        save_config(self.cfg)
+        cnt = len([k for k in self.product_map.keys() if k != "_HAS_SHORT_COL"])
+        has_short = bool(self.product_map.get("_HAS_SHORT_COL"))
+        self.logger.log(f"Справочник загружен автоматически: {path} (записей={cnt}); ShortName-столбец: {has_short}; "
+                        f"{'из кэша' if from_cache else 'разобран'} за {took:.2f} с")
+        self.set_status(f"Справочник загружен ({cnt})")
+        self._log_gtin_check(mapping)
+
+    def _log_gtin_check(self, mapping):
+        """Ключи справочника с неверной контрольной цифрой GTIN — находятся только точным совпадением."""
+        bad = gtin_index(mapping).invalid
+        if bad:
+            more = f" и ещё {len(bad) - 5}" if len(bad) > 5 else ""
+            self.logger.log_warning(f"Справочник: неверная контрольная цифра GTIN у {len(bad)} записей: "
+                                    f"{', '.join(bad[:5])}{more}")
 
-            # ---- авто-превью первой строки сразу после выбора CSV (старт программы) ----
-            try:
-                if self.csv_rows:
-                    try:
-                        self.index_entry.delete(0, 'end')
-                        self.index_entry.insert(0, '1')
-                    except Exception:
-                        pass
-                    self._preview()
-            except Exception as _e:
+    @staticmethod
+    def _file_sig(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _watch_product_map(self):
+        """Опрос mtime справочника (cfg product_map_watch_sec, 0 — выкл.); изменённый файл перечитывается в фоне."""
+        interval = float(self.cfg.get("product_map_watch_sec", 5))
+        if interval <= 0:
+            return
+        try:
+            path = self._pm_path or self.cfg.get("product_map_path") or ""
+            sig = self._file_sig(path) if path else None
+            if sig is not None and self._pm_future is None:
+                if self._pm_sig is None:
+                    # справочник ещё ни разу не читался из этого файла — следим с текущего состояния
+                    self._pm_sig = sig
+                elif sig != self._pm_sig:
+                    # Excel сохраняет файл не мгновенно: ждём, пока mtime/размер не перестанут меняться
+                    if sig == self._pm_seen:
+                        self.logger.log(f"Справочник изменён на диске — перечитываю в фоне: {path}")
+                        self._load_product_map_async(path, reload=True)
+                    self._pm_seen = sig
+        except Exception as e:
+            self.logger.err(f"Слежение за справочником: {e}")
+        self.after(int(interval * 1000), self._watch_product_map)
+
+    def _wait_product_map(self):
+        """Дождаться фоновой загрузки справочника (окно при этом обновляется); сразу, если она не идёт."""
+        fut = self._pm_future
+        if fut is None:
+            return
+        if not fut.done():
+            self.logger.log("Ожидание загрузки справочника…")
+            while not fut.done():
                 try:
-                    self.logger.err(f"Авто-превью при запуске: {_e}")
+                    self.update_idletasks(); self.update()
                 except Exception:
                     pass
-            # ---- конец авто-превью ----
+                futures_wait([fut], timeout=0.05)
+        self._apply_product_map(fut)
+
+    def _prompt_csv_on_launch(self):
+        if self.csv_path:
+            return
+        # можно выбрать несколько файлов — они будут объединены в один поток строк
+        paths = fd.askopenfilenames(title="Выбери kontur.csv/tsv (один или несколько)",
+                                    filetypes=[("CSV/TSV/XLSX (также .gz/.zip)", "*.csv;*.tsv;*.txt;*.xlsx;*.gz;*.zip"),
+                                               ("Все файлы", "*.*")])
+        if not paths:
+            self.logger.err("CSV не выбран.")
+            return
+        try:
+            self._open_csv_paths(list(paths))
         except Exception as e:
             self.logger.err(f"Ошибка CSV: {e}")
             mb.showerror("CSV", f"Не удалось прочитать файл:\n{e}")
@@ -1116,44 +1436,307 @@ class App(ctk.CTk):
         self.logger.log(f"[Пресет] Сохранён путь для {fmt}: {p}")
 
     def _choose_csv(self):
-        p = fd.askopenfilename(title="Выбери kontur.csv/tsv",
-                               filetypes=[("CSV/TSV", "*.csv;*.tsv;*.txt"), ("Все файлы", "*.*")])
-        if not p:
+        # можно выбрать несколько файлов — они будут объединены в один поток строк
+        paths = fd.askopenfilenames(title="Выбери kontur.csv/tsv (один или несколько)",
+                                    filetypes=[("CSV/TSV/XLSX (также .gz/.zip)", "*.csv;*.tsv;*.txt;*.xlsx;*.gz;*.zip"),
+                                               ("Все файлы", "*.*")])
+        if not paths:
             return
+        try:
+            self._open_csv_paths(list(paths))
+        except Exception as e:
+            self.logger.err(f"Ошибка CSV: {e}")
+
+    def _open_csv_paths(self, paths):
+        """Один файл — открыть как есть; несколько — слить потоком в один TSV (сквозная нумерация, без повторов DM)."""
+        if len(paths) == 1:
+            self._open_csv(paths[0])
+            return
+        # объединённый файл может читать фоновый проход и держать mmap индекс — отпустить перед перезаписью
+        self._wait_csv_index()
+        self._wait_csv_scan(apply=False)
+        if self.csv_index is not None:
+            self.csv_index.close()
+            self.csv_index = None
+        out = os.path.join(_cfg_dir(), "merged_kontur.tsv")
+        drop = bool(self.cfg.get("merge_drop_duplicates", True))
+        t0 = time.time()
+        rep = write_kontur_merged(paths, out, drop_duplicates=drop)
+        for path, n in rep.per_file:
+            self.logger.log(f"CSV: {os.path.basename(path)} — строк {n}")
+        if rep.duplicates:
+            sample = ", ".join(f"{os.path.basename(f)}:{n}" for f, n in rep.duplicate_samples[:10])
+            what = "пропущено" if drop else "оставлено"
+            self.logger.log_warning(f"CSV: повторяющихся DM между файлами: {rep.duplicates} ({what}; {sample}…)")
+        self.logger.log(f"CSV: объединено файлов {len(paths)}, строк {rep.rows} за {time.time() - t0:.2f} с")
+        self._open_csv(out)
+        self.csv_label.configure(text=f"CSV: {len(paths)} файл(ов): " + ", ".join(os.path.basename(p) for p in paths))
+
+    @staticmethod
+    def _csv_tail_state(p) -> dict:
+        size = os.path.getsize(p)
+        head_len = min(size, 4096)
+        open_line = False
+        if size:
+            with open(p, "rb") as f:
+                f.seek(size - 1)
+                open_line = f.read(1) != b"\n"
+        return {"offset": size, "head": kontur_head_hash(p, head_len), "head_len": head_len,
+                "open_line": open_line, "dated": not is_streamed(p) and kontur_dated(p)}
+
+    def _reload_csv_tail(self):
+        """Дочитать строки, дописанные в конец CSV после открытия; подменённый файл — открыть заново."""
+        if not self.csv_path:
+            mb.showerror("Нет CSV", "Сначала выберите CSV.")
+            return
+        p = self.csv_path
+        st = getattr(self, "csv_tail", None)
+        if self._index_future is not None:
+            self.logger.log("CSV: индекс строк ещё строится — дочитать можно после него")
+            return
+        try:
+            size = os.path.getsize(p)
+            # у архива «хвост» не дочитать — только полная перезагрузка
+            rewritten = (not st or is_streamed(p) or size < st["offset"]
+                         or kontur_head_hash(p, st["head_len"]) != st["head"])
+            # в хранилище уже лежит недописанная последняя строка — дочитать её нельзя, только заново
+            if rewritten or (self.csv_index is None and st["open_line"]):
+                self.logger.log_warning("CSV: файл изменён не только в конце — полная перезагрузка")
+                self._open_csv(p)
+                return
+            before = self._csv_total()
+            t0 = time.time()
+            # хранилище дописывается на месте — фоновый проход по нему должен закончиться раньше
+            self._wait_csv_scan()
+            if self.csv_index is not None:
+                try:
+                    self.csv_index.extend_tail()
+                except ValueError:
+                    self.logger.log_warning("CSV: файл укоротился — полная перезагрузка")
+                    self._open_csv(p)
+                    return
+                if self.cfg.get("row_index_sidecar", True):
+                    try:
+                        self.csv_index.save()
+                    except OSError as e:
+                        self.logger.log_warning(f"CSV: не удалось сохранить индекс строк: {e}")
+                self.csv_total = len(self.csv_index)
+                st["offset"] = self.csv_index.size
+            else:
+                rows, st["offset"] = read_kontur_tail(p, st["offset"], st.get("dated", False))
+                if not isinstance(self.csv_rows, KonturRowStore):
+                    self.csv_rows = KonturRowStore.from_rows(self.csv_rows)
+                self.csv_rows.extend(rows)
+                self.csv_total = len(self.csv_rows)
+            added = self.csv_total - before
+            if not added:
+                self.logger.log("CSV: новых строк нет")
+                return
+            self.logger.log(f"CSV: дочитано строк: {added} за {time.time() - t0:.2f} с (всего {self.csv_total})")
+            # индекс — по всему файлу, проверки — только по новым строкам
+            self._scan_csv(report_from=before)
+        except Exception as e:
+            self.logger.err(f"Ошибка дочитывания CSV: {e}")
+
+    def _open_csv(self, p):
+        """Открыть kontur-файл: небольшой — в компактное хранилище, большой — через индекс смещений."""
         self.csv_path = p
         self.csv_label.configure(text=f"CSV: {self.csv_path}")
+        self.csv_rows = []
+        self.csv_total = 0
+        # индекс предыдущего файла, если ещё строится, больше не нужен
+        self._index_future = None
+        if self.csv_index is not None:
+            self.csv_index.close()
+            self.csv_index = None
+        t0 = time.time()
+        # снимок размера/начала файла до разбора: от него «Дочитать CSV» продолжит чтение
+        self.csv_tail = self._csv_tail_state(p)
+        store_max = int(self.cfg.get("csv_store_max_mb", 64)) * 1024 * 1024
+        if is_streamed(p) or os.path.getsize(p) <= store_max:
+            # сжатый (.gz/.zip) и .xlsx файл читается потоком и всегда хранится в памяти: смещения по нему не построить
+            # файл помещается в компактное колоночное хранилище (DM-буфер + id GTIN/NAME)
+            src = "из кэша" if self._load_csv_store(p, None if is_streamed(p) else self.csv_tail["offset"]) else "в память"
+            self.csv_total = len(self.csv_rows)
+            self.logger.log(f"CSV: загружено {src} за {time.time() - t0:.2f} с "
+                            f"(~{self.csv_rows.nbytes() / 1048576:.1f} МБ, GTIN={len(self.csv_rows.gtins)})")
+        else:
+            # большой файл: индекс смещений строк (проход по байтам, по диапазонам в пуле процессов;
+            # сохраняется рядом с CSV как .rowidx) — в фоне, окно не замирает
+            self._index_csv(p, self._csv_opened)
+            return
+        self._csv_opened()
+
+    def _index_csv(self, p, on_ready):
+        """Построить (или взять из .rowidx) индекс строк в фоновом потоке; on_ready() — когда он готов."""
+        fut = self._scan_executor.submit(KonturRowIndex.open, p,
+                                         persist=bool(self.cfg.get("row_index_sidecar", True)),
+                                         workers=int(self.cfg.get("csv_workers", 0)) or None)
+        self._index_future = fut
+        self.set_status("Индекс строк CSV строится…")
+        self.after(100, self._poll_csv_index, fut, on_ready, time.time())
+
+    def _poll_csv_index(self, fut, on_ready, t0):
+        if not fut.done():
+            self.after(100, self._poll_csv_index, fut, on_ready, t0)
+            return
+        if self._index_future is not fut:
+            # пока индекс строился, открыт другой файл
+            return
+        self._index_future = None
         try:
-            self.csv_rows = load_kontur_raw(p)
-            head = self.csv_rows[0] if self.csv_rows else {"DM": "", "NAME": ""}
-            self.logger.log(f"CSV: строк={len(self.csv_rows)}; пример DM='{head.get('DM','')}', NAME='{head.get('NAME','')}'")
-            # авто-подстановка размера пакета: минимум из дефолта и общего числа строк
-            try:
-                if self.csv_rows:
-                    suggested = min(len(self.csv_rows), self.default_batch_size)
-                    self.batch_entry.delete(0, "end")
-                    self.batch_entry.insert(0, str(suggested))
-            except Exception:
-                pass
+            self.csv_index = fut.result()
+        except Exception as e:
+            self.logger.err(f"Ошибка CSV: индекс строк не построен: {e}")
+            self.set_status("CSV не открыт")
+            return
+        self.csv_total = len(self.csv_index)
+        self.logger.log(f"CSV: индекс строк готов за {time.time() - t0:.2f} с")
+        on_ready()
+
+    def _wait_csv_index(self):
+        """Дождаться построения индекса (файл сейчас перезапишут); сам индекс уже не нужен."""
+        fut, self._index_future = self._index_future, None
+        if fut is not None:
+            futures_wait([fut])
+
+    def _csv_opened(self):
+        """Файл открыт (хранилище или индекс готовы): пример строки, проход по файлу, размер пакета, превью."""
+        head = self._csv_row(1) or {"DM": "", "NAME": ""}
+        self.logger.log(f"CSV: строк={self.csv_total}; пример DM='{head.get('DM','')}', NAME='{head.get('NAME','')}'")
+        self._scan_csv()
+        # авто-подстановка размера пакета: минимум из дефолта и общего числа строк
+        try:
+            if self.csv_total:
+                suggested = min(self.csv_total, self.default_batch_size)
+                self.batch_entry.delete(0, "end")
+                self.batch_entry.insert(0, str(suggested))
+        except Exception:
+            pass
 
-            # ---- авто-превью первой строки сразу после выбора CSV ----
-            try:
-                if self.csv_rows:
-                    # сбросим индекс на 1 и вызовем превью
-                    try:
-                        self.index_entry.delete(0, 'end')
-                        self.index_entry.insert(0, '1')
-                    except Exception:
-                        pass
-                    self._preview()
-            except Exception as _e:
-                # не падать из-за превью — просто залогируем
+        # ---- авто-превью первой строки сразу после выбора CSV ----
+        try:
+            if self.csv_total:
+                # сбросим индекс на 1 и вызовем превью
                 try:
-                    self.logger.err(f"Авто-превью после выбора CSV: {_e}")
+                    self.index_entry.delete(0, 'end')
+                    self.index_entry.insert(0, '1')
                 except Exception:
                     pass
-            # ---- конец авто-превью ----
+                self._preview()
+        except Exception as _e:
+            # не падать из-за превью — просто залогируем
+            try:
+                self.logger.err(f"Авто-превью после выбора CSV: {_e}")
+            except Exception:
+                pass
+        # ---- конец авто-превью ----
+
+    # ---------- доступ к строкам CSV (потоково) ----------
+
+    def _csv_total(self) -> int:
+        if self.csv_rows:
+            return len(self.csv_rows)
+        return int(getattr(self, "csv_total", 0) or 0)
+
+    def _csv_row(self, idx1: int):
+        """Строка №idx1 (1-based) без загрузки всего файла; None, если строки нет."""
+        if idx1 < 1:
+            return None
+        if self.csv_rows:
+            return self.csv_rows[idx1 - 1] if idx1 <= len(self.csv_rows) else None
+        if self.csv_index is not None:
+            return self.csv_index[idx1 - 1] if idx1 <= len(self.csv_index) else None
+        if not self.csv_path:
+            return None
+        return next(islice(iter_kontur_raw(self.csv_path), idx1 - 1, None), None)
+
+    def _iter_csv_rows(self, idx0: int, limit=None):
+        """Ленивый итератор строк начиная с idx0 (0-based), не более limit штук."""
+        stop = (idx0 + limit) if limit else None
+        if self.csv_rows:
+            # срез хранилища — это представление, строки не копируются
+            return iter(self.csv_rows[idx0:stop])
+        if self.csv_index is not None:
+            return self.csv_index.iter_from(idx0, limit)
+        return islice(iter_kontur_raw(self.csv_path), idx0, stop)
+
+    def _scan_csv(self, report_from=0):
+        """Индекс DM/GTIN и проверки по журналу и GS1 — одним проходом по файлу в фоновом потоке.
+
+        report_from — с какой строки (0-based) проверять; None — только индекс (восстановление сессии).
+        Пока индекс строится, «Отбор» по GTIN/DM недоступен.
+        """
+        self.csv_lookup = None
+        if not report_from:
+            # новый файл; при дочитывании отчёт по прежним строкам дополняется новыми
+            self.csv_ledger_report = None
+        self._scan_future = None
+        source = self.csv_rows if isinstance(self.csv_rows, KonturRowStore) else self.csv_index
+        if source is None or not self._csv_total():
+            return
+        fut = self._scan_executor.submit(scan_kontur, source, self.ledger, report_from)
+        self._scan_future = fut
+        self.set_status("Проверка CSV…")
+        self.after(100, self._poll_csv_scan, fut)
+
+    def _poll_csv_scan(self, fut):
+        if not fut.done():
+            self.after(100, self._poll_csv_scan, fut)
+            return
+        self._apply_csv_scan(fut)
+
+    def _apply_csv_scan(self, fut):
+        # результат по уже закрытому/перечитанному файлу не нужен
+        if self._scan_future is not fut:
+            return
+        self._scan_future = None
+        try:
+            scan = fut.result()
         except Exception as e:
-            self.logger.err(f"Ошибка CSV: {e}")
+            self.logger.err(f"CSV: индекс DM/GTIN не построен: {e}")
+            self.set_status("Ошибка проверки CSV")
+            return
+        self.csv_lookup = scan.lookup
+        checks = "" if scan.gs1 is None else f" и проверки DM ({scan.gs1.total} строк)"
+        self.logger.log(f"CSV: индекс DM/GTIN{checks} за {scan.seconds:.2f} с")
+        self.set_status(f"CSV: строк {self._csv_total()}")
+        if scan.ledger is not None:
+            self._show_ledger_report(scan.ledger)
+            full = self.csv_ledger_report
+            if scan.report_from == 0 or full is None:
+                self.csv_ledger_report = scan.ledger if scan.report_from == 0 else None
+            else:
+                full.total += scan.ledger.total
+                full.printed.extend(scan.ledger.printed)
+                full.duplicates.extend(scan.ledger.duplicates)
+        if scan.gs1 is not None:
+            self._show_gs1_report(scan.gs1)
+
+    def _wait_csv_scan(self, apply=True):
+        """Дождаться фонового прохода по файлу; apply=False — результат не нужен (файл сейчас сменится)."""
+        fut = self._scan_future
+        if fut is None:
+            return
+        futures_wait([fut])
+        if apply:
+            self._apply_csv_scan(fut)
+        else:
+            self._scan_future = None
+
+    def _current_selection(self, idx0: int, limit=None) -> RowSelection:
+        """Строки к печати: «Отбор», если заполнен, иначе диапазон idx0 + limit. ValueError — отбор не разобран."""
+        sel = parse_selection(self.select_entry.get(), self.csv_lookup, self._csv_total())
+        if sel is None:
+            return RowSelection.span(idx0, limit, self._csv_total())
+        self.logger.log(f"Отбор: {len(sel)} строк ({sel.describe()})")
+        return sel
+
+    def _iter_selection(self, sel: RowSelection):
+        """Пары (номер строки 1-based, строка) по отбору, диапазон за диапазоном."""
+        for s, e in sel.ranges:
+            yield from enumerate(self._iter_csv_rows(s, e - s), start=s + 1)
+
     # ---------- helpers ----------
     def _get_batch_size(self):
         t = (self.batch_entry.get() or "").strip()
@@ -1186,6 +1769,41 @@ class App(ctk.CTk):
             mb.showerror("Дата производства", str(e))
             return None
 
+    def _enrich_context(self, need_date: bool = True) -> EnrichContext:
+        """Снимок полей формы для обогащения — один раз на задание, а не на каждую строку.
+
+        Ошибки в полях показываются здесь же, до начала печати; need_date=False — общая дата
+        не нужна (у всех строк своя PROD_DATE), о пустом/неверном поле не сообщаем.
+        """
+        # справочник мог ещё грузиться в фоне — задание без него не начинаем
+        self._wait_product_map()
+        if need_date:
+            d = self._get_prod_date()
+        else:
+            try:
+                d = parse_date_ru((self.prod_date_entry.get() or "").strip())
+            except Exception:
+                d = None
+        return EnrichContext(
+            prod_date=d,
+            exp_days=self._get_exp_days(),
+            mode_choice=self.format_combo.get(),
+            manual_part=None if self.part_auto_var.get() else (self.part_entry.get() or "").strip(),
+            product_map=self.product_map,
+        )
+
+    def _csv_needs_prod_date(self, sel=None) -> bool:
+        """Есть ли в отборе (по умолчанию — во всём файле) строки без своей PROD_DATE."""
+        store = self.csv_rows
+        if not isinstance(store, KonturRowStore):
+            return True
+        if not store.dates[1:]:
+            return True
+        ids = store.date_ids()
+        if sel is None:
+            return 0 in ids
+        return any(0 in ids[s:e] for s, e in sel.ranges)
+
     def _get_exp_days(self):
         t = (self.exp_days_entry.get() or "").strip()
         if not t:
@@ -1330,26 +1948,32 @@ class App(ctk.CTk):
         return None
 
     
-    def _enrich(self, base_row, idx1):
-        d = self._get_prod_date()
-        if not d:
+    def _enrich(self, base_row, idx1, ctx=None):
+        # своя дата производства в строке (4-я колонка) важнее общей даты из поля
+        if ctx is None:
+            ctx = self._enrich_context(need_date=not base_row.get("PROD_DATE"))
+        d = None if base_row.get("PROD_DATE") else ctx.prod_date
+        if not d and not base_row.get("PROD_DATE"):
+            return None
+        try:
+            enr = enrich_row(
+                base_row=base_row,
+                idx1=idx1,
+                prod_date=d,
+                exp_days_override=ctx.exp_days,
+                product_map=ctx.product_map,
+                mode_choice=ctx.mode_choice
+            )
+        except ValueError as e:
+            self.logger.err(f"Строка {idx1}: {e}")
             return None
-        enr = enrich_row(
-            base_row=base_row,
-            idx1=idx1,
-            prod_date=d,
-            exp_days_override=self._get_exp_days(),
-            product_map=self.product_map,
-            mode_choice=self.format_combo.get()
-        )
 
         # ручная партия имеет приоритет (если авто-галка снята)
-        if not self.part_auto_var.get():
-            manual = (self.part_entry.get() or "").strip()
-            enr["PART_NUM"] = manual
+        if ctx.manual_part is not None:
+            enr["PART_NUM"] = ctx.manual_part
 
         gtin_key = only_digits(base_row.get("GTIN", ""))
-        info = self.product_map.get(gtin_key, {})
+        info = lookup_product(ctx.product_map, gtin_key)
         shelf = info.get("SHELF") or {}
         shelf_desc = shelf.get("raw") or "-"
         self.logger.log(
@@ -1362,14 +1986,122 @@ class App(ctk.CTk):
         src = "не задан"
         if enr.get("_SHELF_LOG"):
             src = enr["_SHELF_LOG"]
-        elif self._get_exp_days() is not None:
-            src = f"override_days={self._get_exp_days()}"
+        elif ctx.exp_days is not None:
+            src = f"override_days={ctx.exp_days}"
         self.logger.log(f"Срок годности: {src}; EXP_DATE={enr.get('EXP_DATE','')}")
 
         # источник ShortName
         self.logger.log(f"ShortName источник: {enr.get('_SHORT_SRC','?')} → '{enr.get('ShortName','')}'")
         return enr
 
+    # строк за один вызов enrich_rows между обновлениями окна
+    ENRICH_CHUNK = 500
+
+    def _enrich_many(self, rows, nums, ctx, state=None):
+        """Пакетный _enrich: список enriched (None — строка не сформирована) для rows с номерами nums.
+
+        Всё, что зависит только от GTIN и даты, считается один раз на GTIN. Параметры берутся
+        из ctx (EnrichContext), виджеты не трогаются. state — общий словарь между вызовами
+        одной печати: сведения о товаре пишутся в лог один раз на GTIN.
+        """
+        out = enrich_chunk(ctx, rows, nums)
+        self._log_enriched(rows, out, ctx, state)
+        return out
+
+    def _log_enriched(self, rows, out, ctx, state=None):
+        """Сведения о товаре в лог — один раз на GTIN за печать (state["logged"])."""
+        state = state if state is not None else {}
+        logged = state.setdefault("logged", set())
+        for base, enr in zip(rows, out):
+            if enr is None:
+                continue
+            gtin_key = only_digits(base.get("GTIN", ""))
+            if gtin_key in logged:
+                continue
+            logged.add(gtin_key)
+            info = lookup_product(ctx.product_map, gtin_key)
+            shelf = info.get("SHELF") or {}
+            self.logger.log(
+                f"GTIN lookup: FORMAT='{info.get('FORMAT','-') or '-'}', "
+                f"SHELF='{shelf.get('raw') or '-'}', SHELF_PARSED={enr.get('_SHELF_LOG','')}, "
+                f"PART_TPL={'-' if not info.get('PART_TEMPLATE') else info.get('PART_TEMPLATE')}, "
+                f"ShortNameExcel='{(info.get('SHORTNAME') or '').strip()}', GTIN={gtin_key}; "
+                f"EXP_DATE={enr.get('EXP_DATE','')}; ShortName источник: {enr.get('_SHORT_SRC','?')}"
+            )
+
+    def _await_prefetched(self, prefetch):
+        """Следующий подготовленный пакет из Prefetcher; окно обновляется, пока он не готов.
+
+        None — пакеты кончились или печать отменена.
+        """
+        while True:
+            try:
+                return prefetch.get(timeout=0.05)
+            except queue.Empty:
+                pass
+            try:
+                self.update_idletasks(); self.update()
+            except Exception:
+                pass
+            if self.cancel_requested:
+                return None
+
+    def _enrich_pool_ok(self, n) -> bool:
+        """Обогащать ли n строк в пуле процессов (cfg: enrich_pool, enrich_pool_min_rows)."""
+        return (bool(self.cfg.get("enrich_pool", True))
+                and n >= int(self.cfg.get("enrich_pool_min_rows", 20000))
+                and default_workers() > 1)
+
+    def _iter_enriched(self, pairs, ctx, state=None, use_pool=False, pump=True):
+        """Пары (номер строки, enriched|None) для пар (номер строки, строка), по порядку.
+
+        use_pool — куски уходят в пул процессов (EnrichPool), окно в это время
+        обновляется, пока результат очередного куска не готов. Без пула окно
+        обновляется между кусками (pump).
+        """
+        state = state if state is not None else {}
+        if not use_pool:
+            for chunk in iter_chunks(pairs, self.ENRICH_CHUNK):
+                if pump:
+                    self._pause_wait()
+                    try:
+                        self.update_idletasks(); self.update()
+                    except Exception:
+                        pass
+                nums = [n for n, _ in chunk]
+                yield from zip(nums, self._enrich_many([b for _, b in chunk], nums, ctx, state))
+            return
+        step = int(self.cfg.get("enrich_pool_chunk", 5000))
+        chunks = (([b for _, b in c], [n for n, _ in c]) for c in iter_chunks(pairs, step))
+        t0 = time.time()
+        pool = EnrichPool(ctx)
+        self.logger.log(f"Обогащение в пуле процессов: {pool.workers} шт., кусок {step} строк")
+        done = 0
+        try:
+            for (rows, nums), fut in pool.submit_all(chunks):
+                while not fut.done():
+                    self._pause_wait()
+                    try:
+                        self.update_idletasks(); self.update()
+                    except Exception:
+                        pass
+                    if self.cancel_requested:
+                        raise InterruptedError
+                    futures_wait([fut], timeout=0.05)
+                out = fut.result()
+                self._log_enriched(rows, out, ctx, state)
+                done += len(rows)
+                yield from zip(nums, out)
+        except InterruptedError:
+            self.logger.log("Отменено пользователем во время подготовки данных.")
+            pool.close(cancel=True)
+            return
+        except BaseException:
+            pool.close(cancel=True)
+            raise
+        pool.close()
+        self.logger.log(f"Пул процессов: обогащено строк {done} за {time.time() - t0:.2f} с")
+
     def _show_preview_path(self, path):
         try:
             img = Image.open(path)
@@ -1499,8 +2231,8 @@ class App(ctk.CTk):
                     pass
                 try:
                     # Одно задание, без диалогов
-                    fmt.PrintOut(False, True) if self._dialog_flag() else fmt.PrintOut(False, False)
-                    return True
+                    res = fmt.PrintOut(False, True) if self._dialog_flag() else fmt.PrintOut(False, False)
+                    return print_succeeded(res)
                 except Exception as e:
                     try:
                         self.logger.err(f"SingleJob PrintOut error: {e}")
@@ -1541,8 +2273,10 @@ class App(ctk.CTk):
         # B: трёхаргументная перегрузка (copies, serialized, showDialog)
         try:
             self.logger.log(f"BT Print: B -> PrintOut(Copies={int(copies)}, Serialized=False, ShowDialog={prompt})")
-            fmt.PrintOut(int(copies), False, prompt)
-            return True
+            res = fmt.PrintOut(int(copies), False, prompt)
+            if not print_succeeded(res):
+                self.logger.err(f"BT Print: печать не выполнена (PrintOut={res})")
+            return print_succeeded(res)
         except Exception as e:
             if False and prompt:
                 self.logger.err(f"BT Print B ошибка: {e}")
@@ -1552,10 +2286,12 @@ class App(ctk.CTk):
         # C: fallback — полностью тихо
         try:
             self.logger.log("BT Print: C -> PrintOut(False, False) (тихо)")
-            fmt.PrintOut(False, True) if self._dialog_flag() else fmt.PrintOut(False, False)
+            res = fmt.PrintOut(False, True) if self._dialog_flag() else fmt.PrintOut(False, False)
             if False and prompt:
                 self.logger.err("Диалог печати не поддерживается COM — выполнена тихая печать.")
-            return True
+            if not print_succeeded(res):
+                self.logger.err(f"BT Print: печать не выполнена (PrintOut={res})")
+            return print_succeeded(res)
         except Exception as e:
             self.logger.err(f"Печать не удалась: {e}")
             return False
@@ -1652,18 +2388,17 @@ class App(ctk.CTk):
         if not self.csv_path:
             mb.showerror("CSV", "Выбери CSV")
             return
-        if not self.csv_rows:
-            try:
-                self.csv_rows = load_kontur_raw(self.csv_path)
-            except Exception as e:
-                self.logger.err(f"CSV ошибка: {e}")
-                return
-        if not self.csv_rows:
+        try:
+            total_rows = self._csv_total()
+            idx1 = min(self._get_index(), total_rows)
+            base = self._csv_row(idx1) if total_rows else None
+        except Exception as e:
+            self.logger.err(f"CSV ошибка: {e}")
+            return
+        if not base:
             mb.showerror("CSV", "Нет данных")
             return
 
-        idx1 = min(self._get_index(), len(self.csv_rows))
-        base = self.csv_rows[idx1 - 1]
         enr = self._enrich(base, idx1)
         if not enr:
             return
@@ -1712,19 +2447,20 @@ class App(ctk.CTk):
         if not self.csv_path:
             mb.showerror("CSV", "Выбери CSV")
             return
-        if not self.csv_rows:
-            try:
-                self.csv_rows = load_kontur_raw(self.csv_path)
-            except Exception as e:
-                self.logger.err(f"CSV ошибка: {e}")
-                return
-        if not self.csv_rows:
+        try:
+            total_rows = self._csv_total()
+            idx1 = min(self._get_index(), total_rows)
+            base = self._csv_row(idx1) if total_rows else None
+        except Exception as e:
+            self.logger.err(f"CSV ошибка: {e}")
+            return
+        if not base:
             mb.showerror("CSV", "Нет данных")
             return
 
-        idx1 = min(self._get_index(), len(self.csv_rows))
         copies = self._get_copies()
-        base = self.csv_rows[idx1 - 1]
+        if not self._ledger_confirm([base.get("DM")], "Печать строки") or self._ledger_blocked(base.get("DM")):
+            return
         enr = self._enrich(base, idx1)
         if not enr:
             return
@@ -1752,6 +2488,7 @@ class App(ctk.CTk):
 
             main_ok = self._bt_print(fmt, fmt.PrintSetup.IdenticalCopiesOfLabel, False)
             if main_ok:
+                self._ledger_record([enr.get("DM")])
                 self.logger.log(f"Основная этикетка отправлена → '{prn}'.")
                 try:
                     self._print_marking_label(enr)
@@ -1770,137 +2507,6 @@ class App(ctk.CTk):
             except Exception:
                 pass
 
-    def _print_all(self):
-
-        try:
-            self.deiconify(); self.state("normal"); self.lift()
-        except Exception:
-            pass
-        self.cancel_requested = False
-        self._reset_batch_state()
-        prn = self._get_printer()
-
-        if not prn:
-
-            return
-
-        if not self.csv_path:
-
-            mb.showerror("CSV", "Выбери CSV")
-
-            return
-
-        if not self.csv_rows:
-
-            try:
-
-                self.csv_rows = load_kontur_raw(self.csv_path)
-
-            except Exception as e:
-
-                self.logger.err(f"CSV ошибка: {e}")
-
-                return
-
-        if not self.csv_rows:
-
-            mb.showerror("CSV", "Нет данных")
-
-            return
-
-
-
-        limit = self._get_limit()
-
-        idx0 = max(0, (self._get_index() if hasattr(self, '_get_index') else 1) - 1)
-        rows_all = self.csv_rows[idx0:] if not limit else self.csv_rows[idx0:idx0+limit]
-
-        total = len(rows_all)
-
-        copies = self._get_copies()
-
-        batch_size = self._get_batch_size() or total
-        global_start = idx0
-        self.logger.log(f"Старт со строки: {global_start+1}")
-
-
-
-        # Сохраняем настройки
-
-        try:
-
-            self.cfg['batch_size'] = batch_size
-
-            self.cfg['show_print_dialog'] = bool(self.show_dialog_var.get())
-
-            save_config(self.cfg)
-
-        except Exception:
-
-            pass
-
-
-
-        self.logger.log(f"Серия: {total}/{len(self.csv_rows)} строк; копий/шт={copies}; принтер='{prn}'; пакет={batch_size}; диалог={'ON' if self.show_dialog_var.get() else 'OFF'}")
-
-        sent_total = 0
-
-
-
-        batches = [(i, min(i+batch_size, total)) for i in range(0, total, batch_size)]
-
-        self.logger.log(f"Всего пакетов: {len(batches)}")
-        try:
-            for bidx, (start, end) in enumerate(batches, start=1):
-                rows = rows_all[start:end]
-                self.set_status("Подготовка данных…")
-                enriched_rows = self._prepare_enriched_rows(rows, global_start + start)
-
-                if not enriched_rows:
-                    self.logger.err(f"Пакет {bidx}: нет валидных строк для записи tmp_batch.csv — пропуск печати пакета")
-                    continue
-
-                start_line = global_start + start + 1
-                end_line = global_start + end
-                self.set_status(f"Печать пакета {bidx} из {len(batches)} (строки {start_line}–{end_line})")
-                self._write_tmp_batch_csv(enriched_rows)
-                sent_total += self._print_enriched_rows(enriched_rows, prn, copies, bidx, len(batches), start_line=start_line, end_line=end_line)
-                self._store_batch_state(bidx, len(batches), rows, enriched_rows, global_start + start, copies, prn)
-                self._show_batch_controls(
-                    f"Пакет {bidx}/{len(batches)} завершён", f"Строки: {global_start + start + 1}-{global_start + end} (в пакете {len(rows)} позиций)"
-                )
-
-                while True:
-                    action = self._await_batch_action()
-                    if action == "next":
-                        break
-                    if action == "cancel":
-                        self.cancel_requested = True
-                        break
-                    if action == "reprint":
-                        self._reprint_current_batch()
-                        continue
-                    if action == "partial":
-                        self._reprint_partial_batch()
-                        continue
-                    break
-
-                if self.cancel_requested:
-                    break
-        except Exception as e:
-            self.set_status(f"Ошибка печати: {e}")
-            self.logger.err(f"Ошибка при печати пакетов: {e}")
-        if self.cancel_requested:
-            self.set_status("Печать отменена")
-        else:
-            self.logger.log(f"Готово. Отправлено: {sent_total}/{total}")
-            self.set_status("Готово")
-        # ## GUI_VIS_REVEAL_END ##
-        try:
-            self.deiconify(); self.state("normal"); self.lift()
-        except Exception:
-            pass
-
     def _print_test(self):
         """Печать одной тестовой страницы (лучше калибровки 'X'). 
         Если есть C:\\auto_print\\test_page.btw — используем его.
@@ -2056,25 +2662,25 @@ class App(ctk.CTk):
             return
 
 
-        if not self.csv_rows:
+        try:
 
 
-            try:
+            total_rows = self._csv_total()
 
 
-                self.csv_rows = load_kontur_raw(self.csv_path)
+            base = self._csv_row(max(1, min(idx, total_rows))) if total_rows else None
 
 
-            except Exception as e:
+        except Exception as e:
 
 
-                self.logger.err(f"CSV ошибка: {e}")
+            self.logger.err(f"CSV ошибка: {e}")
 
 
-                return
+            return
 
 
-        if not self.csv_rows:
+        if not base:
 
 
             mb.showerror("CSV", "Нет данных")
@@ -2083,10 +2689,6 @@ class App(ctk.CTk):
             return
 
 
-
-        base = self.csv_rows[max(1, min(idx, len(self.csv_rows))) - 1]
-
-
         enr = self._enrich(base, idx)
 
 
@@ -2310,31 +2912,31 @@ class App(ctk.CTk):
 
 
 
-        if not self.csv_rows:
+        try:
 
 
 
-            try:
+            total_rows = self._csv_total()
 
 
 
-                self.csv_rows = load_kontur_raw(self.csv_path)
+            base = self._csv_row(max(1, min(idx, total_rows))) if total_rows else None
 
 
 
-            except Exception as e:
+        except Exception as e:
 
 
 
-                self.logger.err(f"CSV ошибка: {e}")
+            self.logger.err(f"CSV ошибка: {e}")
 
 
 
-                return
+            return
 
 
 
-        if not self.csv_rows:
+        if not base:
 
 
 
@@ -2346,10 +2948,6 @@ class App(ctk.CTk):
 
 
 
-        base = self.csv_rows[max(1, min(idx, len(self.csv_rows))) - 1]
-
-
-
         enr = self._enrich(base, idx)
 
 
@@ -2832,7 +3430,7 @@ class App(ctk.CTk):
                 mb.showerror("Дата производства", f"Неверный формат (ДД.ММ.ГГГГ): {e}")
                 return None
 
-            info   = getattr(self, "product_map", {}).get(self._rangecsv_only_digits(gtin), {})
+            info   = lookup_product(getattr(self, "product_map", {}), gtin)
             shelf  = info.get("SHELF") or {}
             short_from_xlsx = (info.get("SHORTNAME") or "").strip()
             part_tpl = info.get("PART_TEMPLATE") or ""
@@ -3013,6 +3611,7 @@ class App(ctk.CTk):
                 enriched = []
 
                 self.logger.log("[INFO] Сбор данных в память для tmp_batch.csv (ускоренный режим)")
+                ctx = self._enrich_context()
 
                 for i, base in enumerate(rows_all):
 
@@ -3024,7 +3623,7 @@ class App(ctk.CTk):
 
                     idx1 = idx0 + i + 1
 
-                    enr = self._enrich(base, idx1)
+                    enr = self._enrich(base, idx1, ctx)
 
                     if not enr:
 
@@ -3448,9 +4047,10 @@ def _print_range_one_job_via_csv_patched(self):
 
     out_rows = []
     fmt_name_first = None
+    ctx = self._enrich_context()
     for idx1 in range(start1, end1+1):
         base = self.csv_rows[idx1-1]
-        enr = self._enrich(base, idx1)
+        enr = self._enrich(base, idx1, ctx)
         if not enr:
             continue
         if fmt_name_first is None:
@@ -3498,6 +4098,7 @@ except Exception as _e:
 
 # === Monkey patches: DB log + tmp_batch regenerate, no-rebind (BEGIN) ===
 import csv, datetime as _dt, os as _os, traceback as _tb, re as _re
+from itertools import chain, islice
 
 
 # --- Module-level SAFE calibration helper (defined early) ---
@@ -3636,41 +4237,70 @@ def _patch__log_db_connections(self, fmt):
 def _patch__write_tmp_batch_rows(self, rows, tmp_path):
     """
     Записывает tmp_batch.csv с колонками из self.REQ_COLS.
-    rows — массив словарей (обогащённых self._enrich).
+    rows — итерируемое словарей (обогащённых self._enrich), читается потоково.
+    Возвращает число записанных строк.
     """
     cols = list(getattr(self, "REQ_COLS", ["ShortName","ShortGTIN","EXP_DATE","PROD_DATE","PART_NUM","DM","NUM"]))
     _os.makedirs(_os.path.dirname(tmp_path), exist_ok=True)
+    n = 0
     with open(tmp_path, "w", encoding="utf-8", newline="") as f:
         w = csv.DictWriter(f, fieldnames=cols, delimiter=",", quoting=csv.QUOTE_MINIMAL)
         w.writeheader()
         for r in rows:
+            if self._ledger_blocked(r.get("DM")):
+                continue
             # только необходимые столбцы
             out = {c: (r.get(c, "") or "") for c in cols}
             w.writerow(out)
+            n += 1
     try:
-        self.logger.log(f"tmp_batch.csv записан: {tmp_path}")
+        self.logger.log(f"tmp_batch.csv записан: {tmp_path} (строк={n})")
     except Exception:
         pass
+    return n
+
+def _patch__columnar_source(self):
+    """Откуда колоночный движок берёт строки: KonturRowStore или индекс большого файла (None — неоткуда)."""
+    rows = getattr(self, "csv_rows", None)
+    if isinstance(rows, KonturRowStore):
+        return rows
+    return getattr(self, "csv_index", None)
+
+def _patch__columnar_ok(self, sel) -> bool:
+    """Колоночное обогащение — для больших отборов из хранилища в памяти или из индекса файла."""
+    return (_patch__columnar_source(self) is not None
+            and len(sel) >= int(self.cfg.get("columnar_min_rows", 100000)))
+
+def _patch__pack_size(self):
+    """Размер пакета для печати одним заданием; 0 — весь отбор одним пакетом."""
+    cands = ["batch_entry", "pack_n", "pack_by", "packet_by", "packet_size", "pack_var"]
+    for name in cands:
+        try:
+            v = getattr(self, name)
+            val = int(v.get()) if hasattr(v, "get") else int(v)
+            if val > 0:
+                return val
+        except Exception:
+            pass
+    return 0
 
-def _patch__collect_range_rows(self):
-    """
-    Забираем диапазон из self.csv_rows по index/limit, делаем self._enrich,
-    возвращаем массив 'enriched' словарей.
-    """
-    # ensure CSV loaded
-    if not getattr(self, "csv_rows", None):
+def _patch__calib_enabled(self):
+    """Включена ли калибровка (6 строк 'X' в начале файла каждого пакета)."""
+    names = ('calib_var','calibrate_var','calibration_var','calib_check','calibrate_check','calib_chk')
+    for _n in names:
         try:
-            if not getattr(self, "csv_path", ""):
-                return []
-            from __main__ import load_kontur_raw as _load_kontur_raw  # original helper
-            self.csv_rows = _load_kontur_raw(self.csv_path)
-        except Exception as e:
-            try:
-                self.logger.err(f"CSV ошибка: {e}")
-            except Exception:
-                pass
-            return []
+            v = getattr(self, _n, None)
+            if v is None:
+                continue
+            v = v.get() if hasattr(v, 'get') else v
+            if bool(v):
+                return True
+        except Exception:
+            pass
+    return False
 
+def _patch__range_bounds(self):
+    """(idx0, limit) диапазона из полей «Строка №» и «Лимит»; limit=None — до конца."""
     # pick range (1-based index)
     try:
         idx0 = max(0, int(self.index_entry.get().strip() or "1") - 1)
@@ -3684,24 +4314,45 @@ def _patch__collect_range_rows(self):
             limit_v = max(1, int(t))
     except Exception:
         limit_v = None
+    return idx0, limit_v
 
-    rows_all = self.csv_rows[idx0:] if not limit_v else self.csv_rows[idx0:idx0+limit_v]
-    if not rows_all:
-        return []
+def _patch__selection(self):
+    """Отбор строк («Отбор» или index/limit); ValueError — отбор не разобран."""
+    idx0, limit_v = _patch__range_bounds(self)
+    return self._current_selection(idx0, limit_v)
 
-    enriched = []
-    for i, base in enumerate(rows_all, start=1):
-        idx1 = idx0 + i
+def _patch__collect_range_rows(self, sel=None, ctx=None):
+    """
+    Лениво забираем строки отбора (по умолчанию index/limit) из CSV, делаем self._enrich
+    и отдаём 'enriched' словари по одному (генератор, файл целиком в память не читается).
+    ctx — снимок параметров задания (EnrichContext), по умолчанию снимается при первом обращении.
+    """
+    if not getattr(self, "csv_path", ""):
+        return
+
+    try:
+        if sel is None:
+            sel = _patch__selection(self)
+        rows_all = self._iter_selection(sel)
+    except Exception as e:
         try:
-            enr = self._enrich(base, idx1)
-        except Exception as e:
-            enr = None
+            self.logger.err(f"CSV ошибка: {e}")
+        except Exception:
+            pass
+        return
+
+    if ctx is None:
+        need_date = self._csv_needs_prod_date(sel)
+        ctx = self._enrich_context(need_date=need_date)
+        # дата не введена/неверна — ошибка уже показана; без неё строки не сформировать
+        if need_date and ctx.prod_date is None:
+            return
+    for idx1, enr in self._iter_enriched(rows_all, ctx, use_pool=self._enrich_pool_ok(len(sel)), pump=False):
         if not enr:
             try: self.logger.err(f"Строка {idx1}: данные не сформированы — пропуск")
             except Exception: pass
             continue
-        enriched.append(enr)
-    return enriched
+        yield enr
 
 def _patch__print_range_one_job_via_csv(self):
     """
@@ -3710,32 +4361,104 @@ def _patch__print_range_one_job_via_csv(self):
     """
     self.cancel_requested = False
 
-    # 1) Собрать и записать tmp_batch.csv
-    rows = _patch__collect_range_rows(self)
-    if not rows:
+    # 0) Отбор строк и сверка его с журналом напечатанных DM
+    try:
+        sel = _patch__selection(self)
+    except ValueError as e:
         from tkinter import messagebox as mb
-        mb.showerror("Печать N шт", "Диапазон пуст — нечего печатать.")
+        mb.showerror("Отбор", str(e))
         return
+    try:
+        if not self._ledger_confirm((r.get("DM") for _, r in self._iter_selection(sel)), "Печать N шт", sel):
+            return
+    except Exception as e:
+        try: self.logger.err(f"Журнал DM: проверка не выполнена: {e}")
+        except Exception: pass
 
-    # всегда перезаписываем tmp перед печатью
+    # 1) Пакеты готовятся в фоне (Prefetcher): пока печатается пакет N, пакет N+1 обогащается
+    #    и пишется в tmp_batch.csv.<N+1>.next, а перед своей печатью подменяет tmp_batch.csv
+    #    (большой отбор обогащается колоночно, группами GTIN — и из хранилища, и из индекса файла)
     tmp_path = os.path.join("C:\\auto_print", "tmp_batch.csv")
+    # параметры обогащения снимаются с формы один раз на задание
+    need_date = self._csv_needs_prod_date(sel)
+    ctx = self._enrich_context(need_date=need_date)
+    # дата не введена/неверна — ошибка уже показана; иначе каждая строка отбора ушла бы в лог пропуском
+    if need_date and ctx.prod_date is None:
+        return
+    cols = list(getattr(self, "REQ_COLS", ["ShortName","ShortGTIN","EXP_DATE","PROD_DATE","PART_NUM","DM","NUM"]))
+    pack_size = _patch__pack_size(self)
+    if pack_size <= 0 or pack_size >= len(sel):
+        pack_size = len(sel)
+    packs = (len(sel) + pack_size - 1) // pack_size
+    calibrate = _patch__calib_enabled(self)
+    skip = self._ledger_blocked
+    # колоночному движку нужна дата у каждой строки — своя или общая
+    if _patch__columnar_ok(self, sel) and (ctx.prod_date or not need_date):
+        source = _patch__columnar_source(self)
+        self.logger.log(f"Пакеты обогащаются колоночно ({'numpy' if HAVE_NUMPY else 'python'}"
+                        f"{'' if isinstance(source, KonturRowStore) else ', из индекса файла'})")
+
+        def stage(item):
+            return prepare_column_batch((item[0], item[1].ranges), source, ctx, cols, tmp_path, calibrate, skip)
+    else:
+        def stage(item):
+            return prepare_row_batch((item[0], self._iter_selection(item[1])), ctx, cols, tmp_path, calibrate, skip)
+
+    prefetch = Prefetcher(enumerate(sel.chunks(pack_size), start=1), stage,
+                          depth=int(self.cfg.get("pipeline_depth", 1)))
+    pack_no = [0]
+
+    def _next_pack():
+        """Следующий подготовленный пакет, в котором есть что печатать; None — пакеты кончились или отмена."""
+        while True:
+            t0 = time.time()
+            batch = self._await_prefetched(prefetch)
+            if batch is None:
+                return None
+            pack_no[0] += 1
+            for num in batch.skipped:
+                self.logger.err(f"Строка {num}: данные не сформированы — пропуск")
+            if batch.written:
+                self.logger.log(f"[PACK] Пакет {pack_no[0]}/{packs} готов (строк={batch.written}, "
+                                f"ожидание {time.time() - t0:.2f} с)")
+                return batch
+            try:
+                _os.remove(batch.staged_path)
+            except OSError:
+                pass
+            self.logger.err(f"[PACK] Пакет {pack_no[0]}/{packs}: нет строк к печати — пропуск")
+
+    def _drop_packs():
+        prefetch.close()
+        discard_staged(tmp_path)
+
     try:
-        _patch__write_tmp_batch_rows(self, rows, tmp_path)
+        batch = _next_pack()
     except Exception as e:
+        _drop_packs()
         try: self.logger.err(f"Не удалось записать tmp_batch: {e}")
         except Exception: pass
         return
+    if batch is None:
+        _drop_packs()
+        if not self.cancel_requested:
+            from tkinter import messagebox as mb
+            mb.showerror("Печать N шт", "Диапазон пуст — нечего печатать.")
+        return
+    first = batch.first
 
     # 2) Определить формат и BTW (берём из первой строки)
-    fmt_name = rows[0].get("_FORMAT", "16x16")
+    fmt_name = first.get("_FORMAT", "16x16")
     btw = self._get_btw_for_format(fmt_name)
     if not btw:
+        _drop_packs()
         return
 
     # 3) Открыть BTW, залогировать NamedSubStrings и DB connections, НИЧЕГО НЕ ПЕРЕПРИВЯЗЫВАЯ
     try:
         fmt = self.bt.open_format(btw)
     except Exception as e:
+        _drop_packs()
         try: self.logger.err(f"Не удалось открыть BTW: {e}")
         except Exception: pass
         return
@@ -3758,6 +4481,7 @@ def _patch__print_range_one_job_via_csv(self):
     # 4) Запустить одно задание печати (через диалог или тихо) — БЕЗ перепривязки
     prn = self._get_printer()
     if not prn:
+        _drop_packs()
         try: fmt.Close(1)
         except Exception: pass
         return
@@ -3769,16 +4493,6 @@ def _patch__print_range_one_job_via_csv(self):
     try: fmt.PrintSetup.PrinterName = prn
     except Exception: pass
     # === CALIB & PACK (one-job, тихий путь) ===
-    do_cal = False
-    for name in ("calib_var","calibrate_var","calibration_var","calib_check","calibrate_check"):
-        v = getattr(self, name, None)
-        if v is None: continue
-        try:
-            do_cal = bool(v.get()); break
-        except Exception:
-            try: do_cal = bool(v); break
-            except Exception: pass
-
     if False:
         try:
             try:
@@ -3817,7 +4531,6 @@ def _patch__print_range_one_job_via_csv(self):
             fmt.PrintOut(True, True)
         else:
             self.logger.log("[INFO] ONE-JOB: печать пакетами с подтверждением")
-            import csv, time
             try:
                 import tkinter as _tk, tkinter.messagebox as _mb
             except Exception:
@@ -3826,231 +4539,88 @@ def _patch__print_range_one_job_via_csv(self):
             # Используем тот же путь, что и при записи tmp_batch.csv, чтобы избежать несоответствий
             master_csv = tmp_path
 
-            def _get_pack_size():
-                cands = ["batch_entry", "pack_n", "pack_by", "packet_by", "packet_size", "pack_var"]
-                for name in cands:
-                    try:
-                        v = getattr(self, name)
-                        val = int(v.get()) if hasattr(v, "get") else int(v)
-                        if val > 0:
-                            return val
-                    except Exception:
-                        pass
-                return 0
-
-            pack_size = _get_pack_size()
-
+            # Учитываем «Одно задание»: подтверждать пакеты только если выключено
+            one_job = False
             try:
-                with open(master_csv, "r", encoding="utf-8-sig", newline="") as rf:
-                    rdr = csv.reader(rf, delimiter=",", quotechar='"')
-                    rows_all = list(rdr)
-            except FileNotFoundError:
-                self.logger.err(f"tmp_batch.csv не найден: {master_csv}")
-                if _mb:
-                    _mb.showerror("tmp_batch.csv", f"Файл не найден:\n{master_csv}")
-                return
+                one_job = bool(self.single_job_var.get())
+            except Exception:
+                try:
+                    one_job = bool(self.single_job_var)
+                except Exception:
+                    one_job = False
 
-            if not rows_all:
-                self.logger.err("tmp_batch.csv пуст")
-            else:
-                header = rows_all[0]
-                data_rows = rows_all[1:]
-                total = len(data_rows)
-                if pack_size <= 0 or pack_size >= total:
-                    pack_size = total
-
-                packs = (total + pack_size - 1) // pack_size
-                for p in range(packs):
-                    s = p * pack_size
-                    e = min(total, s + pack_size)
-                    chunk = data_rows[s:e]
-
-
-                    # --- CSV-CAL: если галка включена и это первый батч — добавим 6 'X' строк в начало ---
-                    def __x6_cal_enabled_any(self):
-                        # Явно читаем известные имена чекбокса калибровки
-                        names = ('calib_var','calibrate_var','calibration_var','calib_check','calibrate_check','calib_chk')
-                        for _n in names:
-                            try:
-                                v = getattr(self, _n, None)
-                                if v is None:
-                                    continue
-                                v = v.get() if hasattr(v, 'get') else v
-                                if bool(v):
-                                    return True
-                            except Exception:
-                                pass
-                        return False
+            _show_dialog = False
+            try:
+                _show_dialog = bool(self.show_dialog_var.get())
+            except Exception:
+                try: _show_dialog = bool(self.default_show_dialog)
+                except Exception: _show_dialog = False
+
+            while batch is not None:
+                p = pack_no[0] - 1
+                # Подставить подготовленный пакет на место tmp_batch.csv (калибровочные 'X' уже в начале)
+                _os.replace(batch.staged_path, master_csv)
+                rows_in_file = batch.written + batch.calibration
+                try:
+                    if batch.calibration:
+                        self.logger.log(f"CSV-CAL: {batch.calibration} строк 'X' в начале файла пакета")
+                    self.logger.log(f"[PACK] tmp_batch.csv → пакет {p+1}/{packs}, строк {batch.written}")
+                except Exception:
+                    pass
 
-                    do_cal = __x6_cal_enabled_any(self)
-                    add_x6 = bool(do_cal and len(chunk) > 0)
+                # Перепривязать БД и включить печать из БД
+                try:
+                    self._rangecsv_repoint_db(fmt, master_csv)
+                except Exception as _e:
+                    try: self.logger.err(f"Rebind DB failed: {_e}")
+                    except Exception: pass
+                try: fmt.UseDatabase = True
+                except Exception: pass
+                try: fmt.SelectRecordsAtPrint = False
+                except Exception: pass
+                try: fmt.RecordRange = f"1-{rows_in_file}"
+                except Exception: pass
 
-                    # Готовим калибровочную строку в формате текущего header
-                    cal_rows = []
-                    if add_x6:
-                        # индекс поля _FORMAT, если есть
-                        fmt_idx = None
-                        try:
-                            fmt_idx = header.index("_FORMAT")
-                        except Exception:
-                            fmt_idx = None
-                        fmt0 = None
-                        try:
-                            if fmt_idx is not None and data_rows:
-                                fmt0 = data_rows[0][fmt_idx] or "16x16"
-                        except Exception:
-                            fmt0 = "16x16"
-                        # Собираем строку X под каждое имя колонки
-                        def __x6_build_row():
-                            rowx = []
-                            for col in header:
-                                if col.upper() == "NUM":
-                                    rowx.append("1")
-                                elif col == "ShortGTIN":
-                                    rowx.append("000")
-                                elif col == "_FORMAT":
-                                    rowx.append(fmt0 or "16x16")
-                                else:
-                                    rowx.append("X")
-                            return rowx
-                        cal_rows = [__x6_build_row() for _ in range(6)]
-                        try: self.logger.log("CSV-CAL: добавлю 6 'X' в файл батча (только для первого пакета)")
-                        except Exception: pass
-                    # --- END CSV-CAL ---
-                    # Перезаписать CSV текущим батчем
-                    with open(master_csv, "w", encoding="utf-8-sig", newline="") as wf:
-                        w = csv.writer(wf, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL)
-                        w.writerow(header)
-                        for row in cal_rows:
-                            w.writerow(row)
-                        for row in chunk:
-                            w.writerow(row)
+                # Печать с ожиданием спулера (чтоб пакеты не слиплись); следующий пакет
+                # в это время готовится в фоне
+                try:
+                    res = fmt.PrintOut(False, True) if self._dialog_flag() else fmt.PrintOut(False, False)
+                except TypeError:
+                    res = fmt.PrintOut(int(copies), _show_dialog)
+                    time.sleep(2)
+                # в журнал — только реально отправленный пакет (отмена диалога печати даёт btFailure)
+                if not print_succeeded(res):
+                    self.logger.err(f"[PACK] Пакет {p+1}/{packs} не напечатан (PrintOut={res}) — DM в журнал не записаны")
+                else:
+                    with open(master_csv, "r", encoding="utf-8-sig", newline="") as rf:
+                        rdr = csv.reader(rf, delimiter=",", quotechar='"')
+                        header = next(rdr, None) or []
+                        if "DM" in header:
+                            dm_col = header.index("DM")
+                            self._ledger_record(row[dm_col] for row in rdr if len(row) > dm_col)
+
+                # Подтверждение между батчами (кроме последнего)
+                if p < packs - 1 and not one_job:
+                    cont = True
                     try:
-                        self.logger.log(f"[PACK] tmp_batch.csv → строки {s+1}-{e} из {total}")
+                        if _mb is not None:
+                            cont = _mb.askyesno("Печать пакетами",
+                                                f"Батч {p+1}/{packs} напечатан.\nПродолжить следующий?",
+                                                parent=self)
                     except Exception:
                         pass
-
-                    # Перепривязать БД и включить печать из БД
-                    try:
-                        self._rangecsv_repoint_db(fmt, master_csv)
-                    except Exception as _e:
-                        try: self.logger.err(f"Rebind DB failed: {_e}")
+                    if not cont:
+                        try: self.logger.log("[PACK] Пользователь остановил печать батчей.")
                         except Exception: pass
-                    try: fmt.UseDatabase = True
-                    except Exception: pass
-                    try: fmt.SelectRecordsAtPrint = False
-                    except Exception: pass
-                    try:
-                        _do_cal = False
-                        try:
-                            names = ('calib_var','calibrate_var','calibration_var','calib_check','calibrate_check','calib_chk')
-                            _do_cal = False
-                            for _n in names:
-                                try:
-                                    _v = getattr(self, _n, None)
-                                    if _v is None:
-                                        continue
-                                    _v = _v.get() if hasattr(_v, 'get') else _v
-                                    if bool(_v):
-                                        _do_cal = True
-                                        break
-                                except Exception:
-                                    pass
-                        except Exception:
-                            pass
-                        if _do_cal:
-                            fmt.RecordRange = f"1-{len(chunk)+6}"
-                        else:
-                            fmt.RecordRange = f"1-{len(chunk)}"
-                    except Exception: pass
-
-                    # --- КАЛИБРОВКА: перед КАЖДЫМ батчем, если включена галочка ---
-
-                    do_cal = False
-
-                    for _name in ('calib_var','calibrate_var','calibration_var','calib_check','calibrate_check'):
-
-                        _v = getattr(self, _name, None)
-
-                        if _v is None: continue
-
-                        try:
-
-                            do_cal = bool(_v.get()); break
-
-                        except Exception:
-
-                            try: do_cal = bool(_v); break
-
-                            except Exception: pass
-
-                    if False:
-                        try:
-
-                            if self.logger: self.logger.log(f"КАЛИБРОВКА: батч {p+1}/{packs} — печатаю 6 тестовых этикеток 'X'…")
-
-                        except Exception: pass
-
-                        try:
-
-                            _calibrate_fmt_safely(self, fmt)
-
-                        except Exception as _e:
-
-                            try:
-
-                                if self.logger: self.logger.err(f"КАЛИБРОВКА: сбой — {_e}")
-
-                            except Exception: pass
-
-
-                    _show_dialog = False
-
-                    try:
-
-                        _show_dialog = bool(self.show_dialog_var.get())
-
-                    except Exception:
-
-                        try: _show_dialog = bool(self.default_show_dialog)
-
-                        except Exception: _show_dialog = False
-
-                    # Печать с ожиданием спулера (чтоб пакеты не слиплись)
-                    try:
-                        fmt.PrintOut(False, True) if self._dialog_flag() else fmt.PrintOut(False, False)
-                    except TypeError:
-                        fmt.PrintOut(int(copies), _show_dialog)
-                        time.sleep(2)
-
-                    # Подтверждение между батчами (кроме последнего)
-                    # Учитываем «Одно задание»: подтверждать только если выключено
-                    one_job = False
-                    try:
-                        one_job = bool(self.single_job_var.get())
-                    except Exception:
-                        try:
-                            one_job = bool(self.single_job_var)
-                        except Exception:
-                            one_job = False
-                    if p < packs - 1 and not one_job:
-                        cont = True
-                        try:
-                            if _mb is not None:
-                                cont = _mb.askyesno("Печать пакетами",
-                                                    f"Батч {p+1}/{packs} ({s+1}-{e}, parent=self) напечатан.\nПродолжить следующий?")
-                        except Exception:
-                            pass
-                        if not cont:
-                            try: self.logger.log("[PACK] Пользователь остановил печать батчей.")
-                            except Exception: pass
-                            break
+                        break
+                batch = _next_pack()
         self.logger.log("ONE-JOB OK")
     except Exception as e:
         self.logger.err(f"ONE-JOB печать провалилась: {e}\n{_tb.format_exc()}")
     finally:
         try: fmt.Close(1)
         except Exception: pass
+        _drop_packs()
 
 def _patch__print_one_pdf_dialog(self):
     """
@@ -4060,9 +4630,10 @@ def _patch__print_one_pdf_dialog(self):
     # 0) Всегда обновим tmp_batch по текущему диапазону — чтобы 30x20/16x16 были в свежем состоянии
     try:
         rows = _patch__collect_range_rows(self)
-        if rows:
+        first = next(rows, None)
+        if first is not None:
             tmp_path = os.path.join("C:\\auto_print", "tmp_batch.csv")
-            _patch__write_tmp_batch_rows(self, rows, tmp_path)
+            _patch__write_tmp_batch_rows(self, chain([first], rows), tmp_path)
     except Exception:
         pass
 
@@ -4083,22 +4654,19 @@ def _patch__print_one_pdf_dialog(self):
         mb.showerror("Печать", "Некорректные индекс/копии")
         return
 
-    # ensure csv rows
-    if not getattr(self, "csv_rows", None):
-        try:
-            if getattr(self, "csv_path", ""):
-                from __main__ import load_kontur_raw as _load_kontur_raw
-                self.csv_rows = _load_kontur_raw(self.csv_path)
-        except Exception as e:
-            try: self.logger.err(f"CSV ошибка: {e}")
-            except Exception: pass
-            return
-    if not self.csv_rows:
+    # строка читается из CSV точечно, без загрузки всего файла
+    try:
+        total_rows = self._csv_total() if getattr(self, "csv_path", "") else 0
+        base = self._csv_row(max(1, min(idx, total_rows))) if total_rows else None
+    except Exception as e:
+        try: self.logger.err(f"CSV ошибка: {e}")
+        except Exception: pass
+        return
+    if not base:
         from tkinter import messagebox as mb
         mb.showerror("CSV", "Нет данных")
         return
 
-    base = self.csv_rows[max(1, min(idx, len(self.csv_rows))) - 1]
     enr = self._enrich(base, idx)
     if not enr:
         return
@@ -4389,6 +4957,8 @@ def _x6__write_tmp_batch_csv(self, rows_enriched, path=os.path.join(BASE_DIR, "t
         w = csv.DictWriter(f, fieldnames=cols, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL)
         w.writeheader()
         for enr in rows_enriched or []:
+            if self._ledger_blocked(enr.get("DM")):
+                continue
             w.writerow({k: (enr.get(k, "") or "") for k in cols})
     try:
         self.logger.log(f"tmp_batch.csv записан: {path} (строк={len(rows_enriched or [])})")
@@ -0,0 +1,116 @@
+"""On-disk cache of parsed kontur files, kept in the app config dir."""
+from __future__ import annotations
+
+import hashlib
+import os
+from typing import List, Optional, Tuple
+
+from .config import _cfg_dir
+from .row_store import KonturRowStore
+
+CACHE_DIR_NAME = "kontur_cache"
+CACHE_SUFFIX = ".krs"
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# сколько байт из начала, середины и конца файла попадает в хэш содержимого
+_SAMPLE = 64 * 1024
+
+
+def kontur_cache_key(path: str) -> str:
+    """Key of a file version: size, mtime and a hash of sampled content.
+
+    Sampling the head, middle and tail keeps the key cheap on slow network
+    drives; together with size and mtime it changes on any rewrite.
+    """
+    st = os.stat(path)
+    h = hashlib.blake2b(f"{st.st_size}:{st.st_mtime_ns}".encode("ascii"), digest_size=20)
+    with open(path, "rb") as f:
+        for pos in (0, max(0, st.st_size // 2 - _SAMPLE // 2), max(0, st.st_size - _SAMPLE)):
+            f.seek(pos)
+            h.update(f.read(_SAMPLE))
+    return h.hexdigest()
+
+
+class KonturCache:
+    """Parsed ``KonturRowStore`` snapshots, one file per key.
+
+    The total size of the cache dir is bounded by ``max_bytes``; the least
+    recently used entries (by file mtime, refreshed on every hit) go first.
+    """
+
+    def __init__(self, base_dir: Optional[str] = None, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        self.dir = os.path.join(base_dir or _cfg_dir(), CACHE_DIR_NAME)
+        self.max_bytes = max_bytes
+        os.makedirs(self.dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.dir, key + CACHE_SUFFIX)
+
+    def get(self, key: str) -> Optional[KonturRowStore]:
+        p = self._path(key)
+        try:
+            with open(p, "rb") as f:
+                store = KonturRowStore.from_bytes(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            self._remove(p)
+            return None
+        try:
+            os.utime(p)
+        except OSError:
+            pass
+        return store
+
+    def put(self, key: str, store: KonturRowStore) -> bool:
+        data = store.to_bytes()
+        if len(data) > self.max_bytes:
+            return False
+        p = self._path(key)
+        tmp = p + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, p)
+        except OSError:
+            self._remove(tmp)
+            return False
+        self.evict()
+        return True
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        out = []
+        for name in os.listdir(self.dir):
+            if not name.endswith(CACHE_SUFFIX):
+                continue
+            p = os.path.join(self.dir, name)
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            out.append((st.st_mtime, st.st_size, p))
+        return out
+
+    def evict(self) -> int:
+        """Drop least recently used entries until the cache fits; returns how many were removed."""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, p in entries:
+            if total <= self.max_bytes:
+                break
+            if self._remove(p):
+                total -= size
+                removed += 1
+        return removed
+
+    def clear(self) -> None:
+        for _, _, p in self._entries():
+            self._remove(p)
+
+    @staticmethod
+    def _remove(p: str) -> bool:
+        try:
+            os.remove(p)
+            return True
+        except OSError:
+            return False
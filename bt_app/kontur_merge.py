@@ -0,0 +1,69 @@
+"""Merging several kontur files into one logical row stream."""
+from __future__ import annotations
+
+import csv
+import os
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .data_io import iter_kontur_raw
+from .ledger import KeySet, dm_key
+
+# сколько повторов запоминать для отчёта (файл, номер строки в файле)
+_DUP_SAMPLES = 20
+
+
+@dataclass
+class MergeReport:
+    """What ``iter_kontur_merged`` saw; filled while the stream is consumed."""
+    rows: int = 0
+    per_file: List[Tuple[str, int]] = field(default_factory=list)
+    duplicates: int = 0
+    duplicate_samples: List[Tuple[str, int]] = field(default_factory=list)
+
+
+def iter_kontur_merged(paths: Iterable[str], drop_duplicates: bool = True,
+                       report: Optional[MergeReport] = None) -> Iterator[Dict[str, str]]:
+    """Stream the rows of several kontur files back to back.
+
+    A DM seen in an earlier file (or earlier in the same file) is counted in
+    ``report`` and, with ``drop_duplicates``, left out of the stream. Only a
+    64-bit key per DM is kept, in a ``KeySet``, never the rows themselves.
+    """
+    report = report if report is not None else MergeReport()
+    seen = KeySet()
+    for path in paths:
+        kept = 0
+        for n, row in enumerate(iter_kontur_raw(path), 1):
+            if not seen.add(dm_key(row["DM"])):
+                report.duplicates += 1
+                if len(report.duplicate_samples) < _DUP_SAMPLES:
+                    report.duplicate_samples.append((path, n))
+                if drop_duplicates:
+                    continue
+            kept += 1
+            report.rows += 1
+            yield row
+        report.per_file.append((path, kept))
+
+
+def write_kontur_merged(paths: Iterable[str], out_path: str, drop_duplicates: bool = True) -> MergeReport:
+    """Write the merged stream as one kontur TSV (atomically) and return the report."""
+    report = MergeReport()
+    tmp = out_path + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8-sig", newline="") as f:
+            w = csv.writer(f, delimiter="\t", quotechar='"', lineterminator="\n")
+            # с этим заголовком 4-я колонка читается как дата производства строки
+            w.writerow(["DM", "GTIN", "NAME", "PROD_DATE"])
+            for row in iter_kontur_merged(paths, drop_duplicates, report):
+                pd = row.get("PROD_DATE")
+                w.writerow((row["DM"], row["GTIN"], row["NAME"]) + ((pd,) if pd else ()))
+        os.replace(tmp, out_path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    return report
@@ -0,0 +1,379 @@
+"""Persistent ledger of printed DM codes with a memory-mapped hash index."""
+from __future__ import annotations
+
+import hashlib
+import mmap
+import os
+import struct
+import threading
+from array import array
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator, Optional
+
+from .config import _cfg_dir
+
+LEDGER_NAME = "printed_dm.log"
+INDEX_NAME = "printed_dm.idx"
+
+_MAGIC = b"BTDMIX1\0"
+# magic, ёмкость (степень 2), число ключей, сколько байт журнала уже в индексе
+_HEADER = struct.Struct("<8sQQQ")
+_INITIAL_CAPACITY = 1 << 20
+_MAX_LOAD = 0.5
+
+
+def dm_key(dm: str) -> int:
+    """64-bit key of a DM code (0 is reserved for empty hash slots)."""
+    k = int.from_bytes(hashlib.blake2b(dm.encode("utf-8"), digest_size=8).digest(), "little")
+    return k or 1
+
+
+class KeySet:
+    """In-memory set of nonzero 64-bit keys: open addressing over one ``array('Q')``.
+
+    The same table as the ledger index, without the file: 16 bytes per key
+    at the 0.5 load limit, where a ``set`` of ints costs about 78.
+    """
+
+    def __init__(self, capacity: int = 1 << 16) -> None:
+        self.capacity = max(16, 1 << (capacity - 1).bit_length())
+        self._slots = array("Q", [0]) * self.capacity
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __contains__(self, key: int) -> bool:
+        slots, mask = self._slots, self.capacity - 1
+        i = key & mask
+        while True:
+            v = slots[i]
+            if v == key:
+                return True
+            if not v:
+                return False
+            i = (i + 1) & mask
+
+    def add(self, key: int) -> bool:
+        """Insert a key; False when it was already there."""
+        if (self.count + 1) > self.capacity * _MAX_LOAD:
+            self._grow()
+        slots, mask = self._slots, self.capacity - 1
+        i = key & mask
+        while True:
+            v = slots[i]
+            if v == key:
+                return False
+            if not v:
+                slots[i] = key
+                self.count += 1
+                return True
+            i = (i + 1) & mask
+
+    def _grow(self) -> None:
+        old = self._slots
+        self.capacity *= 2
+        slots = self._slots = array("Q", [0]) * self.capacity
+        mask = self.capacity - 1
+        for k in old:
+            if k:
+                i = k & mask
+                while slots[i]:
+                    i = (i + 1) & mask
+                slots[i] = k
+
+
+@dataclass
+class LedgerReport:
+    """Result of checking a sequence of DM codes against the ledger.
+
+    Positions are 0-based indexes into the checked sequence. ``mark`` is the
+    ledger log size when the check began: codes printed later are read with
+    ``codes_since(mark)``.
+    """
+    total: int = 0
+    printed: array = field(default_factory=lambda: array("I"))
+    duplicates: array = field(default_factory=lambda: array("I"))
+    mark: int = 0
+
+
+class PrintedLedger:
+    """Append-only log of printed DM codes plus an on-disk open-addressing index.
+
+    The log (one code per line) is the source of truth; the index is an
+    mmap-ed table of 64-bit code hashes with linear probing, so membership
+    checks are O(1) and do not need the history in RAM. A missing or stale
+    index is rebuilt/replayed from the log on open.
+
+    The public methods are thread-safe: batch preparation checks codes from a
+    worker thread while the GUI thread records printed ones, and growing the
+    index remaps the table under the reader's feet.
+    """
+
+    def __init__(self, base_dir: str):
+        self.base_dir = base_dir
+        self.log_path = os.path.join(base_dir, LEDGER_NAME)
+        self.idx_path = os.path.join(base_dir, INDEX_NAME)
+        self._fh = None
+        self._mm: Optional[mmap.mmap] = None
+        self._slots = None
+        self.capacity = 0
+        self.count = 0
+        self._log_size = 0
+        self._lock = threading.RLock()
+
+    @classmethod
+    def open(cls, base_dir: Optional[str] = None) -> "PrintedLedger":
+        led = cls(base_dir or _cfg_dir())
+        os.makedirs(led.base_dir, exist_ok=True)
+        led._trim_partial_line()
+        if not led._map_index():
+            led._create_index(_INITIAL_CAPACITY)
+        led._replay_log()
+        return led
+
+    # ---------- индексный файл ----------
+
+    def _map_index(self) -> bool:
+        try:
+            with open(self.idx_path, "rb") as f:
+                magic, capacity, count, log_size = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != _MAGIC or capacity & (capacity - 1):
+                return False
+            if os.path.getsize(self.idx_path) != _HEADER.size + capacity * 8:
+                return False
+        except (OSError, struct.error):
+            return False
+        self._fh = open(self.idx_path, "r+b")
+        self._mm = mmap.mmap(self._fh.fileno(), 0)
+        self._slots = memoryview(self._mm)[_HEADER.size:].cast("Q")
+        self.capacity, self.count, self._log_size = capacity, count, log_size
+        return True
+
+    def _unmap(self) -> None:
+        if self._slots is not None:
+            self._slots.release()
+            self._slots = None
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def _create_index(self, capacity: int, log_size: int = 0) -> None:
+        self._unmap()
+        tmp = self.idx_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, capacity, 0, log_size))
+            f.truncate(_HEADER.size + capacity * 8)
+        os.replace(tmp, self.idx_path)
+        self._map_index()
+
+    def _write_header(self) -> None:
+        self._mm[:_HEADER.size] = _HEADER.pack(_MAGIC, self.capacity, self.count, self._log_size)
+
+    def _grow(self) -> None:
+        """Double the table, rehashing slot by slot from the old mapping into the new file."""
+        capacity = self.capacity * 2
+        mask = capacity - 1
+        tmp = self.idx_path + ".tmp"
+        with open(tmp, "w+b") as f:
+            f.write(_HEADER.pack(_MAGIC, capacity, self.count, self._log_size))
+            f.truncate(_HEADER.size + capacity * 8)
+            mm = mmap.mmap(f.fileno(), 0)
+            slots = memoryview(mm)[_HEADER.size:].cast("Q")
+            try:
+                for k in self._slots:
+                    if k:
+                        i = k & mask
+                        while slots[i]:
+                            i = (i + 1) & mask
+                        slots[i] = k
+            finally:
+                slots.release()
+                mm.flush()
+                mm.close()
+        self._unmap()
+        os.replace(tmp, self.idx_path)
+        self._map_index()
+
+    def _insert(self, key: int) -> bool:
+        slots, mask = self._slots, self.capacity - 1
+        i = key & mask
+        while True:
+            v = slots[i]
+            if v == key:
+                return False
+            if not v:
+                slots[i] = key
+                self.count += 1
+                return True
+            i = (i + 1) & mask
+
+    def _contains_key(self, key: int) -> bool:
+        slots, mask = self._slots, self.capacity - 1
+        i = key & mask
+        while True:
+            v = slots[i]
+            if v == key:
+                return True
+            if not v:
+                return False
+            i = (i + 1) & mask
+
+    def _trim_partial_line(self) -> None:
+        """Cut an unterminated last line (a write cut short by a crash) off the log.
+
+        Otherwise the next append would be glued to it and the new code would
+        be lost from the log, though not from the index.
+        """
+        try:
+            f = open(self.log_path, "r+b")
+        except OSError:
+            return
+        with f:
+            size = f.seek(0, os.SEEK_END)
+            pos = size
+            while pos > 0:
+                step = min(4096, pos)
+                f.seek(pos - step)
+                chunk = f.read(step)
+                nl = chunk.rfind(b"\n")
+                if nl >= 0:
+                    pos = pos - step + nl + 1
+                    break
+                pos -= step
+            if pos < size:
+                f.truncate(pos)
+
+    def _replay_log(self) -> None:
+        """Add log lines written after the index was last synced (e.g. after a crash)."""
+        try:
+            size = os.path.getsize(self.log_path)
+        except OSError:
+            size = 0
+        if size < self._log_size:
+            # журнал подменили/обрезали — индекс больше ему не соответствует
+            self._create_index(self.capacity or _INITIAL_CAPACITY)
+        if size == self._log_size:
+            return
+        with open(self.log_path, "rb") as f:
+            f.seek(self._log_size)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                dm = line.rstrip(b"\r\n").decode("utf-8")
+                if dm:
+                    self._add_key(dm_key(dm))
+                self._log_size += len(line)
+        self._write_header()
+
+    def _add_key(self, key: int) -> bool:
+        if (self.count + 1) > self.capacity * _MAX_LOAD:
+            self._grow()
+        return self._insert(key)
+
+    # ---------- публичный API ----------
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __contains__(self, dm: str) -> bool:
+        if not dm:
+            return False
+        k = dm_key(dm)
+        with self._lock:
+            return self._contains_key(k)
+
+    def add(self, dm: str) -> bool:
+        return self.add_many([dm]) == 1
+
+    def add_many(self, dms: Iterable[str]) -> int:
+        """Record printed codes; returns how many were new. The log is written first."""
+        with self._lock:
+            new = []
+            seen = set()
+            for dm in dms:
+                if not dm:
+                    continue
+                k = dm_key(dm)
+                if k in seen or self._contains_key(k):
+                    continue
+                seen.add(k)
+                new.append(dm)
+            if not new:
+                return 0
+            data = "".join(dm + "\n" for dm in new).encode("utf-8")
+            with open(self.log_path, "ab") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            for dm in new:
+                self._add_key(dm_key(dm))
+            self._log_size += len(data)
+            self._write_header()
+            return len(new)
+
+    def check(self, dms: Iterable[str]) -> LedgerReport:
+        """Find codes already in the ledger and codes repeated within ``dms`` itself."""
+        rep = LedgerReport()
+        seen = KeySet(1024)
+        with self._lock:
+            rep.mark = self._log_size
+            contains = self._contains_key
+            for pos, dm in enumerate(dms):
+                rep.total += 1
+                if not dm:
+                    continue
+                k = dm_key(dm)
+                if contains(k):
+                    rep.printed.append(pos)
+                if not seen.add(k):
+                    rep.duplicates.append(pos)
+        return rep
+
+    def printed(self, dms: Iterable[str], start: int = 0) -> array:
+        """Positions (counted from ``start``) of the codes in ``dms`` that are already in the ledger."""
+        out = array("I")
+        with self._lock:
+            contains = self._contains_key
+            for pos, dm in enumerate(dms, start):
+                if dm and contains(dm_key(dm)):
+                    out.append(pos)
+        return out
+
+    def mark(self) -> int:
+        """Current end of the log, for a later ``codes_since``."""
+        with self._lock:
+            return self._log_size
+
+    def codes_since(self, mark: int) -> Iterator[str]:
+        """Codes recorded after ``mark`` (a ``mark()`` value), in log order."""
+        with self._lock:
+            end = self._log_size
+        if end <= mark:
+            return
+        # журнал только дописывается: байты до end уже не изменятся
+        with open(self.log_path, "rb") as f:
+            f.seek(mark)
+            left = end - mark
+            for line in f:
+                left -= len(line)
+                dm = line.rstrip(b"\r\n").decode("utf-8")
+                if dm:
+                    yield dm
+                if left <= 0:
+                    break
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._mm is not None:
+                self._mm.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._mm is not None:
+                self._write_header()
+                self._mm.flush()
+            self._unmap()
@@ -1,8 +1,9 @@
 """Simple data models for label processing."""
 from __future__ import annotations
 
+import datetime as dt
 from dataclasses import dataclass, field
-from typing import Dict, Optional
+from typing import Dict, Mapping, Optional
 
 
 @dataclass
@@ -39,6 +40,21 @@ class ProductInfo:
     SHORTNAME: str = ""
 
 
+@dataclass(frozen=True)
+class EnrichContext:
+    """Enrichment parameters of one print job, read from the form once at job start.
+
+    ``prod_date`` is None when the field is empty or invalid; rows without
+    their own PROD_DATE are then skipped. ``manual_part`` is None while the
+    batch number is generated automatically.
+    """
+    prod_date: Optional[dt.date]
+    exp_days: Optional[int]
+    mode_choice: str
+    manual_part: Optional[str]
+    product_map: Mapping[str, Dict[str, object]]
+
+
 @dataclass
 class AppConfig:
     batch_size: int = 1830
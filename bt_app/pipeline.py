@@ -0,0 +1,221 @@
+"""Background preparation of print batches, running ahead of the printer.
+
+``Prefetcher`` runs a stage in a worker thread and hands its results to the
+consumer in order through a bounded queue: once ``depth`` results are
+waiting, the worker blocks until the consumer takes one, so memory stays
+bounded however slow printing is. ``prepare_row_batch`` and
+``prepare_column_batch`` are the stages of the print-range path: enrich one
+pack and stream it into a staged tmp_batch file, without keeping its rows,
+that the print loop swaps in when the pack's turn comes. The columnar one
+reads either a ``KonturRowStore`` or, for files too big for one, a
+``KonturRowIndex`` piece by piece.
+"""
+from __future__ import annotations
+
+import csv
+import os
+import queue
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+from .data_io import iter_chunks
+from .enrich_np import enrich_columns
+from .enrich_pool import enrich_chunk
+from .models import EnrichContext
+from .row_index import KonturRowIndex
+from .row_store import KonturRowStore
+
+# сколько строк-«X» печатается перед пакетом при калибровке
+CALIBRATION_ROWS = 6
+# строк на один вызов колоночного движка (из индекса — и на одно временное хранилище)
+COLUMN_CHUNK_ROWS = 200000
+
+
+class Prefetcher:
+    """Applies ``stage`` to ``items`` in a daemon thread, at most ``depth`` results ahead.
+
+    An exception raised by the stage is re-raised from ``get`` in the
+    consumer; the items after it are not processed.
+    """
+
+    def __init__(self, items: Iterable, stage: Callable, depth: int = 1) -> None:
+        self._q: "queue.Queue[Tuple[bool, object]]" = queue.Queue(maxsize=max(1, depth))
+        self._stop = threading.Event()
+        self._done = False
+        self._thread = threading.Thread(target=self._run, args=(iter(items), stage),
+                                        name="batch-prefetch", daemon=True)
+        self._thread.start()
+
+    def _run(self, it, stage) -> None:
+        try:
+            for item in it:
+                if self._stop.is_set() or not self._put((True, stage(item))):
+                    return
+        except BaseException as e:
+            self._put((False, e))
+            return
+        self._put((True, None))
+
+    def _put(self, msg) -> bool:
+        # ждём места в очереди, но не дольше, чем до close()
+        while not self._stop.is_set():
+            try:
+                self._q.put(msg, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, timeout: Optional[float] = None):
+        """Next result; None once the items are exhausted. Raises ``queue.Empty`` on timeout."""
+        if self._done:
+            return None
+        ok, value = self._q.get(timeout=timeout)
+        if not ok:
+            self._done = True
+            raise value
+        if value is None:
+            self._done = True
+        return value
+
+    def close(self) -> None:
+        """Stop the worker; results not taken yet are dropped."""
+        self._stop.set()
+        try:
+            while True:
+                self._q.get_nowait()
+        except queue.Empty:
+            pass
+        self._thread.join(timeout=5)
+
+
+@dataclass
+class PreparedBatch:
+    # подготовленный tmp_batch, ещё не подставленный на место рабочего
+    staged_path: str
+    # строк данных в файле (без калибровочных и без отсеянных skip)
+    written: int
+    # первая сформированная строка пакета (по ней выбирается формат)
+    first: Optional[dict]
+    # калибровочных строк в начале файла
+    calibration: int = 0
+    # номера строк, которые не удалось сформировать
+    skipped: List[int] = field(default_factory=list)
+
+
+def calibration_rows(cols: Sequence[str], fmt: str) -> List[Dict[str, str]]:
+    """The dummy 'X' rows printed ahead of a batch while calibrating."""
+    dummy = {k: ("1" if k.upper() == "NUM" else ("000" if k == "ShortGTIN" else "X")) for k in cols}
+    dummy["_FORMAT"] = fmt
+    return [dummy.copy() for _ in range(CALIBRATION_ROWS)]
+
+
+def prepare_row_batch(item: Tuple[int, Iterable[Tuple[int, Dict[str, str]]]], ctx: EnrichContext,
+                      cols: Sequence[str], tmp_path: str, calibrate: bool = False,
+                      skip: Optional[Callable[[str], bool]] = None, chunk_rows: int = 5000) -> PreparedBatch:
+    """Stage for ``Prefetcher``: ``(pack number, (row number, row) pairs)`` → ``PreparedBatch``.
+
+    Rows are read and enriched ``chunk_rows`` at a time and streamed into
+    the staged file, not kept. Touches no GUI state, so it is safe to run
+    in the worker thread.
+    """
+    bidx, pairs = item
+    staged = f"{tmp_path}.{bidx}.next"
+    written, first, skipped, cal = 0, None, [], 0
+    os.makedirs(os.path.dirname(staged), exist_ok=True)
+    with open(staged, "w", encoding="utf-8-sig", newline="") as f:
+        w = csv.writer(f, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        w.writerow(cols)
+        for chunk in iter_chunks(pairs, chunk_rows):
+            nums = [n for n, _ in chunk]
+            out = enrich_chunk(ctx, [r for _, r in chunk], nums)
+            skipped.extend(n for n, e in zip(nums, out) if not e)
+            keep = [e for e in out if e]
+            if first is None and keep:
+                first = keep[0]
+                if calibrate:
+                    cal_rows = calibration_rows(cols, first.get("_FORMAT") or "16x16")
+                    w.writerows([r.get(c, "") for c in cols] for r in cal_rows)
+                    cal = len(cal_rows)
+            if skip is not None:
+                keep = [e for e in keep if not skip(e.get("DM"))]
+            w.writerows([e.get(c, "") or "" for c in cols] for e in keep)
+            written += len(keep)
+    return PreparedBatch(staged, written, first, cal, skipped)
+
+
+def _column_pieces(source: Union[KonturRowStore, KonturRowIndex], start: int, stop: int,
+                   chunk_rows: int) -> Iterator[Tuple[KonturRowStore, int, int, int]]:
+    """``(store, start, stop, NUM of start)`` pieces of file rows ``[start, stop)``.
+
+    Rows of an index are parsed straight into the columns of a temporary
+    store, one piece at a time.
+    """
+    for s in range(start, stop, chunk_rows):
+        e = min(stop, s + chunk_rows)
+        if isinstance(source, KonturRowStore):
+            yield source, s, e, s + 1
+        else:
+            part = KonturRowStore()
+            part.extend_columns(*source.columns(s, e - s))
+            yield part, 0, len(part), s + 1
+
+
+def prepare_column_batch(item: Tuple[int, List[Tuple[int, int]]],
+                         source: Union[KonturRowStore, KonturRowIndex], ctx: EnrichContext,
+                         cols: Sequence[str], tmp_path: str, calibrate: bool = False,
+                         skip: Optional[Callable[[str], bool]] = None,
+                         chunk_rows: int = COLUMN_CHUNK_ROWS) -> PreparedBatch:
+    """``prepare_row_batch`` for ``(pack number, [(start, stop), ...])`` file row ranges.
+
+    Rows come from a store or a row index and are enriched with
+    ``enrich_columns``, so the caller must make sure every row has a
+    production date (its own or ``ctx.prod_date``).
+    """
+    bidx, ranges = item
+    staged = f"{tmp_path}.{bidx}.next"
+    written, first, skipped, cal = 0, None, [], 0
+    os.makedirs(os.path.dirname(staged), exist_ok=True)
+    with open(staged, "w", encoding="utf-8-sig", newline="") as f:
+        w = csv.writer(f, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        w.writerow(cols)
+        for store, start, stop, num in (piece for s, e in ranges
+                                        for piece in _column_pieces(source, s, e, chunk_rows)):
+            data = enrich_columns(store, start, stop, ctx.prod_date, ctx.exp_days,
+                                  ctx.product_map, ctx.mode_choice, first_num=num)
+            skipped.extend(int(num) for num in data.pop("_SKIPPED"))
+            m = len(data["DM"])
+            if not m:
+                continue
+            if ctx.manual_part is not None:
+                data["PART_NUM"] = [ctx.manual_part] * m
+            if first is None:
+                first = {c: v[0] for c, v in data.items()}
+                if calibrate:
+                    cal_rows = calibration_rows(cols, first.get("_FORMAT") or "16x16")
+                    w.writerows([r.get(c, "") for c in cols] for r in cal_rows)
+                    cal = len(cal_rows)
+            out = zip(*(data.get(c) or [""] * m for c in cols))
+            if skip is not None:
+                out = [row for row, dm in zip(out, data["DM"]) if not skip(dm)]
+            else:
+                out = list(out)
+            w.writerows(out)
+            written += len(out)
+    return PreparedBatch(staged, written, first, cal, skipped)
+
+
+def discard_staged(tmp_path: str) -> None:
+    """Remove staged batch files left behind by a cancelled job."""
+    folder, name = os.path.split(tmp_path)
+    try:
+        names = os.listdir(folder or ".")
+    except OSError:
+        return
+    for fn in names:
+        if fn.startswith(name + ".") and fn.endswith(".next"):
+            try:
+                os.remove(os.path.join(folder, fn))
+            except OSError:
+                pass
@@ -0,0 +1,74 @@
+"""Compiled cache of the parsed product map, kept in the app config dir.
+
+Parsing «Список товаров.xlsx» with openpyxl is the slowest part of startup.
+The parsed mapping is plain dicts of strings, ints and None, so it is stored
+with ``marshal`` next to the key of the workbook version it came from
+(``kontur_cache_key``: size, mtime and sampled content). A matching key means
+the workbook is not opened at all.
+"""
+from __future__ import annotations
+
+import marshal
+import os
+from typing import Callable, Dict, Optional, Tuple
+
+from .config import _cfg_dir
+from .data_io import read_product_map
+from .kontur_cache import kontur_cache_key
+
+CACHE_NAME = "product_map.cache"
+_VERSION = 1
+
+
+def product_cache_path(base_dir: Optional[str] = None) -> str:
+    return os.path.join(base_dir or _cfg_dir(), CACHE_NAME)
+
+
+def _read_cache(cache_path: str, key: str) -> Optional[Dict[str, object]]:
+    try:
+        with open(cache_path, "rb") as f:
+            data = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(data, dict) or data.get("version") != _VERSION or data.get("key") != key:
+        return None
+    mapping = data.get("map")
+    return mapping if isinstance(mapping, dict) else None
+
+
+def _write_cache(cache_path: str, key: str, mapping: Dict[str, object]) -> bool:
+    tmp = cache_path + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            marshal.dump({"version": _VERSION, "key": key, "map": mapping}, f)
+        os.replace(tmp, cache_path)
+        return True
+    except (OSError, ValueError):
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return False
+
+
+def load_product_map_cached(xlsx_path: str, cache_path: Optional[str] = None,
+                            reader: Callable[[str], Dict[str, object]] = read_product_map
+                            ) -> Tuple[Dict[str, object], bool]:
+    """Product map of a workbook and whether it came from the cache.
+
+    The workbook is parsed only when the cache is missing or was made from
+    another version of the file. An empty result (unreadable workbook) is
+    never cached.
+    """
+    cache_path = cache_path or product_cache_path()
+    try:
+        key = kontur_cache_key(xlsx_path)
+    except OSError:
+        return reader(xlsx_path) or {}, False
+    mapping = _read_cache(cache_path, key)
+    if mapping is not None:
+        return mapping, True
+    mapping = reader(xlsx_path) or {}
+    if mapping:
+        _write_cache(cache_path, key, mapping)
+    return mapping, False
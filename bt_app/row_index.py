@@ -0,0 +1,279 @@
+"""Byte-offset row index for random access into kontur TSV files."""
+from __future__ import annotations
+
+import io
+import mmap
+import os
+import struct
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Dict, Iterator, Optional
+
+from .data_io import (PARALLEL_MIN_BYTES, KonturColumns, _parse_kontur_range, is_streamed, iter_kontur_file,
+                      kontur_byte_ranges, kontur_dated)
+
+SIDECAR_SUFFIX = ".rowidx"
+
+_MAGIC = b"BTRIDX2\0"
+# magic, размер файла, mtime_ns, число строк
+_HEADER = struct.Struct("<8sQqQ")
+_BOM = b"\xef\xbb\xbf"
+
+
+def _is_data_line(line: bytes) -> Optional[bool]:
+    """Fast check of a raw line against the kontur skipping rules.
+
+    Returns None when the line needs a real csv parse (quoted first field,
+    or a header with a quoted field).
+    """
+    dm, _, rest = line.partition(b"\t")
+    dm = dm.strip()
+    if not dm:
+        return False
+    if dm[:1] == b'"':
+        return None
+    if dm.upper() == b"DM":
+        if b'"' in rest:
+            return None
+        parts = rest.split(b"\t")
+        name = parts[1].strip() if len(parts) > 1 else b""
+        return name.upper() not in (b"NAME", b"")
+    return True
+
+
+def _parse_line(raw: bytes, dated: bool = False) -> Optional[Dict[str, str]]:
+    text = raw.decode("utf-8").rstrip("\r\n")
+    return next(iter_kontur_file([text], dated), None)
+
+
+class KonturRowIndex:
+    """Offsets of every data row in a kontur file.
+
+    Built in one pass over the raw bytes (one record per physical line, as
+    kontur exports are written) and optionally persisted next to the file as
+    ``<file>.rowidx``. Indexing returns the same dicts as ``load_kontur_raw``;
+    ``dated`` (the header names a PROD_DATE column) is read from the file's
+    first line, since rows are parsed away from the header.
+    """
+
+    def __init__(self, path: str, offsets: array, size: int, mtime_ns: int, dated: Optional[bool] = None):
+        self.path = path
+        self.offsets = offsets
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.dated = kontur_dated(path) if dated is None else dated
+        self._mm: Optional[mmap.mmap] = None
+        self._fh = None
+
+    # ---------- построение / загрузка ----------
+
+    @staticmethod
+    def _scan(path: str, offsets: array, pos: int, end: int) -> None:
+        """Append offsets of data rows found in lines of ``[pos, end)``."""
+        append = offsets.append
+        with open(path, "rb") as f:
+            f.seek(pos)
+            first = pos == 0
+            while pos < end:
+                line = f.readline(end - pos)
+                if not line:
+                    break
+                start = pos
+                pos += len(line)
+                if first:
+                    first = False
+                    if line.startswith(_BOM):
+                        line = line[len(_BOM):]
+                        start += len(_BOM)
+                ok = _is_data_line(line)
+                if ok is None:
+                    ok = _parse_line(line) is not None
+                if ok:
+                    append(start)
+
+    @classmethod
+    def build(cls, path: str, workers: Optional[int] = None) -> "KonturRowIndex":
+        """Index a file in one pass; big files are scanned by byte ranges in a process pool."""
+        if is_streamed(path):
+            raise ValueError(f"Индекс строк строится только по несжатому файлу: {path}")
+        st = os.stat(path)
+        offsets = array("Q")
+        workers = workers or os.cpu_count() or 1
+        if workers <= 1 or st.st_size < PARALLEL_MIN_BYTES:
+            cls._scan(path, offsets, 0, st.st_size)
+        else:
+            # диапазоны начинаются с начала строки, смещения в каждом — абсолютные, порядок сохраняется
+            ranges = kontur_byte_ranges(path, workers * 4)
+            with ProcessPoolExecutor(max_workers=workers) as ex:
+                for part in ex.map(_scan_range, [(path, s, e) for s, e in ranges]):
+                    offsets.frombytes(part)
+        return cls(path, offsets, st.st_size, st.st_mtime_ns)
+
+    def extend_tail(self) -> int:
+        """Index rows appended since the index was built; returns how many were added.
+
+        Raises ValueError when the file shrank, so the caller can rebuild from scratch.
+        """
+        st = os.stat(self.path)
+        if st.st_size < self.size:
+            raise ValueError("file was truncated")
+        if st.st_size == self.size:
+            return 0
+        self.close()
+        before = len(self.offsets)
+        start = self._last_line_start()
+        # последняя строка могла быть записана не до конца — индексируем её заново
+        while self.offsets and self.offsets[-1] >= start:
+            self.offsets.pop()
+        self._scan(self.path, self.offsets, start, st.st_size)
+        self.size, self.mtime_ns = st.st_size, st.st_mtime_ns
+        return len(self.offsets) - before
+
+    def _last_line_start(self) -> int:
+        """Offset just past the last newline within the indexed size."""
+        pos = self.size
+        with open(self.path, "rb") as f:
+            while pos > 0:
+                lo = max(0, pos - 65536)
+                f.seek(lo)
+                nl = f.read(pos - lo).rfind(b"\n")
+                if nl >= 0:
+                    return lo + nl + 1
+                pos = lo
+        return 0
+
+    @classmethod
+    def load(cls, path: str, sidecar: Optional[str] = None) -> Optional["KonturRowIndex"]:
+        """Load a persisted index if it still matches the file's size and mtime."""
+        sidecar = sidecar or path + SIDECAR_SUFFIX
+        try:
+            st = os.stat(path)
+            with open(sidecar, "rb") as f:
+                magic, size, mtime_ns, count = _HEADER.unpack(f.read(_HEADER.size))
+                if magic != _MAGIC or size != st.st_size or mtime_ns != st.st_mtime_ns:
+                    return None
+                offsets = array("Q")
+                offsets.frombytes(f.read(count * offsets.itemsize))
+            if len(offsets) != count:
+                return None
+            return cls(path, offsets, size, mtime_ns)
+        except (OSError, struct.error):
+            return None
+
+    @classmethod
+    def open(cls, path: str, persist: bool = True, workers: Optional[int] = None) -> "KonturRowIndex":
+        """Return the sidecar index when valid, otherwise build (and save) a new one."""
+        idx = cls.load(path) if persist else None
+        if idx is None:
+            idx = cls.build(path, workers)
+            if persist:
+                idx.save()
+        return idx
+
+    def save(self, sidecar: Optional[str] = None) -> bool:
+        sidecar = sidecar or self.path + SIDECAR_SUFFIX
+        tmp = sidecar + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(_HEADER.pack(_MAGIC, self.size, self.mtime_ns, len(self.offsets)))
+                self.offsets.tofile(f)
+            os.replace(tmp, sidecar)
+            return True
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return False
+
+    # ---------- доступ к строкам ----------
+
+    def _map(self) -> Optional[mmap.mmap]:
+        if self._mm is None and self.size:
+            self._fh = open(self.path, "rb")
+            self._mm = mmap.mmap(self._fh.fileno(), self.size, access=mmap.ACCESS_READ)
+        return self._mm
+
+    def raw_line(self, i: int) -> bytes:
+        mm = self._map()
+        start = self.offsets[i]
+        end = mm.find(b"\n", start, self.size)
+        return mm[start:self.size if end < 0 else end]
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __bool__(self) -> bool:
+        return bool(self.offsets)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return [self[j] for j in range(start, stop, step)]
+            return list(self.iter_from(start, stop - start))
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("row index out of range")
+        return _parse_line(self.raw_line(i), self.dated)
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        return self.iter_from(0)
+
+    def iter_from(self, idx0: int, limit: Optional[int] = None) -> Iterator[Dict[str, str]]:
+        """Stream rows starting at row ``idx0`` by seeking straight to its offset."""
+        if idx0 >= len(self) or (limit is not None and limit <= 0):
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self.offsets[idx0])
+            # читаем не дальше проиндексированного размера (файл мог дописаться)
+            text = io.TextIOWrapper(io.BufferedReader(_Bounded(f, self.size - self.offsets[idx0])),
+                                    encoding="utf-8", newline="")
+            rows = iter_kontur_file(text, self.dated)
+            yield from (rows if limit is None else islice(rows, limit))
+
+    def columns(self, idx0: int, limit: int) -> KonturColumns:
+        """(DM, GTIN, NAME, PROD_DATE) columns of ``limit`` rows from ``idx0``, parsed as one byte block."""
+        stop = min(len(self), idx0 + limit)
+        if idx0 >= stop:
+            return [], [], [], []
+        end = self.offsets[stop] if stop < len(self) else self.size
+        return _parse_kontur_range((self.path, self.offsets[idx0], end, self.dated))
+
+    def close(self) -> None:
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+def _scan_range(args) -> bytes:
+    """Process-pool worker: offsets of the data rows in one byte range, as raw ``array('Q')`` bytes."""
+    path, start, end = args
+    offsets = array("Q")
+    KonturRowIndex._scan(path, offsets, start, end)
+    return offsets.tobytes()
+
+
+class _Bounded(io.RawIOBase):
+    """Raw reader limited to ``n`` bytes of an underlying binary file."""
+
+    def __init__(self, f, n: int):
+        self._f = f
+        self._left = n
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        if self._left <= 0:
+            return 0
+        data = self._f.read(min(len(b), self._left))
+        n = len(data)
+        b[:n] = data
+        self._left -= n
+        return n
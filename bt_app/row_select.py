@@ -0,0 +1,282 @@
+"""Row lookups by DM/GTIN and row selections for the print paths."""
+from __future__ import annotations
+
+import heapq
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .data_io import only_digits
+from .gs1 import normalize_dm
+from .row_store import KonturRowStore
+
+try:
+    import numpy as np
+except Exception:  # pragma: no cover - optional dependency
+    np = None
+
+# строк в одном отсортированном куске, когда сортировка идёт без NumPy
+SORT_RUN_ROWS = 1 << 16
+
+
+class RowSelection:
+    """Ordered list of 0-based half-open row ranges ``[start, stop)``."""
+
+    def __init__(self, ranges: Iterable[Tuple[int, int]] = ()) -> None:
+        self.ranges: List[Tuple[int, int]] = [(s, e) for s, e in ranges if e > s]
+
+    @classmethod
+    def span(cls, idx0: int, limit: Optional[int], total: int) -> "RowSelection":
+        """The classic «Строка №» + «Лимит» range."""
+        stop = total if not limit else min(total, idx0 + limit)
+        return cls([(idx0, stop)])
+
+    @classmethod
+    def from_positions(cls, positions: Iterable[int]) -> "RowSelection":
+        """Collapse consecutive positions into ranges, keeping their order."""
+        ranges: List[Tuple[int, int]] = []
+        start = prev = None
+        for p in positions:
+            if prev is not None and p == prev + 1:
+                prev = p
+                continue
+            if start is not None:
+                ranges.append((start, prev + 1))
+            start = prev = p
+        if start is not None:
+            ranges.append((start, prev + 1))
+        return cls(ranges)
+
+    def __len__(self) -> int:
+        return sum(e - s for s, e in self.ranges)
+
+    def __bool__(self) -> bool:
+        return bool(self.ranges)
+
+    def positions(self) -> Iterator[int]:
+        for s, e in self.ranges:
+            yield from range(s, e)
+
+    def chunks(self, size: int) -> Iterator["RowSelection"]:
+        """Consecutive sub-selections of ``size`` rows (the last one may be shorter)."""
+        part: List[Tuple[int, int]] = []
+        left = size
+        for s, e in self.ranges:
+            while s < e:
+                step = min(left, e - s)
+                part.append((s, s + step))
+                s += step
+                left -= step
+                if not left:
+                    yield RowSelection(part)
+                    part, left = [], size
+        if part:
+            yield RowSelection(part)
+
+    def describe(self, max_parts: int = 6) -> str:
+        """1-based human-readable form: "17, 340-360, 9021"."""
+        parts = [str(s + 1) if e - s == 1 else f"{s + 1}-{e}" for s, e in self.ranges[:max_parts]]
+        if len(self.ranges) > max_parts:
+            parts.append("…")
+        return ", ".join(parts)
+
+
+def _norm_gtin(gtin: str) -> str:
+    digits = only_digits(gtin)
+    return digits.zfill(14) if digits else ""
+
+
+class KonturLookup:
+    """Per-file indexes: DM → first row and GTIN → row positions.
+
+    DM codes are kept as sorted 64-bit string hashes with a parallel
+    positions array (12 bytes per row), so a lookup is a binary search rather
+    than a scan. The hashes are only valid inside the running process, and
+    a match is confirmed against the row's DM through ``dm_at`` when the
+    lookup has one. With NumPy the hashes are argsorted in C; without it,
+    runs of ``SORT_RUN_ROWS`` are sorted in Python and merged into arrays.
+    """
+
+    def __init__(self, keys: array, key_pos: array, gtin_pos: Dict[str, array], total: int) -> None:
+        self._keys = keys
+        self._key_pos = key_pos
+        self._gtin_pos = gtin_pos
+        self.total = total
+        # DM строки по её номеру (0-based); None — совпадение хэша не перепроверяется
+        self.dm_at: Optional[Callable[[int], str]] = None
+
+    @classmethod
+    def build(cls, rows: Iterable[Dict[str, str]]) -> "KonturLookup":
+        raw = array("q")
+        gtin_pos: Dict[str, array] = {}
+        by_raw_gtin: Dict[str, array] = {}
+        for pos, row in enumerate(rows):
+            raw.append(hash(row.get("DM", "")))
+            g = row.get("GTIN", "")
+            bucket = by_raw_gtin.get(g)
+            if bucket is None:
+                norm = _norm_gtin(g)
+                bucket = by_raw_gtin[g] = gtin_pos.setdefault(norm, array("I"))
+            bucket.append(pos)
+        return cls._from_hashes(raw, gtin_pos)
+
+    @classmethod
+    def from_columns(cls, chunks: Iterable[Tuple[List[str], List[str]]]) -> "KonturLookup":
+        """Same as ``build`` from (DM, GTIN) column chunks in file order."""
+        raw = array("q")
+        gtin_pos: Dict[str, array] = {}
+        by_raw_gtin: Dict[str, array] = {}
+        pos = 0
+        for dms, gtins in chunks:
+            raw.extend(map(hash, dms))
+            for pos, g in enumerate(gtins, pos):
+                bucket = by_raw_gtin.get(g)
+                if bucket is None:
+                    bucket = by_raw_gtin[g] = gtin_pos.setdefault(_norm_gtin(g), array("I"))
+                bucket.append(pos)
+            pos = len(raw)
+        return cls._from_hashes(raw, gtin_pos)
+
+    @classmethod
+    def from_store(cls, store: KonturRowStore) -> "KonturLookup":
+        """Same as ``build`` but straight from the store columns, without building row dicts."""
+        raw = array("q", map(hash, store.iter_dms()))
+        by_id = [array("I") for _ in store.gtins]
+        for pos, gid in enumerate(store.gtin_ids()):
+            by_id[gid].append(pos)
+        gtin_pos: Dict[str, array] = {}
+        for g, rows in zip(store.gtins, by_id):
+            norm = _norm_gtin(g)
+            prev = gtin_pos.get(norm)
+            # разные написания одного GTIN — слить с сохранением порядка строк
+            gtin_pos[norm] = rows if prev is None else array("I", sorted(prev + rows))
+        lookup = cls._from_hashes(raw, gtin_pos)
+        lookup.dm_at = store.dm
+        return lookup
+
+    @classmethod
+    def _from_hashes(cls, raw: array, gtin_pos: Dict[str, array]) -> "KonturLookup":
+        # стабильная сортировка: при повторах DM первой идёт более ранняя строка
+        if np is not None:
+            hashes = np.frombuffer(raw, dtype=np.int64)
+            order = np.argsort(hashes, kind="stable")
+            keys = array("q", hashes[order].tobytes())
+            return cls(keys, array("I", order.astype(np.uint32).tobytes()), gtin_pos, len(raw))
+        keys, pos = array("q"), array("I")
+        runs = []
+        for s in range(0, len(raw), SORT_RUN_ROWS):
+            order = sorted(range(s, min(len(raw), s + SORT_RUN_ROWS)), key=raw.__getitem__)
+            runs.append((array("q", (raw[i] for i in order)), array("I", order)))
+        if len(runs) == 1:
+            return cls(runs[0][0], runs[0][1], gtin_pos, len(raw))
+        # куски сливаются по (хэш, строка) — при равных хэшах раньше идёт более ранняя строка
+        for k, p in heapq.merge(*(zip(k, p) for k, p in runs)):
+            keys.append(k)
+            pos.append(p)
+        return cls(keys, pos, gtin_pos, len(raw))
+
+    def duplicate_rows(self, start0: int = 0) -> array:
+        """Rows from ``start0`` on (0-based, ascending) whose DM already occurred in an earlier row."""
+        keys, pos = self._keys, self._key_pos
+        if np is not None and keys:
+            k = np.frombuffer(keys, dtype=np.int64)
+            rows = np.frombuffer(pos, dtype=np.uint32)[np.flatnonzero(k[1:] == k[:-1]) + 1]
+            rows = np.sort(rows[rows >= start0])
+            return array("I", rows.astype(np.uint32).tobytes())
+        rows = [p for k0, k1, p in zip(keys, islice(keys, 1, None), islice(pos, 1, None))
+                if k0 == k1 and p >= start0]
+        rows.sort()
+        return array("I", rows)
+
+    def _hash_rows(self, dm: str) -> Iterator[int]:
+        """Rows whose DM has the hash of ``dm``, ascending, confirmed by ``dm_at`` when set."""
+        k = hash(dm)
+        i = bisect_left(self._keys, k)
+        j = bisect_right(self._keys, k, i)
+        for p in self._key_pos[i:j]:
+            if self.dm_at is None or self.dm_at(p) == dm:
+                yield p
+
+    def find_dm(self, dm: str) -> Optional[int]:
+        """0-based row of the first occurrence of a DM code, or None."""
+        dm = (dm or "").strip()
+        for candidate in dict.fromkeys((dm, normalize_dm(dm))):
+            pos = next(self._hash_rows(candidate), None)
+            if pos is not None:
+                return pos
+        return None
+
+    def dm_rows(self, dm: str) -> List[int]:
+        """All 0-based rows of an exact DM code, ascending."""
+        return list(self._hash_rows(dm))
+
+    def gtin_rows(self, gtin: str) -> array:
+        return self._gtin_pos.get(_norm_gtin(gtin), array("I"))
+
+    def gtin_counts(self) -> List[Tuple[str, int]]:
+        return sorted(((g, len(p)) for g, p in self._gtin_pos.items()), key=lambda t: -t[1])
+
+    def select_gtin(self, gtin: str, start0: int = 0) -> RowSelection:
+        rows = self.gtin_rows(gtin)
+        return RowSelection.from_positions(rows[bisect_left(rows, start0):])
+
+    def select_from_dm(self, dm: str) -> RowSelection:
+        pos = self.find_dm(dm)
+        if pos is None:
+            raise ValueError(f"DM не найден в файле: {dm}")
+        return RowSelection([(pos, self.total)])
+
+
+_ROWS_PART = re.compile(r"^(\d+)(?:\s*[-–]\s*(\d+))?$")
+
+
+def parse_row_ranges(text: str, total: int) -> RowSelection:
+    """Parse "17, 340-360, 9021" (1-based, inclusive) into a selection, in the given order."""
+    ranges: List[Tuple[int, int]] = []
+    for part in re.split(r"[,;]+", text):
+        part = part.strip()
+        if not part:
+            continue
+        m = _ROWS_PART.match(part)
+        if not m:
+            raise ValueError(f"Не понимаю часть отбора: '{part}'")
+        a = int(m.group(1))
+        b = int(m.group(2) or a)
+        if a < 1 or b < a:
+            raise ValueError(f"Неверный диапазон строк: '{part}'")
+        if b > total:
+            raise ValueError(f"Строка {b} за пределами файла (всего {total})")
+        if ranges and ranges[-1][1] == a - 1:
+            # 5-9, 10-12 → один диапазон
+            ranges[-1] = (ranges[-1][0], b)
+        else:
+            ranges.append((a - 1, b))
+    return RowSelection(ranges)
+
+
+def parse_selection(text: str, lookup: Optional[KonturLookup], total: int) -> Optional[RowSelection]:
+    """Parse the «Отбор» field; None when it is empty (use «Строка №» + «Лимит»).
+
+    ``17, 340-360, 9021`` — exactly these rows; ``GTIN=<код>`` — only rows of
+    that product; ``DM=<код>`` — from that code to the end.
+    """
+    text = (text or "").strip()
+    if not text:
+        return None
+    if text[0].isdigit():
+        return parse_row_ranges(text, total)
+    key, sep, value = text.partition("=")
+    key = key.strip().upper()
+    if sep and key in ("GTIN", "DM"):
+        if lookup is None:
+            raise ValueError("Индекс строк ещё не построен")
+        value = value.strip()
+        if key == "GTIN":
+            sel = lookup.select_gtin(value)
+            if not sel:
+                raise ValueError(f"Строк с GTIN {value} нет")
+            return sel
+        return lookup.select_from_dm(value)
+    raise ValueError(f"Не понимаю отбор: '{text}' (ожидается 17, 340-360 … / GTIN=… / DM=…)")
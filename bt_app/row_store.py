@@ -0,0 +1,230 @@
+"""Compact columnar storage for parsed kontur rows."""
+from __future__ import annotations
+
+import struct
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional
+
+_MAGIC = b"BTRSTO3\0"
+# magic, строк, байт DM, затем (число значений, байт таблицы) для GTIN, NAME и PROD_DATE
+_HEADER = struct.Struct("<8sQQQQQQQQ")
+
+
+class KonturRowStore:
+    """Kontur rows kept as columns instead of one dict per row.
+
+    DM codes live in a single UTF-8 buffer addressed by an offsets array;
+    GTIN, NAME and the optional per-row PROD_DATE are interned into small
+    per-file tables and stored as integer ids. Indexing returns the same dicts as ``load_kontur_raw``;
+    slicing returns a ``KonturRowView`` over the store without copying.
+    """
+
+    def __init__(self) -> None:
+        self._dm_buf = bytearray()
+        self._dm_off = array("Q", [0])
+        self._gtin_ids = array("I")
+        self._name_ids = array("I")
+        self._date_ids = array("I")
+        self.gtins: List[str] = []
+        self.names: List[str] = []
+        # id 0 — «дата не указана»
+        self.dates: List[str] = [""]
+        self._gtin_lookup: Dict[str, int] = {}
+        self._name_lookup: Dict[str, int] = {}
+        self._date_lookup: Dict[str, int] = {"": 0}
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Dict[str, str]]) -> "KonturRowStore":
+        store = cls()
+        store.extend(rows)
+        return store
+
+    @staticmethod
+    def _intern(value: str, table: List[str], lookup: Dict[str, int]) -> int:
+        i = lookup.get(value)
+        if i is None:
+            i = lookup[value] = len(table)
+            table.append(value)
+        return i
+
+    def append(self, row: Dict[str, str]) -> None:
+        self._dm_buf += row.get("DM", "").encode("utf-8")
+        self._dm_off.append(len(self._dm_buf))
+        self._gtin_ids.append(self._intern(row.get("GTIN", ""), self.gtins, self._gtin_lookup))
+        self._name_ids.append(self._intern(row.get("NAME", ""), self.names, self._name_lookup))
+        self._date_ids.append(self._intern(row.get("PROD_DATE", ""), self.dates, self._date_lookup))
+
+    def extend(self, rows: Iterable[Dict[str, str]]) -> None:
+        for row in rows:
+            self.append(row)
+
+    def extend_columns(self, dms: List[str], gtins: List[str], names: List[str],
+                       dates: Optional[List[str]] = None) -> None:
+        """Append a chunk given as parallel DM/GTIN/NAME(/PROD_DATE) columns."""
+        buf, off = self._dm_buf, self._dm_off
+        for dm in dms:
+            buf += dm.encode("utf-8")
+            off.append(len(buf))
+        intern = self._intern
+        self._gtin_ids.extend(intern(g, self.gtins, self._gtin_lookup) for g in gtins)
+        self._name_ids.extend(intern(n, self.names, self._name_lookup) for n in names)
+        if dates:
+            self._date_ids.extend(intern(p, self.dates, self._date_lookup) for p in dates)
+        else:
+            self._date_ids.extend(array("I", bytes(4 * len(names))))
+
+    # ---------- колонки ----------
+
+    def dm(self, i: int) -> str:
+        return self._dm_buf[self._dm_off[i]:self._dm_off[i + 1]].decode("utf-8")
+
+    def gtin(self, i: int) -> str:
+        return self.gtins[self._gtin_ids[i]]
+
+    def name(self, i: int) -> str:
+        return self.names[self._name_ids[i]]
+
+    def gtin_id(self, i: int) -> int:
+        return self._gtin_ids[i]
+
+    # id-колонки целиком (только для чтения)
+
+    def gtin_ids(self) -> array:
+        return self._gtin_ids
+
+    def name_ids(self) -> array:
+        return self._name_ids
+
+    def date_ids(self) -> array:
+        return self._date_ids
+
+    def dm_slice(self, start: int, stop: int) -> List[str]:
+        """DM codes of rows ``[start, stop)``; ASCII buffers (the usual case) are decoded in one go."""
+        off = self._dm_off
+        base = off[start]
+        chunk = bytes(self._dm_buf[base:off[stop]])
+        if chunk.isascii():
+            text = chunk.decode("ascii")
+            return [text[off[i] - base:off[i + 1] - base] for i in range(start, stop)]
+        return [chunk[off[i] - base:off[i + 1] - base].decode("utf-8") for i in range(start, stop)]
+
+    def iter_dms(self) -> Iterator[str]:
+        buf, off = self._dm_buf, self._dm_off
+        for i in range(len(self)):
+            yield buf[off[i]:off[i + 1]].decode("utf-8")
+
+    # ---------- протокол последовательности ----------
+
+    def __len__(self) -> int:
+        return len(self._gtin_ids)
+
+    def __bool__(self) -> bool:
+        return len(self._gtin_ids) > 0
+
+    def _row(self, i: int) -> Dict[str, str]:
+        row = {"DM": self.dm(i), "GTIN": self.gtins[self._gtin_ids[i]], "NAME": self.names[self._name_ids[i]]}
+        date_id = self._date_ids[i]
+        if date_id:
+            row["PROD_DATE"] = self.dates[date_id]
+        return row
+
+    def __getitem__(self, i):
+        n = len(self)
+        if isinstance(i, slice):
+            start, stop, step = i.indices(n)
+            if step != 1:
+                return [self._row(j) for j in range(start, stop, step)]
+            return KonturRowView(self, start, max(start, stop))
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError("row index out of range")
+        return self._row(i)
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        return (self._row(i) for i in range(len(self)))
+
+    # ---------- двоичный формат (кэш разобранных файлов) ----------
+
+    def to_bytes(self) -> bytes:
+        gtins = "\0".join(self.gtins).encode("utf-8")
+        names = "\0".join(self.names).encode("utf-8")
+        dates = "\0".join(self.dates).encode("utf-8")
+        head = _HEADER.pack(_MAGIC, len(self), len(self._dm_buf), len(self.gtins), len(gtins),
+                            len(self.names), len(names), len(self.dates), len(dates))
+        return b"".join((head, self._dm_off.tobytes(), self._gtin_ids.tobytes(), self._name_ids.tobytes(),
+                         self._date_ids.tobytes(), bytes(self._dm_buf), gtins, names, dates))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "KonturRowStore":
+        """Inverse of ``to_bytes``; raises ValueError on a foreign or truncated buffer."""
+        if len(data) < _HEADER.size:
+            raise ValueError("row store buffer is truncated")
+        magic, n, dm_len, n_gtins, gtins_len, n_names, names_len, n_dates, dates_len = _HEADER.unpack_from(data)
+        if magic != _MAGIC:
+            raise ValueError("not a row store buffer")
+        store = cls()
+        mv = memoryview(data)
+        pos = _HEADER.size
+
+        def take(size: int) -> memoryview:
+            nonlocal pos
+            if pos + size > len(data):
+                raise ValueError("row store buffer is truncated")
+            chunk = mv[pos:pos + size]
+            pos += size
+            return chunk
+
+        store._dm_off = array("Q")
+        store._dm_off.frombytes(take((n + 1) * store._dm_off.itemsize))
+        store._gtin_ids.frombytes(take(n * store._gtin_ids.itemsize))
+        store._name_ids.frombytes(take(n * store._name_ids.itemsize))
+        store._date_ids.frombytes(take(n * store._date_ids.itemsize))
+        store._dm_buf = bytearray(take(dm_len))
+        store.gtins = str(take(gtins_len), "utf-8").split("\0") if n_gtins else []
+        store.names = str(take(names_len), "utf-8").split("\0") if n_names else []
+        store.dates = str(take(dates_len), "utf-8").split("\0")
+        if len(store.gtins) != n_gtins or len(store.names) != n_names or len(store.dates) != n_dates:
+            raise ValueError("row store tables are damaged")
+        store._gtin_lookup = {v: i for i, v in enumerate(store.gtins)}
+        store._name_lookup = {v: i for i, v in enumerate(store.names)}
+        store._date_lookup = {v: i for i, v in enumerate(store.dates)}
+        return store
+
+    def nbytes(self) -> int:
+        """Approximate size of the column buffers (interned tables excluded)."""
+        return (len(self._dm_buf) + self._dm_off.itemsize * len(self._dm_off)
+                + self._gtin_ids.itemsize * len(self._gtin_ids) + self._name_ids.itemsize * len(self._name_ids)
+                + self._date_ids.itemsize * len(self._date_ids))
+
+
+class KonturRowView:
+    """Read-only window ``[start, stop)`` over a ``KonturRowStore``."""
+
+    def __init__(self, store: KonturRowStore, start: int, stop: int) -> None:
+        self.store = store
+        self.start = start
+        self.stop = stop
+
+    def __len__(self) -> int:
+        return self.stop - self.start
+
+    def __bool__(self) -> bool:
+        return self.stop > self.start
+
+    def __getitem__(self, i):
+        n = len(self)
+        if isinstance(i, slice):
+            start, stop, step = i.indices(n)
+            if step != 1:
+                return [self.store._row(self.start + j) for j in range(start, stop, step)]
+            return KonturRowView(self.store, self.start + start, self.start + max(start, stop))
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError("row index out of range")
+        return self.store._row(self.start + i)
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        row = self.store._row
+        return (row(i) for i in range(self.start, self.stop))
@@ -0,0 +1,55 @@
+"""Crash-recovery snapshot of the working session.
+
+The snapshot holds everything that is slow to rebuild: the parsed kontur
+rows (as a ``KonturRowStore`` buffer), the product map and the state of the
+current print batch. It is a single pickle written atomically to the config
+dir and removed on a clean exit, so its presence at startup means the
+previous session did not end normally.
+"""
+from __future__ import annotations
+
+import os
+import pickle
+from typing import Any, Dict, Optional
+
+from .config import _cfg_dir
+
+SESSION_NAME = "session.snap"
+_VERSION = 1
+
+
+def session_path(base_dir: Optional[str] = None) -> str:
+    return os.path.join(base_dir or _cfg_dir(), SESSION_NAME)
+
+
+def save_session(state: Dict[str, Any], path: Optional[str] = None) -> int:
+    """Write the snapshot atomically; returns its size in bytes."""
+    path = path or session_path()
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump({"version": _VERSION, **state}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        size = f.tell()
+    os.replace(tmp, path)
+    return size
+
+
+def load_session(path: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Read a snapshot; None when there is none or it is unreadable / from another version."""
+    path = path or session_path()
+    try:
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+    except Exception:
+        return None
+    if not isinstance(state, dict) or state.get("version") != _VERSION:
+        return None
+    return state
+
+
+def clear_session(path: Optional[str] = None) -> None:
+    path = path or session_path()
+    for p in (path, path + ".tmp"):
+        try:
+            os.remove(p)
+        except OSError:
+            pass
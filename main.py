@@ -1,4 +1,6 @@
 """Entry point for launching the BarTender GUI application."""
+import multiprocessing
+
 from bt_app.gui import App
 
 
@@ -8,4 +10,6 @@ def main() -> None:
 
 
 if __name__ == "__main__":
+    # нужно для пула процессов в собранном PyInstaller .exe
+    multiprocessing.freeze_support()
     main()